@@ -0,0 +1,438 @@
+# -*- coding: utf-8 -*-
+"""
+Headless drift correction of many datasets.
+
+    cc_drift_cor_batch locs "data/*.hdf" --output results --set binsize=20 --set step=500
+    cc_drift_cor_batch images data/ --output results --jobs 2 --memory-budget 16000
+
+Localization data is corrected with ``Locs_RCC``, ``Drift_Interpolate`` and ``Locs_Post_Shift``. XYT images
+with ``Image_RCC_Streaming``, ``Drift_Interpolate`` and ``Image_Post_Shift``, XYZT images with ``Image_RCC`` and
+``Image_Post_Shift_3D``. ``--set name=value`` sets a parameter on every module that has it.
+
+One worker pool is started for the whole batch and shared by all modules. Several datasets are corrected at the
+same time (``--jobs``) as long as their estimated memory use fits in ``--memory-budget``. Each dataset gets its
+own folder in ``--output`` with ``drift.npz`` (same format as ``Drift_Save``), the corrected dataset, caches and
+the timing reports of the modules. A timing summary of all datasets is printed at the end and saved as
+``summary.json``.
+
+PYME is only imported once the pool is running, workers only need ``engine``.
+"""
+
+import os
+import sys
+import ast
+import glob
+import json
+import time
+import argparse
+import threading
+import traceback
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from contextlib import contextmanager
+from collections import OrderedDict
+
+import numpy as np
+
+from cc_drift_cor import engine
+
+import logging
+logger=logging.getLogger(__name__)
+
+FILE_EXTENSIONS = {'locs': ('.hdf', '.h5r'),
+                   'images': ('.h5', '.tif', '.tiff'),
+                   }
+
+STAGES = ['open', 'wait', 'drift', 'interpolate', 'correct', 'save']
+
+# memory of the shift batches in flight and other temporaries not covered by the estimates
+WORKING_BYTES = 2**29
+
+def find_datasets(patterns, kind):
+    """
+        Files matching any of the glob patterns. Folders are searched for files of the kind.
+    """
+    filenames = list()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            matches = [os.path.join(pattern, f) for f in os.listdir(pattern) if os.path.splitext(f)[1].lower() in FILE_EXTENSIONS[kind]]
+        else:
+            matches = glob.glob(pattern)
+        for filename in sorted(matches):
+            if not filename in filenames:
+                filenames.append(filename)
+    return filenames
+
+def parse_settings(items):
+    """
+        'name=value' strings to dict. Values are python literals, anything else is kept as string.
+    """
+    settings = OrderedDict()
+    for item in items:
+        name, sep, value = item.partition('=')
+        if sep == "":
+            raise ValueError("Setting {} is not name=value.".format(item))
+        try:
+            settings[name.strip()] = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            settings[name.strip()] = value
+    return settings
+
+def get_total_memory():
+    """
+        Physical memory in bytes, None if unknown.
+    """
+    try:
+        import psutil
+        return int(psutil.virtual_memory().total)
+    except ImportError:
+        pass
+    try:
+        return int(os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES'))
+    except (AttributeError, ValueError, OSError):
+        return None
+
+class MemoryBudget(object):
+    """
+        Lets datasets run together while the sum of their estimates fits in the budget.
+        A dataset is always allowed to run alone, even if it is over the budget.
+    """
+    def __init__(self, budget):
+        self.budget = budget
+        self.used = 0
+        self._condition = threading.Condition()
+    
+    @contextmanager
+    def reserve(self, nbytes):
+        with self._condition:
+            while self.used > 0 and self.used + nbytes > self.budget:
+                self._condition.wait()
+            self.used += nbytes
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.used -= nbytes
+                self._condition.notify_all()
+
+class DatasetRun(object):
+    """
+        Correction of one dataset. Subclasses open the dataset, estimate its memory use and run the modules.
+    """
+    def __init__(self, filename, out_dir, args, settings):
+        self.filename = filename
+        self.out_dir = out_dir
+        self.args = args
+        self.settings = settings
+        self.timings = OrderedDict((stage, 0.) for stage in STAGES)
+        self.estimated_bytes = None
+    
+    @contextmanager
+    def stage(self, name):
+        t_start = time.time()
+        try:
+            yield
+        finally:
+            self.timings[name] += time.time() - t_start
+    
+    def setup_module(self, module):
+        """
+            Caches and reports into the output folder of the dataset, then the user settings.
+        """
+        for trait_name in module.editable_traits():
+            if trait_name.startswith("cache_"):
+                if self.args.cache == 'disk':
+                    cache_name = os.path.basename(module.trait_get(trait_name)[trait_name]) or "{}.bin".format(trait_name)
+                    module.trait_set(**{trait_name: os.path.join(self.out_dir, cache_name)})
+                else:
+                    module.trait_set(**{trait_name: ""})
+        # the memory estimates of the budget assume caches are used as chosen, not planned by the modules
+        if 'storage' in module.editable_traits():
+            module.trait_set(storage='File' if self.args.cache == 'disk' else 'Memory')
+        
+        if 'multiprocessing' in module.editable_traits():
+            module.trait_set(multiprocessing=self.args.workers > 1)
+        module.trait_set(report_path=os.path.join(self.out_dir, "report_{}.json".format(module.__class__.__name__)))
+        
+        for name, value in self.settings.items():
+            if name in module.editable_traits():
+                module.trait_set(**{name: value})
+        
+        return module
+    
+    def save_drift(self, t_shift, drift):
+        # same as DriftOutput
+        np.savez_compressed(os.path.join(self.out_dir, "drift.npz"), tIndex=t_shift, drift=drift)
+    
+    def interpolate(self, t_shift, drift):
+        with self.stage('interpolate'):
+            return engine.interpolate_drift(t_shift, drift, self.args.degree_of_spline, self.args.smoothing_factor)
+    
+    def run(self, budget):
+        with self.stage('open'):
+            self.open()
+        self.estimated_bytes = self.estimate_memory()
+        
+        t_wait = time.time()
+        with budget.reserve(self.estimated_bytes):
+            self.timings['wait'] = time.time() - t_wait
+            self.correct()
+
+class LocalizationRun(DatasetRun):
+    @staticmethod
+    def make_modules():
+        from cc_drift_cor.plugins.recipes import localisations
+        return [localisations.RCCDriftCorrection()]
+    
+    def open(self):
+        from PYME.IO import tabular
+        
+        if self.filename.lower().endswith('.h5r'):
+            source_class = tabular.H5RSource
+        else:
+            source_class = tabular.HDFSource
+        
+        tables = [self.args.table] if self.args.table != "" else ['FitResults', 'Localizations']
+        for i, table in enumerate(tables):
+            try:
+                self.source = source_class(self.filename, table)
+                self.table = table
+                break
+            except Exception:
+                if i == len(tables) - 1:
+                    raise
+        
+        self.rcc, = [self.setup_module(m) for m in self.make_modules()]
+    
+    def estimate_memory(self):
+        """
+            Coordinates and their copies during RCC, plus the ft images unless cached to file.
+        """
+        rcc = self.rcc
+        n_events = len(self.source)
+        estimate = 8 * n_events * 10
+        
+        if rcc.cache_fft == "":
+            dims = ['x', 'y'] if rcc.flatten_z else ['x', 'y', 'z']
+            n_bins = np.prod([np.ceil(np.ptp(self.source[k]) / rcc.binsize) + 2 for k in dims])
+            t = self.source['t']
+            if rcc.window_mode == 'Adaptive':
+                n_steps = n_events / float(max(rcc.target_count, 1)) + 1
+            else:
+                n_steps = np.ptp(t) / float(rcc.step) + 1
+            estimate += int(16 * n_steps * (n_bins // 2 + 1))
+        
+        return estimate + WORKING_BYTES
+    
+    def correct(self):
+        from cc_drift_cor.plugins.recipes import localisations
+        
+        rcc = self.rcc
+        namespace = {rcc.input_for_correction: self.source, rcc.input_for_mapping: self.source}
+        with self.stage('drift'):
+            rcc.execute(namespace)
+        t_shift, drift = namespace[rcc.output_drift]
+        self.save_drift(t_shift, drift)
+        
+        interpolators = self.interpolate(t_shift, drift)
+        if self.args.drift_only:
+            return
+        
+        with self.stage('correct'):
+            corrected = localisations.DriftCorrectedSource(self.source, interpolators)
+        with self.stage('save'):
+            corrected.to_hdf(os.path.join(self.out_dir, "corrected{}".format(os.path.splitext(self.filename)[1])), self.table)
+
+class ImageRun(DatasetRun):
+    @staticmethod
+    def make_modules(volume=False):
+        from cc_drift_cor.plugins.recipes import processing
+        if volume:
+            return [processing.RCCDriftCorrection(), processing.ShiftVolume()]
+        return [processing.StreamingRCCDriftCorrection(), processing.ShiftImage()]
+    
+    def open(self):
+        from PYME.IO.image import ImageStack
+        
+        self.image = ImageStack(filename=self.filename, haveGUI=False)
+        # XYZT, same test as Image_RCC
+        self.volume = self.image.data.nTrueDims == 4
+        self.rcc, self.shift = [self.setup_module(m) for m in self.make_modules(self.volume)]
+    
+    def estimate_memory(self):
+        """
+            Image data, working memory of the streaming RCC, plus the ft images and the shifted images
+            unless they are cached to file.
+        """
+        shape = self.image.data.shape
+        n_voxels = int(np.prod(shape))
+        estimate = n_voxels * np.dtype(self.image.data.dtype).itemsize
+        
+        if not self.volume:
+            estimate += int(self.rcc.memory_budget * 2**20)
+        if self.rcc.cache_fft == "":
+            binsize = self.rcc.binsize if not self.volume else [1, 1, 1]
+            estimate += 16 * (n_voxels // int(np.prod(binsize)) // 2 + 1)
+        if self.shift.cache_image == "" and not self.shift.lazy:
+            estimate += 8 * n_voxels
+        
+        return estimate + WORKING_BYTES
+    
+    def correct(self):
+        rcc = self.rcc
+        namespace = {rcc.input_image: self.image, self.shift.input_image: self.image}
+        with self.stage('drift'):
+            rcc.execute(namespace)
+        t_shift, drift = namespace[rcc.output_drift]
+        self.save_drift(t_shift, drift)
+        
+        interpolators = self.interpolate(t_shift, drift)
+        if self.args.drift_only:
+            return
+        
+        namespace[self.shift.input_drift_interpolator] = interpolators
+        with self.stage('correct'):
+            self.shift.execute(namespace)
+        with self.stage('save'):
+            namespace[self.shift.outputName].Save(filename=os.path.join(self.out_dir, "corrected.h5"))
+
+RUNS = {'locs': LocalizationRun,
+        'images': ImageRun,
+        }
+
+def check_settings(kind, settings):
+    """
+        Raises ValueError for settings no module of this kind has.
+    """
+    if kind == 'images':
+        modules = ImageRun.make_modules(False) + ImageRun.make_modules(True)
+    else:
+        modules = LocalizationRun.make_modules()
+    
+    for name in settings:
+        if not any(name in m.editable_traits() for m in modules):
+            raise ValueError("No {} module has a parameter {}.".format(kind, name))
+
+def make_output_dirs(filenames, output):
+    """
+        One folder per dataset named after the file. Repeated names get a number.
+    """
+    out_dirs = list()
+    for filename in filenames:
+        name = os.path.splitext(os.path.basename(filename))[0]
+        out_dir = os.path.join(output, name)
+        i = 1
+        while out_dir in out_dirs:
+            out_dir = os.path.join(output, "{}_{}".format(name, i))
+            i += 1
+        out_dirs.append(out_dir)
+    
+    for out_dir in out_dirs:
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+    return out_dirs
+
+def run_batch(kind, filenames, output, args, settings):
+    """
+        Corrects all files and returns a summary per file.
+    """
+    budget = MemoryBudget(args.memory_budget * 2**20)
+    out_dirs = make_output_dirs(filenames, output)
+    
+    def process(job):
+        filename, out_dir = job
+        run = RUNS[kind](filename, out_dir, args, settings)
+        summary = OrderedDict([('file', filename), ('output', out_dir), ('status', 'ok')])
+        t_start = time.time()
+        try:
+            run.run(budget)
+        except Exception as e:
+            logger.error("Failed on {}\n{}".format(filename, traceback.format_exc()))
+            summary['status'] = "failed: {}".format(e)
+        summary['estimated_bytes'] = run.estimated_bytes
+        summary['seconds'] = run.timings
+        summary['total_seconds'] = time.time() - t_start
+        print("Finished {} ({}) in {:.2f} s.".format(filename, summary['status'], summary['total_seconds']))
+        return summary
+    
+    summaries = dict()
+    jobs = ThreadPool(processes=max(args.jobs, 1))
+    try:
+        for summary in jobs.imap_unordered(process, list(zip(filenames, out_dirs))):
+            summaries[summary['file']] = summary
+    finally:
+        jobs.close()
+        jobs.join()
+    
+    return [summaries[f] for f in filenames]
+
+def print_summary(summaries, total_seconds):
+    header = "{:<40}{:>10}".format("file", "MB est.") + "".join("{:>12}".format(s) for s in STAGES) + "{:>12}  {}".format("total", "status")
+    print(header)
+    for summary in summaries:
+        name = os.path.basename(summary['file'])
+        if len(name) > 38:
+            name = "..." + name[-35:]
+        estimate = "-" if summary['estimated_bytes'] is None else "{:.0f}".format(summary['estimated_bytes'] / 2.**20)
+        print("{:<40}{:>10}".format(name, estimate) + "".join("{:>12.2f}".format(summary['seconds'][s]) for s in STAGES)
+              + "{:>12.2f}  {}".format(summary['total_seconds'], summary['status']))
+    n_ok = sum(s['status'] == 'ok' for s in summaries)
+    print("{} of {} datasets corrected in {:.2f} s.".format(n_ok, len(summaries), total_seconds))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Drift correction of many localization or image datasets.")
+    parser.add_argument('kind', choices=sorted(RUNS.keys()), help="type of data")
+    parser.add_argument('inputs', nargs='+', help="files, folders or glob patterns")
+    parser.add_argument('--output', default='drift_correction', help="folder for the results of all datasets")
+    parser.add_argument('--set', dest='settings', action='append', default=[], metavar='NAME=VALUE',
+                        help="module parameter, e.g. binsize=20. Repeat for more")
+    parser.add_argument('--workers', type=int, default=max(multiprocessing.cpu_count()-1, 1),
+                        help="processes of the shared worker pool, 1 to run without a pool")
+    parser.add_argument('--jobs', type=int, default=2, help="datasets corrected at the same time")
+    parser.add_argument('--memory-budget', type=float, default=None,
+                        help="MB for all datasets in progress, half of the physical memory by default")
+    parser.add_argument('--cache', choices=['disk', 'memory'], default='disk',
+                        help="keep ft images and shifted images in files in the output folder or in memory")
+    parser.add_argument('--table', default="", help="table of localization files, FitResults or Localizations by default")
+    parser.add_argument('--degree-of-spline', type=int, default=3, help="as Drift_Interpolate")
+    parser.add_argument('--smoothing-factor', type=float, default=-1, help="as Drift_Interpolate")
+    parser.add_argument('--drift-only', action='store_true', help="only measure and save drift")
+    args = parser.parse_args(argv)
+    
+    if args.memory_budget is None:
+        total_memory = get_total_memory()
+        args.memory_budget = total_memory / 2.**21 if not total_memory is None else 4000.
+    
+    filenames = find_datasets(args.inputs, args.kind)
+    if len(filenames) == 0:
+        print("No datasets found.")
+        return 1
+    settings = parse_settings(args.settings)
+    
+    t_start = time.time()
+    # started before PYME is imported so workers stay small
+    pool = multiprocessing.Pool(processes=args.workers) if args.workers > 1 else None
+    try:
+        from cc_drift_cor.plugins.recipes.processing import CacheCleanupModule
+        check_settings(args.kind, settings)
+        
+        print("Correcting {} datasets, {} at a time, {:.0f} MB budget, {} workers.".format(len(filenames), args.jobs, args.memory_budget, args.workers))
+        CacheCleanupModule.share_pool(pool, args.workers)
+        try:
+            summaries = run_batch(args.kind, filenames, args.output, args, settings)
+        finally:
+            CacheCleanupModule.share_pool(None)
+    finally:
+        if not pool is None:
+            pool.close()
+            pool.join()
+    total_seconds = time.time() - t_start
+    
+    print_summary(summaries, total_seconds)
+    with open(os.path.join(args.output, "summary.json"), 'w') as f:
+        json.dump(OrderedDict([('total_seconds', total_seconds), ('datasets', summaries)]), f, indent=1)
+    
+    return 0 if all(s['status'] == 'ok' for s in summaries) else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,445 @@
+# -*- coding: utf-8 -*-
+"""
+Speed / accuracy benchmarks on simulated data.
+
+Run with
+    python -m cc_drift_cor.benchmarks
+
+``locs`` and ``images`` run every stage of the localization and image pipelines on simulated data with a
+known drift and report the error against it. Results can be saved with ``--save`` and compared against a
+previous run with ``--compare``. No GUI components are used. Only ``locs`` and ``images`` import PYME.
+``solvers`` compares the RCC outlier removal with the IRLS solver on a synthetic pair system with outlier pairs.
+``pairs`` reports the number of pairs against the drift error of each pair sampling.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+from collections import OrderedDict
+
+import numpy as np
+
+from cc_drift_cor import engine
+
+
+def render_beads(shape, centers, sigma=2.0, offset=(0, 0, 0)):
+    """
+        Sum of gaussian spots, evaluated analytically at each pixel. 2D or 3D.
+        Gaussians are separable, so each axis is evaluated on its own and combined per spot.
+    """
+    centers = np.asarray(centers, dtype=np.float64)
+    profiles = [np.exp(-(np.arange(n)[:, None] - centers[None, :, d] - offset[d])**2 / (2 * sigma**2))
+                for d, n in enumerate(shape)]
+    if len(shape) == 2:
+        return profiles[0].dot(profiles[1].T)
+    return np.einsum('ib,jb,kb->ijk', *profiles)
+
+def drift_trajectory(t, n_frames, amplitude):
+    """
+        Smooth known drift at time points t, one column per entry of amplitude (x, y, z).
+    """
+    tt = np.asarray(t, dtype=np.float64) / n_frames
+    shapes = [np.sin(2 * np.pi * 1.3 * tt), tt**2, np.sin(2 * np.pi * 0.7 * tt)]
+    return np.stack([a * shape for a, shape in zip(amplitude, shapes)], axis=1)
+
+def drift_at(drift, t):
+    """
+        Drift per frame, linearly interpolated at (non integer) time points t.
+    """
+    frames = np.arange(drift.shape[0])
+    return np.stack([np.interp(t, frames, drift[:, d]) for d in range(drift.shape[1])], axis=1)
+
+def simulate_localizations(n_events=200000, n_frames=10000, dims=3, n_structures=400, extent=5000., z_extent=600.,
+                           precision=10., amplitude=(60., 40., 50.), seed=0):
+    """
+        Localizations of point-like structures blinking at random frames, with drift added.
+        dims 2 gives z = 0 and no z drift.
+        Returns dict of columns (x, y, z, t and x_true etc. without drift) and the drift (nm) per frame.
+    """
+    rng = np.random.RandomState(seed)
+    amplitude = np.asarray(amplitude, dtype=np.float64)
+    if dims == 2:
+        amplitude[2] = 0
+        z_extent = 0
+    
+    structures = np.stack([rng.uniform(0, extent, n_structures),
+                           rng.uniform(0, extent, n_structures),
+                           rng.uniform(0, z_extent, n_structures)], axis=1)
+    index = rng.randint(0, n_structures, n_events)
+    t = np.sort(rng.randint(0, n_frames, n_events))
+    drift = drift_trajectory(np.arange(n_frames), n_frames, amplitude)
+    
+    locs = OrderedDict()
+    for d, key in enumerate(['x', 'y', 'z']):
+        position = structures[index, d]
+        if d < dims:
+            # z precision is usually a few times worse
+            position = position + rng.normal(0, precision * (2.5 if d == 2 else 1), n_events)
+        locs[key + '_true'] = position
+        locs[key] = position + drift[t, d]
+    locs['t'] = t.astype(np.float64)
+    
+    return locs, drift
+
+def simulate_image_stack(size=256, n_frames=200, dims=2, n_beads=100, pixel_size=100., z_pixel_size=200.,
+                         amplitude=(300., 200., 200.), photons=500., background=100., seed=0):
+    """
+        Gaussian beads drifting over n_frames frames of XYT (dims 2) or XYZT (dims 3, size // 8 z slices).
+        Returns noisy uint16 stack, the same stack without noise, the drift (nm) per frame, metadata and
+        render(drift), which gives the noise free frame at any drift. Needs PYME for the metadata.
+    """
+    from PYME.IO import MetaDataHandler
+    
+    rng = np.random.RandomState(seed)
+    shape = (size, size) if dims == 2 else (size, size, max(size // 8, 8))
+    voxelsize = np.asarray([pixel_size, pixel_size, z_pixel_size])
+    drift = drift_trajectory(np.arange(n_frames), n_frames, amplitude[:dims])
+    
+    margin = 8 + np.abs(drift).max(axis=0) / voxelsize[:dims]
+    centers = np.stack([rng.uniform(m, n - m, n_beads) for m, n in zip(margin, shape)], axis=1)
+    
+    def render(d):
+        return background + photons * render_beads(shape, centers, offset=np.asarray(d) / voxelsize[:dims])
+    
+    clean = np.stack([render(d) for d in drift], axis=-1)
+    raw = rng.poisson(clean).astype(np.uint16)
+    
+    mdh = MetaDataHandler.NestedClassMDHandler()
+    for key, v in zip(['x', 'y', 'z'], voxelsize):
+        mdh['voxelsize.{}'.format(key)] = v / 1E3
+    mdh['voxelsize.units'] = 'um'
+    
+    return raw, clean, drift, mdh, render
+
+def rms_without_offset(residuals):
+    """
+        RMS over rows and columns after removing the mean of each column.
+        Drift is only defined up to an offset.
+    """
+    residuals = residuals - residuals.mean(axis=0)
+    return np.sqrt(np.mean(residuals**2))
+
+def interpolate_measured_drift(t_shift, drift):
+    """
+        Spline interpolators of measured drift, as Drift_Interpolate without smoothing.
+    """
+    return engine.interpolate_drift(t_shift, drift, min(3, len(t_shift) - 1), 0)
+
+def add_spans(results, module, stages):
+    """
+        Adds the seconds spent in stages (see instrumentation) during the module's last run to results.
+        stages is a dict of result name: list of stage names.
+    """
+    spans = module.get_instrumentation().spans
+    for name, names in stages.items():
+        results[name] = (sum(spans[s][0] for s in names if s in spans), None)
+
+def benchmark_shift_methods(shape=(256, 256), n_frames=50, n_beads=100, max_shift=4.0, repeats=3, seed=0):
+    """
+        Shifts n_frames copies of the same image by random sub-pixel amounts with every ShiftImage method.
+        Compares against the image rendered at the shifted positions (RMS error over the inner region,
+        away from pixels shifted in from outside the frame).
+        Returns dict of method: (seconds per frame, RMS error).
+    """
+    rng = np.random.RandomState(seed)
+    margin = int(np.ceil(max_shift)) + 8
+    centers = np.stack([rng.uniform(margin, shape[0] - margin, n_beads),
+                        rng.uniform(margin, shape[1] - margin, n_beads)], axis=1)
+    shifts = rng.uniform(-max_shift, max_shift, (n_frames, 2))
+    
+    image = render_beads(shape, centers)
+    frames = np.repeat(image[:, :, None], n_frames, axis=2)
+    truth = np.stack([render_beads(shape, centers, offset=s) for s in shifts], axis=2)
+    inner = (slice(margin, -margin), slice(margin, -margin))
+    
+    results = OrderedDict()
+    for method in ['Fourier', 'Linear', 'Cubic', 'Lanczos']:
+        timings = list()
+        for i in range(repeats):
+            t_start = time.time()
+            shifted = engine.shift_frames(frames, shifts, method, np.asarray(shape))
+            timings.append(time.time() - t_start)
+        error = np.sqrt(np.mean((shifted - truth)[inner]**2)) / image.max()
+        results[method] = (min(timings) / n_frames, error)
+    
+    return results
+
+def benchmark_median_methods(shape=(2048, 2048), n_frames=8, size=3, repeats=1, seed=0):
+    """
+        Median filters a synthetic uint16 camera stack with 2D and 3D kernels and every PreprocessingFilter method.
+        Returns dict of "kernel method": (frames per second, max abs difference to scipy.ndimage).
+    """
+    rng = np.random.RandomState(seed)
+    # offset + poisson noise, roughly what a sCMOS camera gives
+    frames = (100 + rng.poisson(20, tuple(shape) + (n_frames,))).astype(np.uint16)
+    
+    results = OrderedDict()
+    for dims, kernel_shape in [('2D', (size, size, 1)), ('3D', (size, size, size))]:
+        reference = None
+        for method in ['ndimage', 'Selection network']:
+            timings = list()
+            for i in range(repeats):
+                t_start = time.time()
+                filtered = engine.median_filter(frames, kernel_shape, method)
+                timings.append(time.time() - t_start)
+            if reference is None:
+                reference = filtered
+            error = np.abs(filtered.astype(np.float64) - reference).max()
+            results["{} {}".format(dims, method)] = (n_frames / min(timings), error)
+    
+    return results
+
+def benchmark_localizations(n_events=200000, n_frames=10000, dims=3, seed=0):
+    """
+        Localization pipeline (Locs_RCC, then ApplyDrift) on simulated localizations with a known drift.
+        20 time windows, 30 nm bins.
+        Returns dict of stage: (seconds, RMS error in nm). Error is None for intermediate stages.
+    """
+    from PYME.IO import tabular
+    from cc_drift_cor.plugins.recipes import localisations
+    
+    locs, drift = simulate_localizations(n_events, n_frames, dims, seed=seed)
+    window = max(n_frames // 20, 1)
+    
+    results = OrderedDict()
+    rcc = localisations.RCCDriftCorrection(step=window, window=window, binsize=30., flatten_z=(dims == 2),
+                                           cache_fft='', debug_cor_file='', multiprocessing=False)
+    rcc.trait_setq(**{"_start_time": time.time()})
+    drift_res = rcc.calc_corr_drift_from_locs(locs['x'], locs['y'], locs['z'], locs['t'])
+    t_start = time.time()
+    t_shift, shifts = rcc.rcc(rcc.shift_max, *drift_res)
+    t_rcc = time.time() - t_start
+    shifts = np.cumsum(shifts, 0)
+    
+    add_spans(results, rcc, OrderedDict([('calc_fft_from_locs', ['FFT generation']),
+                                         ('calc_corr_drift_from_ft_images', ['pair correlation'])]))
+    n_pairs = rcc.get_instrumentation().counters['pairs']
+    # includes reading the ft images and storing the results, not only calc_shift_direct
+    results['pair correlation (per pair)'] = (results['calc_corr_drift_from_ft_images'][0] / n_pairs, None)
+    # measured drift is the correction, i.e. -drift
+    results['rcc'] = (t_rcc, rms_without_offset(shifts[:, :dims] + drift_at(drift, t_shift)[:, :dims]))
+    
+    namespace = {'Localizations': tabular.DictSource(locs),
+                 'drift_interpolator': interpolate_measured_drift(t_shift, shifts[:, :dims])}
+    apply_drift = localisations.ApplyDrift()
+    t_start = time.time()
+    apply_drift.execute(namespace)
+    corrected = namespace[apply_drift.output_name]
+    residuals = np.stack([corrected[k] - locs[k + '_true'] for k in ['x', 'y', 'z'][:dims]], axis=1)
+    results['ApplyDrift'] = (time.time() - t_start, rms_without_offset(residuals))
+    
+    return results
+
+def benchmark_images(size=256, n_frames=200, dims=2, seed=0):
+    """
+        Image pipeline on simulated beads with a known drift. XYT (dims 2) runs Image_Pre_Clip&Filter,
+        Image_Pre_Downsample (2 x 2 x 10), Image_RCC and Image_Post_Shift. XYZT (dims 3) runs Image_RCC
+        on 10 frame averages and Image_Post_Shift_3D.
+        The shift is applied to the noise free stack and compared against the noise free frame at the first
+        measured time point (relative RMS error over the inner region).
+        Returns dict of stage: (seconds, error). Error is the RMS drift error in nm for rcc.
+    """
+    from PYME.IO import MetaDataHandler
+    from PYME.IO.image import ImageStack
+    from cc_drift_cor.plugins.recipes import processing
+    
+    raw, clean, drift, mdh, render = simulate_image_stack(size, n_frames, dims, seed=seed)
+    
+    results = OrderedDict()
+    cache_dir = tempfile.mkdtemp()
+    try:
+        if dims == 2:
+            namespace = {'input': ImageStack(raw, mdh=mdh)}
+            
+            preprocessing = processing.PreprocessingFilter(threshold_lower=0, cache_clip='', multiprocessing=False)
+            t_start = time.time()
+            preprocessing._execute(namespace)
+            results['PreprocessingFilter'] = (time.time() - t_start, None)
+            
+            binning = processing.Binning(binsize=[2, 2, 10], inputName=preprocessing.output_name,
+                                         cache_bin=os.path.join(cache_dir, 'bin.bin'), multiprocessing=False)
+            t_start = time.time()
+            binning._execute(namespace)
+            results['Binning'] = (time.time() - t_start, None)
+            rcc_input = namespace[binning.outputName]
+        else:
+            n_bins = n_frames // 10
+            binned = raw[..., :n_bins * 10].reshape(raw.shape[:-1] + (n_bins, 10)).mean(-1)
+            rcc_input = ImageStack(binned, mdh=MetaDataHandler.NestedClassMDHandler(mdh))
+            rcc_input.mdh['recipe.binning'] = [1, 1, 10]
+        
+        namespace = {'input': rcc_input}
+        rcc = processing.RCCDriftCorrection(cache_fft='', debug_cor_file='', multiprocessing=False)
+        t_start = time.time()
+        rcc._execute(namespace)
+        t_rcc = time.time() - t_start
+        t_shift, shifts = namespace[rcc.output_drift]
+        
+        add_spans(results, rcc, OrderedDict([('calc_fft_from_images', ['FFT generation']),
+                                             ('calc_corr_drift_from_ft_images', ['pair correlation'])]))
+        results['rcc'] = (t_rcc, rms_without_offset(shifts[:, :dims] + drift_at(drift, t_shift)))
+        
+        shift = (processing.ShiftImage if dims == 2 else processing.ShiftVolume)(cache_image='', multiprocessing=False)
+        namespace = {shift.input_image: ImageStack(clean, mdh=mdh),
+                     shift.input_drift_interpolator: interpolate_measured_drift(t_shift, shifts[:, :dims])}
+        t_start = time.time()
+        shift._execute(namespace)
+        t_shift_images = time.time() - t_start
+        
+        # frames are shifted back to where they were at the first measured time point
+        shifted = np.asarray(namespace[shift.outputName].data[(slice(None),) * (dims + 1)])
+        reference = render(drift_at(drift, t_shift[:1])[0])
+        inner = tuple(slice(n // 4, n - n // 4) for n in reference.shape)
+        error = np.sqrt(np.mean((shifted[inner] - reference[inner][..., None])**2)) / np.ptp(reference)
+        results[shift.__class__.__name__] = (t_shift_images, error)
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    
+    return results
+
+def benchmark_solvers(n_steps=100, corr_window=10, outlier_fraction=0.1, noise=0.5, shift_max=2., seed=0):
+    """
+        Drift solvers on a synthetic pair system: a random walk drift (pixels), shifts of all pairs within
+        corr_window with gaussian noise, and outlier_fraction of the pairs replaced by random shifts of up to 20 pixels.
+        Plain least squares, RCC (greedy removal of pairs over shift_max) and IRLS (Huber reweighting).
+        Returns dict of solver: (seconds, RMS drift error in pixels).
+    """
+    rng = np.random.RandomState(seed)
+    steps = rng.normal(0, 1, (n_steps - 1, 3))
+    pairs, coefs = engine.plan_pairs(n_steps, 'RCC', corr_window)
+    shifts = coefs.dot(steps) + rng.normal(0, noise, (len(pairs), 3))
+    outliers = rng.rand(len(pairs)) < outlier_fraction
+    shifts[outliers] = rng.uniform(-20, 20, (outliers.sum(), 3))
+    truth = np.cumsum(steps, 0)
+    
+    def error(drifts):
+        return rms_without_offset(np.cumsum(drifts, 0) - truth)
+    
+    results = OrderedDict()
+    t_start = time.time()
+    drifts = engine.solve_drift(coefs, shifts)
+    results['least squares'] = (time.time() - t_start, error(drifts))
+    
+    t_start = time.time()
+    drifts = engine.solve_drift(coefs, shifts)
+    kept, counter, complete = engine.reject_outliers(coefs, shifts, drifts, shift_max)
+    drifts = engine.solve_drift(coefs, shifts, kept)
+    results['RCC'] = (time.time() - t_start, error(drifts))
+    
+    t_start = time.time()
+    drifts, robust_weights, iterations = engine.solve_drift_robust(coefs, shifts, shift_max)
+    results['IRLS'] = (time.time() - t_start, error(drifts))
+    results['IRLS iterations'] = (iterations, None)
+    
+    return results
+
+def benchmark_pair_sampling(n_steps=400, noise=0.5, seed=0):
+    """
+        Accuracy against cost (number of pairs to correlate) of the pair samplings (see engine.select_pairs),
+        on a synthetic pair system with a random walk drift (pixels) and gaussian noise on each pair shift.
+        Returns dict of sampling and corr_window: (pairs, RMS drift error in pixels).
+    """
+    rng = np.random.RandomState(seed)
+    steps = rng.normal(0, 1, (n_steps - 1, 3))
+    truth = np.cumsum(steps, 0)
+    
+    results = OrderedDict()
+    for sampling, corr_windows in [('Window', [1, 2, 5, 20, 0]), ('Geometric', [1, 2, 5]), ('Random', [1, 2, 5])]:
+        for corr_window in corr_windows:
+            pairs, coefs = engine.plan_pairs(n_steps, 'RCC', corr_window, sampling)
+            shifts = coefs.dot(steps) + rng.normal(0, noise, (len(pairs), 3))
+            drifts = engine.solve_drift(coefs, shifts)
+            results['{} {}'.format(sampling, corr_window)] = (len(pairs), rms_without_offset(np.cumsum(drifts, 0) - truth))
+    
+    return results
+
+def print_results(title, results, units):
+    print(title)
+    print("{:<32}{:>16}{:>16}".format('', *units))
+    for key, values in results.items():
+        print("{:<32}".format(key) + "".join("{:>16}".format('-') if v is None else "{:>16.3e}".format(v) for v in values))
+    print('')
+
+def compare_results(all_results, previous):
+    """
+        Prints the first value of each result (seconds or rate) against a run saved with save_results.
+    """
+    print("Compared to run of {}".format(time.strftime('%Y-%m-%d %H:%M', time.localtime(previous['time']))))
+    print("{:<48}{:>14}{:>14}{:>10}".format('', 'previous', 'now', 'ratio'))
+    for name, results in all_results.items():
+        previous_results = previous['results'].get(name, {})
+        for key, values in results.items():
+            if not key in previous_results:
+                continue
+            old = previous_results[key][0]
+            print("{:<48}{:>14.3e}{:>14.3e}{:>10.2f}".format("{} {}".format(name, key), old, values[0], values[0] / old if old else np.nan))
+    print('')
+
+def save_results(path, all_results, options):
+    """
+        Saves results as json, with the options and versions needed to compare runs later.
+    """
+    report = OrderedDict([('time', time.time()),
+                          ('options', options),
+                          ('python', sys.version.split()[0]),
+                          ('numpy', np.__version__),
+                          ('cpu_count', multiprocessing.cpu_count()),
+                          ('results', OrderedDict((name, OrderedDict((k, [None if v is None else float(v) for v in values])
+                                                                     for k, values in results.items()))
+                                                  for name, results in all_results.items())),
+                          ])
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=1)
+
+
+# name: (function, title, units, command line options used)
+BENCHMARKS = {'shift': (benchmark_shift_methods, 'ShiftImage methods', ('s/frame', 'rel. RMS error'), ()),
+              'median': (benchmark_median_methods, 'PreprocessingFilter median filter, 2048x2048 uint16', ('frames/s', 'max abs diff'), ()),
+              'locs': (benchmark_localizations, 'Localization pipeline', ('s', 'RMS error (nm)'), ('n_events', 'n_frames', 'dims')),
+              'images': (benchmark_images, 'Image pipeline', ('s', 'error'), ('size', 'n_frames', 'dims')),
+              'pairs': (benchmark_pair_sampling, 'Pair sampling, synthetic pairs', ('pairs', 'RMS error (px)'), ('n_steps',)),
+              'solvers': (benchmark_solvers, 'Drift solvers, synthetic pairs with outliers', ('s', 'RMS error (px)'), ('n_steps', 'corr_window', 'outlier_fraction')),
+              }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Speed / accuracy benchmarks on simulated data.')
+    parser.add_argument('benchmarks', nargs='*',
+                        help='benchmarks to run, all by default. One or more of: {}'.format(', '.join(sorted(BENCHMARKS))))
+    parser.add_argument('--events', type=int, help='number of localizations (locs)')
+    parser.add_argument('--frames', type=int, help='number of frames (locs, images)')
+    parser.add_argument('--size', type=int, help='image width and height in pixels (images)')
+    parser.add_argument('--dims', type=int, choices=[2, 3], help='2D or 3D data (locs, images)')
+    parser.add_argument('--steps', type=int, help='number of time points (pairs, solvers)')
+    parser.add_argument('--corr-window', type=int, help='correlation window, 0 for all pairs (solvers)')
+    parser.add_argument('--outliers', type=float, help='fraction of outlier pairs (solvers)')
+    parser.add_argument('--save', help='save results to this json file')
+    parser.add_argument('--compare', help='compare against results saved with --save')
+    args = parser.parse_args(argv)
+    for name in args.benchmarks:
+        if not name in BENCHMARKS:
+            parser.error('unknown benchmark {}'.format(name))
+    
+    options = dict((k, v) for k, v in [('n_events', args.events), ('n_frames', args.frames),
+                                       ('size', args.size), ('dims', args.dims), ('n_steps', args.steps),
+                                       ('corr_window', args.corr_window), ('outlier_fraction', args.outliers)] if not v is None)
+    
+    all_results = OrderedDict()
+    for name in args.benchmarks or sorted(BENCHMARKS):
+        function, title, units, option_names = BENCHMARKS[name]
+        all_results[name] = function(**dict((k, v) for k, v in options.items() if k in option_names))
+        print_results(title, all_results[name], units)
+    
+    if not args.compare is None:
+        with open(args.compare) as f:
+            compare_results(all_results, json.load(f))
+    
+    if not args.save is None:
+        save_results(args.save, all_results, options)
+
+if __name__ == '__main__':
+    main()
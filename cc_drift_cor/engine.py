@@ -0,0 +1,1579 @@
+# -*- coding: utf-8 -*-
+"""
+Numerical core of the drift correction: preprocessing, binning, FFT generation, pair correlation,
+solving for drift and applying drift.
+
+Plain functions on numpy arrays with no PYME imports. The recipe modules are thin adapters around
+these, and worker processes of multiprocessing pools only need to import this module.
+scipy submodules are imported where they are used to keep importing this module fast.
+"""
+
+import numpy as np
+
+import time
+from functools import partial
+from collections import deque, OrderedDict
+
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import logging
+logger=logging.getLogger(__name__)
+
+def calc_median_kernel_shape(median_filter_size, median_filter_dims='3D'):
+    """
+        XYT median kernel. (1, 1, 1) if disabled.
+    """
+    if median_filter_size <= 0:
+        return (1, 1, 1)
+    elif median_filter_dims == '2D':
+        return (median_filter_size, median_filter_size, 1)
+    else:
+        return (median_filter_size,) * 3
+
+def calc_tukey_mask(shape, tukey_size, dtype=np.float32):
+    """
+        2D Tukey mask, shaped (x, y, 1) to broadcast over frames.
+    """
+    from scipy import signal
+    tukey_mask_x = signal.tukey(shape[0], tukey_size)
+    tukey_mask_y = signal.tukey(shape[1], tukey_size)
+    return np.multiply(*np.meshgrid(tukey_mask_x, tukey_mask_y, indexing='ij'))[:,:,None].astype(dtype)
+
+def plan_tiles(shape, halo, max_tile_voxels):
+    """
+        Splits shape into tiles of at most max_tile_voxels, including a halo on each side.
+        Halves the longest tile dim until the tile fits. halo is a scalar or one value per dim.
+        Returns list of (outer, core) tuples of slices. outer is core plus halo, clipped to shape.
+    """
+    shape = np.asarray(shape, dtype=np.int64)
+    halo = np.broadcast_to(halo, shape.shape).astype(np.int64)
+    tile_shape = shape.copy()
+    while np.prod(tile_shape + 2 * halo) > max_tile_voxels and np.any(tile_shape > 1):
+        i = np.argmax(tile_shape)
+        tile_shape[i] = -(-tile_shape[i] // 2)
+    
+    starts = [np.arange(0, n, t) for n, t in zip(shape, tile_shape)]
+    tiles = list()
+    for start in zip(*[g.ravel() for g in np.meshgrid(*starts, indexing='ij')]):
+        core = tuple(slice(int(a), int(min(a + t, n))) for a, t, n in zip(start, tile_shape, shape))
+        outer = tuple(slice(max(c.start - h, 0), min(c.stop + h, n)) for c, h, n in zip(core, halo, shape))
+        tiles.append((outer, core))
+    return tiles
+
+def preprocess_tile_helper(args):
+    """
+        Wrapper for working with multiprocessing functions.
+    """
+    index, data, inner, filter_args = args
+    return (index,) + preprocess_tile(data, inner, *filter_args)
+
+def preprocess_tile(data, inner, median_kernel_shape, median_method, threshold_lower, clip_to_lower, threshold_upper, clip_to_upper, tukey_mask=None, dtype=np.float32):
+    """
+        Median filter, clipping and Tukey filter for one tile. Returns data[inner] filtered and timings.
+        Tile borders are only exact if data includes a halo of median_kernel_shape // 2 around inner,
+        'nearest' mode only matters at the true image borders.
+    """
+    t_start = time.time()
+    if np.prod(median_kernel_shape) > 1:
+        data = median_filter(data, median_kernel_shape, median_method)
+    if not inner is None:
+        data = data[inner]
+    t_median = time.time()
+    
+    data = clip_and_taper(data, threshold_lower, clip_to_lower, threshold_upper, clip_to_upper, tukey_mask, dtype)
+    
+    return data, (t_median - t_start, time.time() - t_median)
+
+def median_filter(data, kernel_shape, method='Auto'):
+    """
+        Median filter with 'nearest' borders. See PreprocessingFilter.median_method.
+    """
+    from scipy import ndimage
+    if method == 'ndimage' or (method == 'Auto' and np.prod(kernel_shape) > 125):
+        return ndimage.median_filter(data, kernel_shape, mode='nearest')
+    else:
+        return median_filter_selection(data, kernel_shape)
+
+def median_filter_selection(data, kernel_shape, block_size=2**18):
+    """
+        Exact median filter from min/max operations on shifted copies of the data, 'nearest' borders.
+        Fast for small kernels on integer data, cost grows with the square of the number of pixels in the kernel.
+        Works on blocks along the first dim so the copies stay in cache.
+    """
+    kernel_shape = tuple(kernel_shape)
+    # same footprint position as ndimage.median_filter
+    padded = np.pad(data, [(k // 2, k - 1 - k // 2) for k in kernel_shape], mode='edge')
+    out = np.empty(data.shape, dtype=data.dtype)
+    
+    rows_per_block = max(1, block_size // max(1, np.prod(data.shape[1:])))
+    for i in range(0, data.shape[0], rows_per_block):
+        i_end = min(i + rows_per_block, data.shape[0])
+        values = [padded[(slice(i + offset[0], i_end + offset[0]),) + tuple(slice(o, o + n) for o, n in zip(offset[1:], data.shape[1:]))]
+                  for offset in np.ndindex(*kernel_shape)]
+        out[i:i_end] = select_median(values)
+    
+    return out
+
+def select_median(values):
+    """
+        Element-wise median of a list of arrays with forgetful selection.
+        Keeps n // 2 + 2 values, drops their min and max, adds the next value and repeats until one is left.
+        Upper median for an even number of arrays, same as ndimage.median_filter.
+    """
+    from scipy import ndimage
+    values = list(values)
+    if len(values) % 2 == 0:
+        # upper median is the median after adding a value larger than everything
+        if np.issubdtype(values[0].dtype, np.integer):
+            largest = np.iinfo(values[0].dtype).max
+        else:
+            largest = np.inf
+        values.append(np.full_like(values[0], largest))
+    
+    n_values = len(values)
+    if n_values == 1:
+        return np.array(values[0])
+    
+    n_work = (n_values + 3) // 2
+    work = [np.array(v) for v in values[:n_work]]
+    remaining = list(values[n_work:])
+    temp = np.empty_like(work[0])
+    
+    while True:
+        # one bubble pass each way moves the max to the end and the min to the start
+        for i in range(len(work) - 1):
+            np.minimum(work[i], work[i+1], out=temp)
+            np.maximum(work[i], work[i+1], out=work[i+1])
+            work[i], temp = temp, work[i]
+        for i in range(len(work) - 2, 0, -1):
+            np.minimum(work[i-1], work[i], out=temp)
+            np.maximum(work[i-1], work[i], out=work[i])
+            work[i-1], temp = temp, work[i-1]
+        work = work[1:-1]
+        
+        if len(remaining) == 0:
+            return work[0]
+        work.append(np.array(remaining.pop(0)))
+
+def clip_and_taper(data, threshold_lower, clip_to_lower, threshold_upper, clip_to_upper, tukey_mask=None, dtype=np.float32, block_size=2**18):
+    """
+        Replaces out of range values, subtracts clip_to_lower and applies the Tukey mask, block by block.
+        Equivalent to (in this order)
+            data[data >= threshold_upper] = clip_to_upper
+            data[data <= threshold_lower] = clip_to_lower
+            data -= clip_to_lower
+            data *= tukey_mask
+        Works on cache sized blocks along the first (contiguous) dim and writes directly to the output dtype.
+    """
+    dtype = np.dtype(dtype)
+    # values replaced by clip_to_upper are checked against the lower threshold afterwards
+    upper_value = clip_to_upper if clip_to_upper > threshold_lower else clip_to_lower
+    if tukey_mask is None:
+        tukey_mask = np.ones((1,) * data.ndim, dtype=dtype)
+    
+    # all steps on one block before moving on to the next, only one reused boolean temporary
+    out = np.empty(data.shape, dtype=dtype)
+    rows_per_block = max(1, block_size // max(1, np.prod(data.shape[1:])))
+    mask = np.empty((min(rows_per_block, data.shape[0]),) + data.shape[1:], dtype=bool)
+    for i in range(0, data.shape[0], rows_per_block):
+        block = data[i:i+rows_per_block]
+        out_block = out[i:i+rows_per_block]
+        mask_block = mask[:block.shape[0]]
+        
+        np.subtract(block, dtype.type(clip_to_lower), out=out_block, casting='unsafe')
+        np.less_equal(block, threshold_lower, out=mask_block)
+        np.copyto(out_block, 0, where=mask_block)
+        np.greater_equal(block, threshold_upper, out=mask_block)
+        np.copyto(out_block, upper_value - clip_to_lower, where=mask_block, casting='unsafe')
+        np.multiply(out_block, tukey_mask[i:i+rows_per_block] if tukey_mask.shape[0] > 1 else tukey_mask, out=out_block)
+    
+    return out
+
+
+def calc_bin_slices(shape, x_start, x_end, y_start, y_end, binsize, keep_partial_bins=False):
+    """
+        x and y slices of the source data to bin and the binned shape.
+    """
+    # unconventional, end stop in inclusive
+    x_slice = np.arange(shape[0]+1)[slice(x_start, x_end, 1)]
+    y_slice = np.arange(shape[1]+1)[slice(y_start, y_end, 1)]
+    if not keep_partial_bins:
+        x_slice = x_slice[:x_slice.shape[0] // binsize[0] * binsize[0]]
+        y_slice = y_slice[:y_slice.shape[0] // binsize[1] * binsize[1]]
+    bincounts = np.asarray([-(-len(x_slice)//binsize[0]), -(-len(y_slice)//binsize[1]), -(-shape[2]//binsize[2])], dtype=np.int64)
+    
+    x_slice_ind = slice(x_slice[0], x_slice[-1]+1)
+    y_slice_ind = slice(y_slice[0], y_slice[-1]+1)
+    
+    return x_slice_ind, y_slice_ind, bincounts
+
+def calc_block_reduce_dtype(dtype, binsize, mode='mean'):
+    """
+        Output dtype of block_reduce. Also the accumulator for sum.
+    """
+    dtype = np.dtype(dtype)
+    if mode == 'max':
+        return dtype
+    elif mode == 'mean':
+        return dtype if dtype.kind == 'f' else np.dtype(np.float32)
+    elif dtype.kind == 'f':
+        return np.dtype(np.float64)
+    elif dtype.kind == 'u':
+        # smallest of uint32 / uint64 that can't overflow
+        if (np.iinfo(np.uint32).max // np.prod(binsize)) >= np.iinfo(dtype).max:
+            return np.dtype(np.uint32)
+        return np.dtype(np.uint64)
+    else:
+        if (np.iinfo(np.int32).max // np.prod(binsize)) >= np.iinfo(dtype).max:
+            return np.dtype(np.int32)
+        return np.dtype(np.int64)
+
+def block_reduce_helper(args):
+    """
+        Wrapper for working with multiprocessing functions.
+    """
+    index, data, binsize, mode = args
+    return (index, block_reduce(data, binsize, mode))
+
+def block_reduce(data, binsize, mode='mean'):
+    """
+        Combines each block of binsize pixels with mean, sum or max. Last bin along each dim can be partially filled.
+        Reduces one dim at a time (largest stride first) by adding strided slices into a wider accumulator,
+        much faster than reshape and mean when the last dim is binned.
+    """
+    binsize = np.asarray(binsize, dtype=np.int64)
+    out_dtype = calc_block_reduce_dtype(data.dtype, binsize, mode)
+    if mode == 'max':
+        ufunc = np.maximum
+        acc_dtype = out_dtype
+    else:
+        ufunc = np.add
+        acc_dtype = calc_block_reduce_dtype(data.dtype, binsize, 'sum')
+    
+    reduced = data
+    for axis, b in enumerate(binsize):
+        if b > 1:
+            reduced = _block_reduce_axis(reduced, b, axis, ufunc, acc_dtype)
+    
+    if mode == 'mean':
+        counts = 1
+        for axis, (length, b) in enumerate(zip(data.shape, binsize)):
+            counts_axis = np.minimum(b, length - np.arange(0, length, b))
+            shape = [1] * data.ndim
+            shape[axis] = counts_axis.shape[0]
+            counts = counts * counts_axis.reshape(shape)
+        reduced = np.divide(reduced, counts, dtype=out_dtype)
+    
+    return reduced.astype(out_dtype, copy=False)
+
+def _block_reduce_axis(data, binsize, axis, ufunc, acc_dtype):
+    """
+        Reduces blocks of binsize along one axis with ufunc (np.add or np.maximum) in acc_dtype.
+    """
+    length = data.shape[axis]
+    n_full = length // binsize
+    
+    def take(start, stop, step=1):
+        slices = [slice(None)] * data.ndim
+        slices[axis] = slice(start, stop, step)
+        return data[tuple(slices)]
+    
+    reduced = np.array(take(0, n_full * binsize, binsize), dtype=acc_dtype)
+    for i in range(1, binsize):
+        ufunc(reduced, take(i, n_full * binsize, binsize), out=reduced, casting='unsafe')
+    
+    if length > n_full * binsize:
+        partial = ufunc.reduce(take(n_full * binsize, length), axis=axis, keepdims=True, dtype=acc_dtype)
+        reduced = np.concatenate([reduced, partial], axis=axis)
+    
+    return reduced
+
+
+def calc_shift_helper(args):
+    """
+        Wrappers needed for imap_unordered functions, etc.
+    """
+    return (args[0], calc_shift(*args[1:]))
+
+def calc_shift(index_1, index_2, origin=0, cache_fft=None, debug_cross_cor=None, return_quality=False):
+    """
+        Are the actual ft images passed? If not, fetch them from file cache.
+    """
+    if not cache_fft is None and cache_fft[0] != "":
+        path, dtype, shape = cache_fft
+        ft_images = np.memmap(path, mode="r", dtype=dtype, shape=shape)
+        ft_1 = ft_images[index_1]
+        ft_2 = ft_images[index_2]
+        del ft_images
+    else:
+        ft_1 = index_1
+        ft_2 = index_2
+        
+    return calc_shift_direct(ft_1, ft_2, origin, debug_cross_cor, return_quality)
+
+# per pair quality returned by calc_shift_direct
+QUALITY_METRICS = ['peak_to_background', 'peak_width', 'fit_residual']
+
+def calc_shift_direct(ft_1, ft_2, origin=0, debug_cross_cor=None, return_quality=False):
+    """
+        Does the actual fft cross correlation.
+        Clean up - including cropping, thresholding, mask dilation.
+        Performs n dimension gaussian fit and returns center.
+        If return_quality, also returns the QUALITY_METRICS of the peak: its height over the mean of the
+        searched area, its width (pixels, from second moments) and the RMS residual of a gaussian of that
+        width against the normalized peak.
+    """
+    from scipy import ndimage, optimize
+    ft_1 = ndimage.fourier_gaussian(ft_1, 0.5)
+    ft_2 = ndimage.fourier_gaussian(ft_2, 0.5)
+    # module level for multiprocessing
+    tmp = ft_1 * np.conj(ft_2)    
+    del ft_1, ft_2
+    cross_corr = np.abs(np.fft.ifftshift(np.fft.irfftn(tmp)))
+    flat_dims = np.where(np.asarray(cross_corr.shape) == 1)[0]
+    if len(flat_dims) > 0:
+        cross_corr = cross_corr.squeeze()
+    
+    if cross_corr.sum() == 0:
+        if return_quality:
+            return origin * np.nan, np.full(len(QUALITY_METRICS), np.nan)
+        return origin * np.nan
+    
+#    threshold = np.ptp(cross_corr) * 0.5 + np.min(cross_corr)
+    
+    # cheat and striaght up crop out 3/4 of the image if it's large
+    # i.e. drift not allow to span 1/4 the image width
+    cropping = [slice(dim*6//16, -dim*6//16) if dim >= 16 else slice(None, None) for dim in cross_corr.shape]
+    cross_corr_mask = np.zeros(cross_corr.shape)
+    cross_corr_mask[tuple(cropping)] = True
+    
+#    threshold = np.percentile(cross_corr[cropping], 95)
+    
+    threshold = np.ptp(cross_corr[cross_corr_mask.astype(bool)]) * 0.75 + np.min(cross_corr[cross_corr_mask.astype(bool)])
+    
+    cross_corr_mask *= cross_corr > threshold
+    
+    # difficult to adjust for complete despeckling. slow?
+#    cross_corr_mask = ndimage.binary_erosion(cross_corr_mask, structure=np.ones((1,)*cross_corr_mask.ndim), iterations=1, border_value=1, )
+#    cross_corr_mask = ndimage.binary_dilation(cross_corr_mask, structure=np.ones((3,)*cross_corr_mask.ndim), iterations=1, border_value=0, )
+    
+    labeled_image, labeled_counts = ndimage.label(cross_corr_mask)
+    if labeled_counts > 1: 
+        max_index = np.argmax(ndimage.mean(cross_corr_mask, labeled_image, range(1, labeled_counts+1))) + 1
+        cross_corr_mask = labeled_image == max_index
+    
+    if return_quality:
+        peak_to_background = cross_corr[cross_corr_mask > 0].max() / cross_corr[tuple(cropping)].mean()
+    
+    cross_corr_mask = ndimage.binary_dilation(cross_corr_mask, structure=np.ones((5,)*cross_corr_mask.ndim), iterations=1, border_value=0, )
+    
+    cross_corr_thresholded = cross_corr * cross_corr_mask
+#    
+    if not debug_cross_cor is None:
+        store_cross_cor(cross_corr_thresholded, flat_dims, *debug_cross_cor)
+    
+    dims = range(len(cross_corr.shape))
+    
+    # crop out masked area
+    bounds = np.zeros((len(dims), 2), dtype=np.int64)
+    for d in dims:
+        dims_tmp = list(dims)
+        dims_tmp.remove(d)
+        mask_1d = np.any(cross_corr_mask, axis=tuple(dims_tmp))
+        bounds[d] = np.where(mask_1d)[0][[0, -1]] + [0, 1]
+        cross_corr_thresholded = cross_corr_thresholded.take(np.arange(*bounds[d]), axis=d)    
+
+#    offset = np.zeros(len(dims))
+#    for d, length in enumerate(cross_corr_thresholded.shape):
+#        dims_tmp = list(dims)
+#        dims_tmp.remove(d)
+#        offset[d] = np.sum(np.arange(length) * cross_corr_thresholded.sum(axis=tuple(dims_tmp)))
+#    offset /= cross_corr_thresholded.sum()
+#    offset += bounds[:, 0]
+    
+    cross_corr_thresholded[cross_corr_thresholded==0] = np.nan
+#    cross_corr_thresholded -= np.nanmin(cross_corr_thresholded)
+    cross_corr_thresholded /= np.nanmax(cross_corr_thresholded)
+
+#    ### Gaussian fit
+##    p0 = [np.nanmax(cross_corr_thresholded), np.nanmin(cross_corr_thresholded)]
+#    p0 = [1, 0]
+#    grids = list()
+#    for i, d in enumerate(cross_corr_thresholded.shape):
+#        grids.append(np.arange(d))
+#        p0.extend([(d-1)*0.5, 0.5*d])
+#    res = optimize.least_squares(guassian_nd_error, p0, args=(grids, cross_corr_thresholded))
+    
+    ### Rbf peak finding
+    p0 = []
+    grids = list()
+    for i, d in enumerate(cross_corr_thresholded.shape):
+        grids.append(np.arange(d))
+        p0.append(0.5*d)
+    rbf_interpolator = build_rbf(grids, cross_corr_thresholded)
+    res = optimize.minimize(rbf_nd_error, p0, args=rbf_interpolator)
+    
+    offset = list()
+    for i in np.arange(len(cross_corr_thresholded.shape)):
+#        offset.append(res.x[2*i+2])
+        offset.append(res.x[i])
+    if return_quality:
+        peak_width, fit_residual = calc_peak_width(cross_corr_thresholded, res.x)
+    
+    offset += bounds[:, 0]
+    
+    if len(flat_dims) > 0:
+        offset = np.insert(offset, flat_dims, 0)
+    
+    if return_quality:
+        return offset - origin, np.asarray([peak_to_background, peak_width, fit_residual])
+    return offset - origin
+
+def calc_peak_width(peak, center):
+    """
+        Width (mean of sigmas from second moments around center) of the normalized, nan padded peak and
+        RMS residual of a gaussian with these sigmas against it.
+    """
+    grids = [np.arange(d) for d in peak.shape]
+    mask = ~np.isnan(peak)
+    weights = np.where(mask, peak, 0)
+    dims_nd = np.meshgrid(*grids, indexing='ij')
+    sigmas = [np.sqrt(max(np.sum(weights * (dim - c)**2) / np.sum(weights), 0.25)) for dim, c in zip(dims_nd, center)]
+    
+    p = [1, 0]
+    for c, sigma in zip(center, sigmas):
+        p.extend([c, sigma])
+    residual = np.sqrt(np.mean((peak - gaussian_nd(p, grids))[mask]**2))
+    return np.mean(sigmas), residual
+
+def plan_debug_cross_cor(n_pairs, cc_shape, crop_size=0, every=1):
+    """
+        Layout of the debug store of cross correlations. One record per captured pair with the index of the pair,
+        the corner of the crop in the cross correlation (projected to 2D, cc_shape) and the crop itself.
+        crop_size is the width of the crop around the peak, 0 to keep the whole projection. Every nth pair is captured.
+        Returns the record dtype and the indexes of the captured pairs.
+    """
+    crop_shape = tuple(int(d) if crop_size <= 0 else int(min(crop_size, d)) for d in cc_shape)
+    dtype = np.dtype([('pair', np.int32), ('corner', np.int32, (len(crop_shape),)), ('image', np.float32, crop_shape)])
+    captured = np.arange(0, n_pairs, max(every, 1))
+    return dtype, captured
+
+def store_cross_cor(cross_corr, flat_dims, slot, store):
+    """
+        Writes cross_corr, projected to 2D along its shortest axis and cropped around its peak,
+        to record slot of store (see plan_debug_cross_cor).
+        store is the array or (path, dtype, shape) of its file.
+    """
+    if isinstance(store, tuple):
+        path, dtype, shape = store
+        store = np.memmap(path, mode="r+", dtype=dtype, shape=shape)
+    
+    for d in flat_dims:
+        cross_corr = np.expand_dims(cross_corr, d)
+    short_axis = np.argmin(cross_corr.shape)
+    projection = cross_corr.mean(axis=short_axis)
+    
+    crop_shape = np.asarray(store.dtype['image'].shape)
+    peak = np.asarray(np.unravel_index(np.argmax(projection), projection.shape))
+    corner = np.clip(peak - crop_shape // 2, 0, np.asarray(projection.shape) - crop_shape)
+    store['corner'][slot] = corner
+    store['image'][slot] = projection[tuple(slice(c, c + n) for c, n in zip(corner, crop_shape))]
+    del store
+
+def guassian_nd_error(p, dims, data):
+    """
+        Calculates mask size normalized error. Protected against nan's.
+    """
+    mask = ~np.isnan(data)
+    return (data - gaussian_nd(p, dims))[mask]/mask.sum()
+
+def gaussian_nd(p, dims):
+    """
+        Creates n dimension gaussian with background.
+        p: tuple of variable length (A, bg, dim_0, sig_0, dim_1, sig_1, dim_2, sig_2, ...)
+        dims: 1d axis. need to match length with p
+    """
+    A, bg = p[:2]
+    dims_nd = np.meshgrid(*dims, indexing='ij')
+    exponent = 0
+    for i, dim in enumerate(dims_nd):
+        exponent += (dim-p[2+2*i])**2/(2*p[2+2*i+1]**2)
+    return A * np.exp(-exponent) + bg
+
+def build_rbf(grids, data):
+    from scipy import interpolate
+    grid_nd_list = np.meshgrid(*grids, indexing='ij')
+    data = data.flatten()
+    mask = ~np.isnan(data)
+    data = data[mask]
+    grid_nd_list_cleaned = [grid_nd.flatten()[mask] for grid_nd in grid_nd_list]
+    grid_nd_list_cleaned.append(data)
+    return interpolate.Rbf(*grid_nd_list_cleaned, function='multiquadric', epsilon=1.)
+
+def rbf_nd_error(p, rbf_interpolator):
+    return -rbf_interpolator(*p)
+
+def rbf_nd(rbf_interpolator, dims):
+    out_shape = [len(d) for d in dims]
+    dims_nd_list = np.meshgrid(*dims, indexing='ij')
+    dims_nd_list_cleaned = [dim_nd.flatten() for dim_nd in dims_nd_list]
+    return rbf_interpolator(*dims_nd_list_cleaned).reshape(out_shape)
+    
+
+def calc_fft_from_image_helper(args):
+    """
+        Wrapper for working with multiprocessing functions.
+    """
+    return (args[0], calc_fft_from_image(*args[1:]))
+
+def calc_fft_from_image(im, cache_fft=None):
+    # module level for multiprocessing
+    """
+        Reals real fft from passed or cached image
+    """
+    
+    if not cache_fft is None and cache_fft[0] != "":
+        path, dtype, shape, index = cache_fft
+        ft_images = np.memmap(path, mode="r+", dtype=dtype, shape=shape)
+        ft_images[index] = np.fft.rfftn(im)
+        ft_images.flush()
+        del ft_images
+        return
+    
+    return np.fft.rfftn(im)
+
+def calc_fft_from_images_helper(args):
+    """
+        Wrapper for working with multiprocessing functions.
+        Writes directly to the ft memmap if cache_fft is defined.
+    """
+    index, images, cache_fft = args
+    if not cache_fft is None and cache_fft[0] != "":
+        path, dtype, shape = cache_fft
+        ft_images = np.memmap(path, mode="r+", dtype=dtype, shape=shape)
+        ft_images[index:index+images.shape[0]] = calc_fft_from_images(images)
+        ft_images.flush()
+        del ft_images
+        return (index, None)
+    
+    return (index, calc_fft_from_images(images))
+
+def calc_fft_from_images(images):
+    """
+        Real fft of each image in a block (first dim).
+    """
+    return np.fft.rfftn(images, axes=tuple(range(1, images.ndim)))
+
+def prefetch_blocks(read_block, blocks, buffers):
+    """
+        Yields (i_start, block) for each (i_start, i_end) in blocks.
+        read_block(i_start, i_end, out) is called on a background thread so the next block is read
+        while the current one is used. A buffer is only reused after the caller asks for the next block.
+    """
+    free_buffers = queue.Queue()
+    for buf in buffers:
+        free_buffers.put(buf)
+    ready = queue.Queue()
+    stop = object()
+    
+    def reader():
+        try:
+            for i_start, i_end in blocks:
+                buf = free_buffers.get()
+                if buf is stop:
+                    return
+                ready.put((i_start, read_block(i_start, i_end, buf), buf))
+        except Exception as e:
+            ready.put(e)
+    
+    thread = threading.Thread(target=reader)
+    thread.daemon = True
+    thread.start()
+    
+    try:
+        for i in range(len(blocks)):
+            item = ready.get()
+            if isinstance(item, Exception):
+                raise item
+            i_start, block, buf = item
+            yield i_start, block
+            free_buffers.put(buf)
+    finally:
+        # stops the reader if the caller stopped early
+        free_buffers.put(stop)
+        thread.join()
+
+def preprocess_bin_fft_helper(args):
+    """
+        Wrapper for working with multiprocessing functions.
+        Writes directly to the fft memmap if cache_fft is defined.
+    """
+    index, data, inner, filter_args, bin_slices, binsize, bin_mode, dims_order, cache_fft = args
+    ft = preprocess_bin_fft(data, inner, filter_args, bin_slices, binsize, bin_mode, dims_order)
+    
+    if not cache_fft is None and cache_fft[0] != "":
+        path, dtype, shape = cache_fft
+        ft_images = np.memmap(path, mode="r+", dtype=dtype, shape=shape)
+        ft_images[index:index+ft.shape[0]] = ft
+        ft_images.flush()
+        del ft_images
+        return (index, None)
+    
+    return (index, ft)
+
+def preprocess_bin_fft(data, inner, filter_args, bin_slices, binsize, bin_mode, dims_order):
+    """
+        Filters (preprocess_tile), bins (block_reduce) a block of XYT frames and returns the real ft of each
+        binned time point as (t, ...) with spatial dims (x, y, 1) reordered by dims_order.
+    """
+    filtered, timings = preprocess_tile(data, inner, *filter_args)
+    binned = block_reduce(filtered[bin_slices[0], bin_slices[1]], binsize, bin_mode)
+    
+    images = np.moveaxis(binned, -1, 0)[..., None]
+    images = np.transpose(images, [0] + list(np.asarray(dims_order) + 1))
+    return np.fft.rfftn(images, axes=(1, 2, 3))
+
+def shift_frames_helper(args):
+    """
+        Wrapper for working with multiprocessing functions.
+        Writes directly to the output memmap if cache_image is defined.
+    """
+    index, frames, shifts, method, padding, cache_image = args
+    res = shift_frames(frames, shifts, method, padding)
+    
+    if not cache_image is None and cache_image[0] != "":
+        path, dtype, shape = cache_image
+        images = np.memmap(path, mode="r+", dtype=dtype, shape=shape)
+        images[..., index:index+res.shape[-1]] = res
+        images.flush()
+        del images
+        return (index, None)
+    
+    return (index, res)
+
+def shift_frames(frames, shifts, method='Fourier', padding=None):
+    """
+        Shifts a batch of frames with the chosen method.
+        frames: array of spatial dims then frames, e.g. (x, y, t)
+        shifts: (frames x spatial dims) in pixels
+        padding: only used by Fourier
+    """
+    if method == 'Fourier':
+        if padding is None:
+            padding = np.asarray(frames.shape[:-1])
+        return shift_frames_fourier(frames, shifts, padding)
+    else:
+        return shift_frames_realspace(frames, shifts, method)
+
+def shift_frames_fourier(frames, shifts, padding):
+    """
+        Performs fft based sub-pixel shifts on a batch of frames with real ffts.
+        frames: array of spatial dims then frames, e.g. (x, y, t)
+        shifts: (frames x spatial dims) in pixels
+        padding: added to both sides of each spatial dim to avoid wrap around
+    """
+    spatial_shape = frames.shape[:-1]
+    n_dims = len(spatial_shape)
+    n_frames = frames.shape[-1]
+    padded_shape = tuple(int(s + 2*p) for s, p in zip(spatial_shape, padding))
+    
+    # frames first so every transform works on contiguous data
+    core = (slice(None),) + tuple(slice(p, p + s) for s, p in zip(spatial_shape, padding))
+    padded = np.zeros((n_frames,) + padded_shape)
+    padded[core] = np.moveaxis(frames, -1, 0)
+    
+    axes = tuple(range(1, n_dims + 1))
+    ft = np.fft.rfftn(padded, axes=axes)
+    del padded
+    
+    ft *= calc_phase_ramp(padded_shape, shifts)
+    
+    shifted = np.fft.irfftn(ft, s=padded_shape, axes=axes)
+    del ft
+    
+    return np.moveaxis(np.abs(shifted[core]), 0, -1)
+
+def calc_phase_ramp(padded_shape, shifts):
+    """
+        Phase ramp for real fft based shifts. Outer product of 1d exponentials, one per dim.
+        Returns array broadcastable to the real ft of frames (frames, padded_shape).
+    """
+    n_frames = shifts.shape[0]
+    n_dims = len(padded_shape)
+    ramp = np.ones((n_frames,) + (1,) * n_dims, dtype=np.complex128)
+    for d, length in enumerate(padded_shape):
+        if d == n_dims - 1:
+            k = np.fft.rfftfreq(length)
+        else:
+            k = np.fft.fftfreq(length)
+        ramp_shape = [n_frames] + [1] * n_dims
+        ramp_shape[d + 1] = k.shape[0]
+        ramp = ramp * np.exp(-2j * np.pi * np.outer(shifts[:, d], k)).reshape(ramp_shape)
+    return ramp
+
+def _kernel_linear(x):
+    return np.clip(1 - np.abs(x), 0, None)
+
+def _kernel_cubic(x, a=-0.5):
+    # Keys cubic convolution
+    x = np.abs(x)
+    return np.where(x <= 1, (a + 2) * x**3 - (a + 3) * x**2 + 1,
+                    np.where(x < 2, a * x**3 - 5 * a * x**2 + 8 * a * x - 4 * a, 0))
+
+def _kernel_lanczos(x, a=3):
+    return np.where(np.abs(x) < a, np.sinc(x) * np.sinc(x / a), 0)
+
+# half width (taps on each side) and kernel function
+INTERPOLATION_KERNELS = {'Linear': (1, _kernel_linear),
+                         'Cubic': (2, _kernel_cubic),
+                         'Lanczos': (3, _kernel_lanczos),
+                         }
+
+def shift_frames_realspace(frames, shifts, kernel='Cubic'):
+    """
+        Real space sub-pixel shifts on a batch of frames. Integer part of the shift by slicing,
+        sub-pixel part by separable interpolation (1d kernel applied along each spatial dim).
+        Pixels shifted in from outside the frame are 0, same as the padded Fourier shift.
+        frames: array of spatial dims then frames, e.g. (x, y, t) or (x, y, z, t)
+        shifts: (frames x spatial dims) in pixels
+    """
+    shifted = np.asarray(frames, dtype=np.float64)
+    for d in range(frames.ndim - 1):
+        if np.any(shifts[:, d] != 0):
+            shifted = _shift_axis_realspace(shifted, shifts[:, d], d, kernel)
+    return shifted
+
+def _shift_axis_realspace(data, shifts, axis, kernel):
+    """
+        out[i] = data[i - shift] along axis, one shift per frame (last axis).
+    """
+    half_width, kernel_function = INTERPOLATION_KERNELS[kernel]
+    
+    # sample position i - shift = (i - n - 1) + (1 - f)
+    n = np.floor(shifts).astype(int)
+    f = shifts - n
+    taps = np.arange(-half_width + 1, half_width + 1)
+    weights = kernel_function((1 - f)[None, :] - taps[:, None])
+    weights /= weights.sum(axis=0)
+    
+    out = np.zeros_like(data)
+    for tap, w in zip(taps, weights):
+        # out[i] += w * data[i - offset]
+        offsets = n + 1 - tap
+        for offset in np.unique(offsets):
+            frames = offsets == offset
+            if np.all(frames):
+                frames = slice(None)
+            _add_shifted(out, data, offset, axis, w[frames], frames)
+    return out
+
+def _add_shifted(out, data, offset, axis, weight, frames):
+    """
+        out[..., frames] += weight * data[..., frames] shifted by integer offset along axis. Zero fill.
+    """
+    length = data.shape[axis]
+    if abs(offset) >= length:
+        return
+    dst = [slice(None)] * data.ndim
+    src = [slice(None)] * data.ndim
+    if offset >= 0:
+        dst[axis] = slice(offset, None)
+        src[axis] = slice(0, length - offset)
+    else:
+        dst[axis] = slice(0, length + offset)
+        src[axis] = slice(-offset, None)
+    dst[-1] = frames
+    src[-1] = frames
+    out[tuple(dst)] += weight * data[tuple(src)]
+
+def calc_fft_from_locs_helper(args):
+    """
+        Wrapper
+    """
+    return (args[0], calc_fft_from_locs(*args[1:]))
+
+def calc_fft_from_locs(xyz, bxyz, cache_fft=None, filter_size=None):
+    # module level for multiprocessing
+    """
+        Creates histogram and applies Tukey filter.
+        Results passed to calc_fft_from_image in the base class
+    """
+    from scipy import signal
+    im = np.histogramdd(xyz, bxyz)[0]
+    
+    if not filter_size is None:
+        mask_shape = np.ones(len(im.shape), dtype=np.int64)
+        for i, d in enumerate(im.shape):
+            if d <= 1:
+                continue
+            mask_shape[:] = 1
+            mask_shape[i] = d    
+            mask = np.empty(mask_shape)
+            mask.squeeze()[:] = signal.tukey(d, filter_size)
+            im *= mask
+        
+    del xyz, bxyz
+    
+    return calc_fft_from_image(im, cache_fft)
+    
+def calc_bin_edges(v_min, v_max, binsize, pad_single_bin=True):
+    """
+        Histogram bin edges covering v_min to v_max.
+        Pads bin length to odd number so image size is even.
+        A single bin (flattened dimension) is only padded if pad_single_bin.
+    """
+    edges = np.arange(v_min, v_max + binsize + 1, binsize)
+    if edges.shape[0] % 2 == 0 and (pad_single_bin or edges.shape[0] > 2):
+        edges = np.concatenate([edges, [edges[-1] + edges[1] - edges[0]]])
+    return edges
+
+def plan_windows(t, step, window):
+    """
+        Fixed windows. Returns 2d array of start and end (exclusive) time of windows.
+    """
+    # start time of all windows, allow partial window near end of pipeline
+    time_values = np.arange(t.min(), t.max() + 1, step)
+    return np.stack([time_values, np.clip(time_values + window, None, t.max())], axis=1)
+
+def plan_windows_by_density(t, target_count, min_frames=1):
+    """
+        Back to back windows sized to contain at least target_count localizations each.
+        Uses prefix sum of localizations per frame. t needs to be sorted.
+        A short last window is merged into the previous one.
+        Returns 2d array of start and end (exclusive) time of windows.
+    """
+    t_min = np.floor(t[0])
+    counts = np.bincount(np.floor(t - t_min).astype(int))
+    n_frames = counts.shape[0]
+    counts_cum = np.concatenate([[0], np.cumsum(counts)])
+    
+    edges = [0]
+    while edges[-1] < n_frames:
+        start = edges[-1]
+        end = np.searchsorted(counts_cum, counts_cum[start] + target_count, side='left')
+        edges.append(min(max(end, start + min_frames), n_frames))
+    
+    if len(edges) > 2 and counts_cum[edges[-1]] - counts_cum[edges[-2]] < 0.5 * target_count:
+        edges.pop(-2)
+    
+    edges = np.asarray(edges) + t_min
+    return np.stack([edges[:-1], edges[1:]], axis=1)
+
+def calc_drift_lut(interpolators, t_min, t_max):
+    """
+        Evaluates drift interpolators once per frame from t_min to t_max.
+        Returns first frame and lookup table (frames x dims).
+    """
+    t_frames = np.arange(np.floor(t_min), np.floor(t_max) + 1)
+    return t_frames[0], np.stack([f(t_frames) for f in interpolators], axis=1)
+
+def lookup_drift(t, t_first, lut, interpolator):
+    """
+        Drift at times t from one column of calc_drift_lut, gathered by frame index.
+        Calls interpolator directly if t is not integer.
+    """
+    index = (t - t_first).astype(int)
+    if np.any(index != t - t_first):
+        return interpolator(t)
+    return lut[index]
+
+def interpolate_drift(tIndex, drift, degree_of_spline, smoothing_factor):
+    from scipy import interpolate
+    if smoothing_factor < 0:
+        smoothing_factor = None
+                
+    spl = list()
+    for i in range(drift.shape[1]):
+        spl_1d = interpolate.UnivariateSpline(tIndex, drift[:,i], k=degree_of_spline, s=smoothing_factor)
+        spl.append(spl_1d)
+    
+    return spl
+
+
+class DriftTable(object):
+    """
+        Drift of one dimension tabulated at every frame. Linear interpolation between frames.
+        Calls fallback (if provided) outside of the tabulated range, otherwise clips to the end values.
+        t can be a scalar or an array.
+    """
+    def __init__(self, t_first, values, fallback=None):
+        self.t_first = t_first
+        self.values = values
+        self.fallback = fallback
+        # repeat last value so the frame after the last one can always be looked up
+        self._values_padded = np.append(values, values[-1])
+        
+    def __call__(self, t):
+        t = np.asarray(t, dtype=float)
+        index = np.atleast_1d(t) - self.t_first
+        index_clipped = np.clip(index, 0, self.values.shape[0] - 1)
+        frame = index_clipped.astype(int)
+        frac = index_clipped - frame
+        out = self._values_padded[frame] * (1 - frac) + self._values_padded[frame + 1] * frac
+        
+        if not self.fallback is None:
+            outside = index != index_clipped
+            if np.any(outside):
+                out[outside] = self.fallback(np.atleast_1d(t)[outside])
+        
+        return out.reshape(t.shape)
+    
+
+# how pairs are chosen (not for DCC), see select_pairs
+PAIR_SAMPLINGS = ['Window', 'Geometric', 'Random']
+
+def select_pairs(n_steps, method='RCC', corr_window=0, sampling='Window', seed=0):
+    """
+        Pairs of time points (i, j), i < j, to cross correlate, in order of i then j.
+        DCC only correlates against the first time point. Otherwise by sampling:
+        Window: all pairs with j-i up to corr_window, all pairs if corr_window is 0.
+        Geometric: pairs with j-i up to corr_window (at least 1) plus links of corr_window * 2, 4, 8, ... from each time point.
+        Random: pairs with j-i up to corr_window (at least 1) plus about log2(n_steps) random partners per time point (seeded).
+        Geometric and Random need O(n log n) pairs and keep long range links that stop errors adding up along the band.
+    """
+    if method == "DCC":
+        return [(0, j) for j in range(1, n_steps)]
+    
+    window = corr_window if corr_window > 0 else n_steps
+    if sampling == 'Window':
+        return [(i, j) for i in range(n_steps-1) for j in range(i+1, min(i+window, n_steps-1)+1)]
+    
+    window = max(corr_window, 1)
+    pairs = set((i, j) for i in range(n_steps-1) for j in range(i+1, min(i+window, n_steps-1)+1))
+    if sampling == 'Geometric':
+        for i in range(n_steps-1):
+            step = 2 * window
+            while i + step < n_steps:
+                pairs.add((i, i + step))
+                step *= 2
+    elif sampling == 'Random':
+        rng = np.random.RandomState(seed)
+        n_links = int(np.ceil(np.log2(max(n_steps, 2))))
+        for i in range(n_steps):
+            for j in rng.randint(0, n_steps, n_links):
+                if j != i:
+                    pairs.add((min(i, j), max(i, j)))
+    else:
+        raise ValueError("Unknown pair sampling {}".format(sampling))
+    
+    return sorted(pairs)
+
+# normal equations denser than this (fraction of nonzeros) are solved as dense matrices
+DENSE_NORMAL_FRACTION = 0.1
+
+def is_normal_dense(n_pairs, n_steps):
+    """
+        Whether the normal equations of n_pairs pairs over n_steps time points are solved as a dense matrix.
+    """
+    return n_steps + 2 * n_pairs > DENSE_NORMAL_FRACTION * n_steps**2
+
+class PairCoefficients(object):
+    """
+        Coefficient matrix (pairs x n_steps-1) of the frame-to-frame drifts summed by each pair,
+        stored as the time points (i, j) of each pair. Row k is ones from column i to j-1.
+        Products are computed on the cumulative drift at each time point, so the pair system is
+        a graph of time points with one edge per pair. todense builds the matrix for debugging.
+    """
+    def __init__(self, i, j, n_steps):
+        self.i = np.asarray(i, dtype=np.int32)
+        self.j = np.asarray(j, dtype=np.int32)
+        self.n_steps = int(n_steps)
+    
+    @classmethod
+    def from_pairs(cls, pairs, n_steps):
+        pairs = np.asarray(pairs, dtype=np.int32).reshape(-1, 2)
+        return cls(pairs[:, 0], pairs[:, 1], n_steps)
+    
+    @property
+    def shape(self):
+        return (self.i.shape[0], max(self.n_steps-1, 0))
+    
+    @property
+    def nbytes(self):
+        return self.i.nbytes + self.j.nbytes
+    
+    def __len__(self):
+        return self.i.shape[0]
+    
+    def __getitem__(self, index):
+        """
+            Subset of pairs (mask or indices).
+        """
+        return PairCoefficients(self.i[index], self.j[index], self.n_steps)
+    
+    def dot(self, drifts):
+        """
+            Same as np.matmul(coefs, drifts). Difference of the cumulative drift at j and i.
+        """
+        cumulative = np.zeros((self.n_steps,) + drifts.shape[1:], dtype=np.result_type(drifts, np.float64))
+        np.cumsum(drifts, axis=0, out=cumulative[1:])
+        return cumulative[self.j] - cumulative[self.i]
+    
+    def is_full_rank(self, weights=None):
+        """
+            Whether the matrix (of pairs with nonzero weights) has full column rank, i.e. the pairs connect all time points.
+        """
+        from scipy.sparse import coo_matrix
+        from scipy.sparse.csgraph import connected_components
+        
+        if self.n_steps < 2:
+            return False
+        keep = slice(None) if weights is None else np.asarray(weights) != 0
+        i, j = self.i[keep], self.j[keep]
+        graph = coo_matrix((np.ones(i.shape[0], dtype=np.int8), (i, j)), shape=(self.n_steps, self.n_steps))
+        return connected_components(graph, directed=False, return_labels=False) == 1
+    
+    def normal_equations(self, shifts, weights=None):
+        """
+            Normal equations of the weighted least squares in the cumulative drift, with the first time point fixed at 0.
+            The left hand side is the graph Laplacian of the pairs without its first row and column, sparse
+            (csc) unless is_normal_dense. Returns the left and right hand sides, (n_steps-1) rows each.
+        """
+        from scipy.sparse import coo_matrix
+        
+        n_pairs = self.i.shape[0]
+        w = np.ones(n_pairs) if weights is None else np.asarray(weights, dtype=np.float64)
+        
+        rows = np.concatenate([self.i, self.j, self.i, self.j])
+        cols = np.concatenate([self.i, self.j, self.j, self.i])
+        values = np.concatenate([w, w, -w, -w])
+        lhs = coo_matrix((values, (rows, cols)), shape=(self.n_steps, self.n_steps)).tocsc()[1:, 1:]
+        
+        weighted = shifts * w[:, None]
+        rhs = np.zeros((self.n_steps,) + shifts.shape[1:])
+        np.add.at(rhs, self.j, weighted)
+        np.subtract.at(rhs, self.i, weighted)
+        
+        if is_normal_dense(n_pairs, self.n_steps):
+            lhs = lhs.toarray()
+        return lhs, rhs[1:]
+    
+    def todense(self):
+        """
+            The coefficient matrix as a dense float array. For debugging only, this is pairs x n_steps-1.
+        """
+        coefs = np.zeros(self.shape)
+        for k, (i, j) in enumerate(zip(self.i, self.j)):
+            coefs[k, i:j] = 1
+        return coefs
+    
+
+def plan_pairs(n_steps, method='RCC', corr_window=0, sampling='Window'):
+    """
+        Pairs of time points (i, j) to cross correlate (see select_pairs), and the matching
+        coefficient matrix (PairCoefficients) of frame-to-frame drifts summed by each pair.
+    """
+    pairs = select_pairs(n_steps, method, corr_window, sampling)
+    
+    return pairs, PairCoefficients.from_pairs(pairs, n_steps)
+
+def calc_pair_shifts(ft_images, pairs, cache_fft="", pool=None, cc_args=None, progress=None, max_in_flight=None):
+    """
+        Shift between the ft images of each pair, relative to the auto correlation of the first image.
+        Rows are nan where the cross correlation failed.
+        With a pool, workers read ft images from cache_fft (file of ft_images) if provided, otherwise
+        the images are passed to them. At most max_in_flight pairs are handed to the pool at once (no limit if None).
+        cc_args are the per pair debug_cross_cor args of calc_shift, (slot, store) of store_cross_cor or None.
+        progress(n_done, n_total) is called every fifth or so of the pairs.
+        Returns the shifts and the quality of each pair (QUALITY_METRICS, see calc_shift_direct).
+    """
+    n_pairs = len(pairs)
+    shifts = np.zeros((n_pairs, 3))
+    quality = np.zeros((n_pairs, len(QUALITY_METRICS)))
+    if cc_args is None:
+        cc_args = (None,) * n_pairs
+    report_every = max(n_pairs // 5, 1)
+    
+    # once per first image
+    autocor_shifts = dict()
+    for i, j in pairs:
+        if not i in autocor_shifts:
+            ft_1 = ft_images[i]
+            autocor_shifts[i] = calc_shift(ft_1, ft_1)
+    
+    if pool is None:
+        for k, (i, j) in enumerate(pairs):
+            shifts[k, :], quality[k, :] = calc_shift(ft_images[i], ft_images[j], autocor_shifts[i], None, cc_args[k], True)
+            
+            if not progress is None and ((k+1) % report_every == 0):
+                progress(k+1, n_pairs)
+    else:
+        cache = (cache_fft, ft_images.dtype, ft_images.shape)
+        if cache_fft == "":
+            args = ((k, ft_images[i], ft_images[j], autocor_shifts[i], cache, cc_args[k], True) for k, (i, j) in enumerate(pairs))
+        else:
+            args = ((k, i, j, autocor_shifts[i], cache, cc_args[k], True) for k, (i, j) in enumerate(pairs))
+        
+        if max_in_flight is None:
+            max_in_flight = n_pairs
+        
+        n_done = [0]
+        def store(k, res):
+            shifts[k,], quality[k,] = res
+            n_done[0] += 1
+            if not progress is None and (n_done[0] % report_every == 0):
+                progress(n_done[0], n_pairs)
+        
+        pending = deque()
+        for arg in args:
+            pending.append(pool.apply_async(calc_shift_helper, (arg,)))
+            while len(pending) >= max_in_flight or (len(pending) > 0 and pending[0].ready()):
+                store(*pending.popleft().get())
+        while len(pending) > 0:
+            store(*pending.popleft().get())
+    
+    return shifts, quality
+
+def calc_pair_weights(quality):
+    """
+        Weights for solve_drift from the quality of each pair (see calc_pair_shifts), normalized to a mean of 1.
+        Inverse square of the gaussian fit residual, which follows the error of the shift best. Peaks of
+        sparse images are narrow and of high contrast but often wrong, so contrast and width are not used.
+        Pairs without a valid quality get the lowest weight.
+        The accuracy gain over uniform weights is unproven, see ``weighting`` of the RCC modules.
+    """
+    fit_residual = np.asarray(quality, dtype=np.float64)[:, QUALITY_METRICS.index('fit_residual')]
+    weights = 1. / np.clip(fit_residual, 0.01, None)**2
+    weights[~np.isfinite(weights)] = 0
+    if weights.sum() > 0:
+        weights *= len(weights) / weights.sum()
+    # keeps every pair in the system so it stays solvable
+    return np.maximum(weights, 1e-3)
+
+def remove_invalid_shifts(shifts, coefs, weights=None):
+    """
+        Drops pairs with nan shifts and checks the coefficient matrix is still solvable.
+        weights (one per pair) are dropped with them if provided.
+    """
+    mask = np.where(~np.isnan(shifts).any(axis=1))[0]
+    if len(mask) < shifts.shape[0]:
+        coefs = coefs[mask]
+        shifts = shifts[mask, :]
+        if not weights is None:
+            weights = weights[mask]
+    
+    assert (coefs.shape[0] > 0) and coefs.is_full_rank(), "Something went wrong with coefficient matrix. Not full rank."
+    
+    return shifts, coefs, weights
+
+def solve_drift(coefs, shifts, weights=None):
+    """
+        Least squares frame-to-frame drift from pair shifts, weighted per pair if weights are provided.
+        Pairs with 0 weight are ignored. Solves the normal equations of PairCoefficients for the cumulative drift.
+    """
+    from scipy.sparse import issparse
+    from scipy.sparse.linalg import spsolve
+    
+    lhs, rhs = coefs.normal_equations(shifts, weights)
+    if issparse(lhs):
+        cumulative = spsolve(lhs, rhs).reshape(rhs.shape)
+    else:
+        cumulative = np.linalg.solve(lhs, rhs)
+    
+    drifts = cumulative.copy()
+    drifts[1:] -= cumulative[:-1]
+    return drifts
+
+def solve_drift_robust(coefs, shifts, shift_max, weights=None, max_iterations=50, tolerance=1e-3):
+    """
+        Iteratively reweighted least squares with Huber weights on the residual distance of each pair.
+        Pairs with residuals over shift_max are down-weighted (shift_max / residual) instead of removed.
+        Each iteration solves the normal equations (see solve_drift). Stops when the drift changes by
+        less than tolerance * shift_max or after max_iterations.
+        weights are per pair weights to start from (see calc_pair_weights).
+        Returns the drift, the final Huber weights and the number of iterations.
+    """
+    if weights is None:
+        weights = np.ones(coefs.shape[0])
+    
+    robust_weights = np.ones(coefs.shape[0])
+    drifts = None
+    for iteration in range(1, max_iterations + 1):
+        drifts_new = solve_drift(coefs, shifts, weights * robust_weights)
+        converged = not drifts is None and np.abs(drifts_new - drifts).max() < tolerance * shift_max
+        drifts = drifts_new
+        
+        residuals_dist = np.linalg.norm(coefs.dot(drifts) - shifts, axis=1)
+        robust_weights = np.minimum(1, shift_max / np.maximum(residuals_dist, 1e-12))
+        if converged:
+            break
+    
+    return drifts, robust_weights, iteration
+
+def reject_outliers(coefs, shifts, drifts, shift_max):
+    """
+        Removes pairs with residuals over shift_max, largest first, as long as the
+        coefficient matrix stays full rank.
+        Returns the mask of pairs kept (weights for solve_drift), number of pairs removed and whether all could be removed.
+    """
+    # Calculate residual errors
+    residuals = coefs.dot(drifts) - shifts
+    residuals_dist = np.linalg.norm(residuals, axis=1)
+    
+    # Sort and mask residual errors
+    residuals_arg = np.argsort(-residuals_dist)
+    residuals_arg = residuals_arg[residuals_dist[residuals_arg] > shift_max]
+    
+    # Remove pairs
+    # Descending from largest residuals to small
+    # Only if matrix remains full rank
+    # Removing more pairs can only lose rank, so the number removed is found by bisection
+    def keep_mask(n_removed):
+        keep = np.ones(coefs.shape[0], dtype=bool)
+        keep[residuals_arg[:n_removed]] = False
+        return keep
+    
+    keep = keep_mask(len(residuals_arg))
+    if len(residuals_arg) == 0 or coefs.is_full_rank(keep):
+        return keep, len(residuals_arg), True
+    
+    counter, n_fail = 0, len(residuals_arg)
+    while n_fail - counter > 1:
+        n_removed = (counter + n_fail) // 2
+        if coefs.is_full_rank(keep_mask(n_removed)):
+            counter = n_removed
+        else:
+            n_fail = n_removed
+    
+    return keep_mask(counter), counter, False
+
+def count_pairs(n_steps, method='RCC', corr_window=0, sampling='Window'):
+    """
+        Number of pairs plan_pairs returns, without building the coefficient matrix.
+    """
+    if n_steps < 2:
+        return 0
+    if method == "DCC":
+        return n_steps - 1
+    if sampling != 'Window':
+        return len(select_pairs(n_steps, method, corr_window, sampling))
+    if corr_window > 0:
+        return sum(min(corr_window, n_steps-1-i) for i in range(n_steps-1))
+    return n_steps * (n_steps-1) // 2
+
+def get_available_memory():
+    """
+        Memory available to new allocations in bytes, None if unknown.
+    """
+    try:
+        import psutil
+        return int(psutil.virtual_memory().available)
+    except ImportError:
+        pass
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+FT_PRECISIONS = {'Double': np.complex128, 'Single': np.complex64}
+
+def plan_rcc_memory(ft_shape, n_pairs, memory_limit=None, storage='Auto', precision='Auto', can_cache=True, pool_size=1):
+    """
+        Chooses where the ft images (ft_shape, one per time point) are kept, their precision and how many
+        pairs are correlated at once so the estimated footprint stays within memory_limit (bytes, None for no limit).
+        
+        In order of preference: double precision in memory, single precision in memory, double precision on file.
+        storage ('Auto', 'Memory' or 'File') and precision ('Auto', 'Double' or 'Single') restrict the choice.
+        File storage needs a cache file (can_cache). If nothing fits, the smallest allowed choice is returned with 'fits' False.
+        Returns an OrderedDict of the choices and the estimates (bytes) they are based on.
+    """
+    n_steps = int(ft_shape[0])
+    ft_voxels = int(np.prod(ft_shape[1:]))
+    
+    # pairs, shifts, residuals and weights, plus the normal equations (triplets and csc, or dense and its factorisation)
+    if is_normal_dense(n_pairs, n_steps):
+        normal_bytes = 2 * 8 * max(n_steps-1, 1)**2
+    else:
+        normal_bytes = 4 * 16 * (n_steps + 4 * n_pairs)
+    solve_bytes = 2 * 4 * n_pairs + 3 * 8 * 3 * n_pairs + 2 * 8 * n_pairs + normal_bytes
+    # filtered copies of both ft images, their product and the real space cross correlation with its mask
+    pair_bytes = 3 * 16 * ft_voxels + 4 * 16 * ft_voxels
+    
+    storages = ['Memory', 'File'] if storage == 'Auto' else [storage]
+    if not can_cache:
+        storages = ['Memory']
+    candidates = list()
+    for s in storages:
+        if precision != 'Auto':
+            candidates.append((s, precision))
+        elif s == 'Memory':
+            candidates.extend([(s, 'Double'), (s, 'Single')])
+        else:
+            # on file only the page cache holds the ft images, no gain from single precision
+            candidates.append((s, 'Double'))
+    
+    def ram_bytes(s, p):
+        ft_bytes = n_steps * ft_voxels * np.dtype(FT_PRECISIONS[p]).itemsize if s == 'Memory' else 0
+        return solve_bytes + ft_bytes + pair_bytes
+    
+    fits = True
+    for s, p in candidates:
+        if memory_limit is None or ram_bytes(s, p) <= memory_limit:
+            break
+    else:
+        fits = False
+    
+    dtype = np.dtype(FT_PRECISIONS[p])
+    ft_bytes = n_steps * ft_voxels * dtype.itemsize
+    image_bytes = ft_voxels * dtype.itemsize
+    
+    pool_size = max(int(pool_size), 1)
+    if memory_limit is None:
+        workers = pool_size
+        in_flight = 2 * pool_size
+    else:
+        free = memory_limit - ram_bytes(s, p) + pair_bytes
+        # ft images are passed to workers if not read from file
+        worker_bytes = pair_bytes + (2 * image_bytes if s == 'Memory' else 0)
+        queued_bytes = 2 * image_bytes if s == 'Memory' else 0
+        workers = int(np.clip(free // worker_bytes, 1, pool_size))
+        if queued_bytes > 0:
+            in_flight = int(np.clip(workers + (free - workers * worker_bytes) // queued_bytes, workers, 2 * workers))
+        else:
+            in_flight = 2 * workers
+    
+    return OrderedDict([('storage', s),
+                        ('precision', p),
+                        ('dtype', dtype.name),
+                        ('workers', workers),
+                        ('pairs_in_flight', in_flight),
+                        ('ft_bytes', int(ft_bytes)),
+                        ('solve_bytes', int(solve_bytes)),
+                        ('pair_bytes', int(pair_bytes)),
+                        ('estimated_bytes', int(ram_bytes(s, p) + (workers - 1) * pair_bytes)),
+                        ('memory_limit', None if memory_limit is None else int(memory_limit)),
+                        ('fits', fits),
+                        ])
+
+class OnlineRCCDriftEstimator(object):
+    """
+    Incremental drift estimation for localizations that are still being acquired.
+    Not a recipe module, feed it from acquisition or analysis code.
+    
+    Uses the same time windows, histograms and cross correlations as ``RCCDriftCorrection``.
+    Each completed window is correlated against the previous ``corr_window`` windows and
+    added to the least squares system of the RCC algorithm in information form.
+    Windows too old to be paired with new windows are marginalized out, so the cost per
+    window is bounded by ``corr_window`` and not by the length of the acquisition.
+    Drift of marginalized windows is kept as estimated at that point (not updated with later data).
+    
+    Rejection is done per window: shifts that disagree with the median prediction from the
+    other pairs by more than ``shift_max`` are dropped (at least one pair is always kept).
+    
+    Parameters
+    ----------
+    x_range, y_range : Tuple of floats
+        Extent of the field of view. Needs to be known beforehand to fix the histogram bins.
+    z_range : Tuple of floats
+        Extent in z. None for 2D.
+    binsize : Float
+        Pixel size.
+    step : Int
+        Step size between windows.
+    window : Int
+        Number of frames used per window. Should be equal or larger than step size.
+    corr_window : Int
+        Number of previous windows each new window is correlated against.
+    tukey_size : Float
+        Shape parameter for Tukey filter (``scipy.signal.tukey``).
+    shift_max : Float
+        Rejection threshold. Set to 0 or negative to disable.
+    t_start : Int
+        Frame the first window starts at.
+    """
+    
+    def __init__(self, x_range, y_range, z_range=None, binsize=30, step=2500, window=2500,
+                 corr_window=5, tukey_size=0.25, shift_max=5, t_start=0):
+        self.step = step
+        self.window = window
+        self.corr_window = max(corr_window, 1)
+        self.tukey_size = tukey_size
+        self.shift_max = shift_max
+        
+        if z_range is None:
+            z_range = (0, 0)
+        bxyz = [calc_bin_edges(x_range[0], x_range[1], binsize),
+                calc_bin_edges(y_range[0], y_range[1], binsize),
+                calc_bin_edges(z_range[0], z_range[1], binsize, pad_single_bin=False)]
+        # shifts of flattened dimensions are always 0
+        self._binsizes = np.asarray([binsize if len(b) > 2 else 0 for b in bxyz])
+        
+        # swap longest axis to the last, same as RCCDriftCorrection, so rfft never runs over a single bin (2D)
+        self._dims_order = np.arange(len(bxyz))
+        dims_largest_index = np.argmax([len(b) for b in bxyz])
+        self._dims_order[-1], self._dims_order[dims_largest_index] = self._dims_order[dims_largest_index], self._dims_order[-1]
+        self.bxyz = [bxyz[i] for i in self._dims_order]
+        
+        self._t_start = t_start
+        self._t_last = None
+        self._next_window = 0
+        # x, y, z, t of localizations not yet used by all their windows
+        self._pending = np.zeros((4, 0))
+        
+        # window index, ft image and autocorrelation shift of the last corr_window windows
+        self._recent = list()
+        
+        # all windows, center time and position (nan if window failed)
+        self._t_mid = list()
+        self._positions = list()
+        
+        # information form of the active (not marginalized) part of the least squares system
+        # first valid window is the anchor with position fixed at 0 and is not a variable
+        self._anchor = None
+        self._active = list()
+        self._info_matrix = np.zeros((0, 0))
+        self._info_vector = np.zeros((0, 3))
+    
+    def _window_bounds(self, k):
+        start = self._t_start + k * self.step
+        return start, start + self.window
+    
+    def add_localizations(self, x, y, z, t):
+        """
+            Adds newly acquired localizations. t is expected to increase between calls.
+            Processes every window completed by this data and returns how many.
+        """
+        if z is None:
+            z = np.zeros_like(x)
+        new = np.asarray([x, y, z, t], dtype=float)
+        if new.shape[1] == 0:
+            return 0
+        if np.any(np.diff(new[3]) < 0):
+            new = new[:, np.argsort(new[3])]
+        
+        self._pending = np.concatenate([self._pending, new], axis=1)
+        self._t_last = new[3, -1] if self._t_last is None else max(self._t_last, new[3, -1])
+        
+        n_processed = 0
+        # window is complete once its last frame has passed
+        while self._window_bounds(self._next_window)[1] <= self._t_last:
+            self._process_window(*self._window_bounds(self._next_window))
+            n_processed += 1
+        
+        return n_processed
+    
+    def finish(self):
+        """
+            Processes remaining windows with the data available, allowing partial window near the end.
+        """
+        if self._t_last is None:
+            return
+        while self._window_bounds(self._next_window)[0] <= self._t_last:
+            start, end = self._window_bounds(self._next_window)
+            self._process_window(start, min(end, self._t_last + 1))
+    
+    def _process_window(self, start, end):
+        k = self._next_window
+        self._next_window += 1
+        
+        t = self._pending[3]
+        i_start, i_end = np.searchsorted(t, [start, end], side='left')
+        ft = calc_fft_from_locs(self._pending[self._dims_order, i_start:i_end].T, self.bxyz, filter_size=self.tukey_size)
+        
+        # drop localizations not needed by later windows
+        next_start = self._window_bounds(self._next_window)[0]
+        self._pending = self._pending[:, np.searchsorted(t, next_start, side='left'):]
+        
+        self._t_mid.append(0.5 * (start + end))
+        self._positions.append(np.full(3, np.nan))
+        
+        autocor_shift = calc_shift(ft, ft)
+        if np.any(np.isnan(autocor_shift)):
+            print("Window {} has no data. Skipped.".format(k))
+            return
+        
+        if self._anchor is None:
+            self._anchor = k
+            self._positions[k][:] = 0
+        else:
+            pairs = list()
+            for i, ft_i, autocor_shift_i in self._recent:
+                shift = calc_shift(ft_i, ft, autocor_shift_i)[self._dims_order] * self._binsizes
+                if not np.any(np.isnan(shift)):
+                    pairs.append((i, shift))
+            
+            if len(pairs) == 0:
+                print("No valid cross correlation for window {}. Skipped.".format(k))
+                return
+            
+            self._add_to_system(k, self._reject_pairs(k, pairs))
+        
+        self._recent.append((k, ft, autocor_shift))
+        if len(self._recent) > self.corr_window:
+            self._recent.pop(0)
+        self._marginalize()
+    
+    def _reject_pairs(self, k, pairs):
+        """
+            Drops pairs whose prediction of the new position is far from the median prediction.
+        """
+        if self.shift_max <= 0 or len(pairs) < 3:
+            return pairs
+        predictions = np.asarray([self._positions[i] + shift for i, shift in pairs])
+        residuals = np.linalg.norm(predictions - np.median(predictions, axis=0), axis=1)
+        keep = residuals <= self.shift_max
+        keep[np.argmin(residuals)] = True
+        if not np.all(keep):
+            print("Window {}: removed {} of {} cross correlations.".format(k, len(pairs) - keep.sum(), len(pairs)))
+        return [p for p, kept in zip(pairs, keep) if kept]
+    
+    def _add_to_system(self, k, pairs):
+        """
+            Adds window k as new variable with one equation per pair (p_k - p_i = shift) and re-solves.
+        """
+        n = len(self._active)
+        self._active.append(k)
+        info_matrix = np.zeros((n+1, n+1))
+        info_matrix[:n, :n] = self._info_matrix
+        info_vector = np.zeros((n+1, 3))
+        info_vector[:n] = self._info_vector
+        
+        for i, shift in pairs:
+            info_matrix[n, n] += 1
+            info_vector[n] += shift
+            if i != self._anchor:
+                j = self._active.index(i)
+                info_matrix[j, j] += 1
+                info_matrix[j, n] -= 1
+                info_matrix[n, j] -= 1
+                info_vector[j] -= shift
+        
+        self._info_matrix = info_matrix
+        self._info_vector = info_vector
+        
+        positions = np.linalg.solve(self._info_matrix, self._info_vector)
+        for j, index in enumerate(self._active):
+            self._positions[index][:] = positions[j]
+    
+    def _marginalize(self):
+        """
+            Removes variables and recent windows that can't be paired with future windows (Schur complement).
+        """
+        oldest_needed = self._next_window - self.corr_window
+        # skipped windows leave older windows in _recent
+        self._recent = [r for r in self._recent if r[0] >= oldest_needed]
+        drop = np.asarray([index < oldest_needed for index in self._active], dtype=bool)
+        if not np.any(drop):
+            return
+        keep = ~drop
+        info_ba = self._info_matrix[np.ix_(keep, drop)]
+        gain = np.matmul(info_ba, np.linalg.inv(self._info_matrix[np.ix_(drop, drop)]))
+        self._info_matrix = self._info_matrix[np.ix_(keep, keep)] - np.matmul(gain, info_ba.T)
+        self._info_vector = self._info_vector[keep] - np.matmul(gain, self._info_vector[drop])
+        self._active = [index for index, d in zip(self._active, drop) if not d]
+    
+    @property
+    def drift(self):
+        """
+            Latest drift estimate, same format as ``output_drift`` of ``RCCDriftCorrection``.
+            Tuple of window center times and drift relative to the first window.
+        """
+        return np.asarray(self._t_mid), np.asarray(self._positions).reshape(-1, 3)
@@ -24,8 +24,10 @@ register_module_elsewhere('Image_Pre_Clip&Filter', processing.PreprocessingFilte
 register_module_elsewhere('Image_Pre_Downsample', processing.Binning)
 
 register_module_elsewhere('Image_RCC', processing.RCCDriftCorrection)
+register_module_elsewhere('Image_RCC_Streaming', processing.StreamingRCCDriftCorrection)
 
 register_module_elsewhere('Image_Post_Shift', processing.ShiftImage)
+register_module_elsewhere('Image_Post_Shift_3D', processing.ShiftVolume)
 
 
 register_module_elsewhere('Drift_Save', io.DriftOutput)
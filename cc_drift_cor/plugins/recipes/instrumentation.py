@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+Stage timings, counters and memory of recipe module runs.
+
+Used by ``CacheCleanupModule``. Every run collects spans (time and change of RSS per stage), counters and the
+process peak RSS, which are logged at the end of the run and can be saved / attached to the outputs as a JSON report.
+
+RSS is process wide. When several runs share the process (e.g. ``cc_drift_cor_batch --jobs``), the RSS change of
+a span includes memory allocated or freed by the other runs meanwhile, and the peak is that of the whole process.
+"""
+
+import sys
+import time
+import json
+from contextlib import contextmanager
+from collections import OrderedDict
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+import logging
+logger=logging.getLogger(__name__)
+
+REPORT_VERSION = 2
+
+def get_current_rss():
+    """
+        Current resident set size of the process in bytes, None if not available on this platform.
+    """
+    try:
+        import psutil
+        return int(psutil.Process().memory_info().rss)
+    except ImportError:
+        pass
+    
+    try:
+        import os
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, AttributeError):
+        return None
+
+def get_peak_rss(children=False):
+    """
+        Peak resident set size of the process (since it started, not of one run) in bytes, None if not available on this platform.
+        Children only covers child processes that already finished (e.g. a closed multiprocessing pool).
+    """
+    if resource is None:
+        if children:
+            return None
+        try:
+            import psutil
+            return int(psutil.Process().memory_info().peak_wset)
+        except (ImportError, AttributeError):
+            return None
+    
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on OS X
+    if sys.platform != 'darwin':
+        peak *= 1024
+    return int(peak)
+
+class Instrumentation(object):
+    """
+        Collects spans and counters of one module run.
+        Spans of the same stage add up, so stages run block by block or in worker processes can be
+        timed piecewise (``span`` around local work, ``add_time`` for times measured elsewhere).
+        ``span`` also adds up the change of the process RSS over the stage, ``add_time`` has no RSS change.
+        Counters can be tied to a stage to report a rate (e.g. pairs/s of 'pair correlation').
+    """
+    def __init__(self, name):
+        self.name = name
+        self.start_time = time.time()
+        self.end_time = None
+        self.spans = OrderedDict()
+        self.rss_deltas = OrderedDict()
+        self.counters = OrderedDict()
+        self._counter_stages = dict()
+        self.info = OrderedDict()
+    
+    @contextmanager
+    def span(self, stage):
+        t_start = time.time()
+        rss_start = get_current_rss()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.time() - t_start)
+            rss_end = get_current_rss()
+            if not (rss_start is None or rss_end is None):
+                self.rss_deltas[stage] = self.rss_deltas.get(stage, 0) + rss_end - rss_start
+    
+    def add_time(self, stage, seconds, calls=1):
+        span = self.spans.setdefault(stage, [0., 0])
+        span[0] += seconds
+        span[1] += calls
+        logger.debug("{}: {} took {:.3f} s.".format(self.name, stage, seconds))
+    
+    def count(self, counter, value=1, stage=None):
+        self.counters[counter] = self.counters.get(counter, 0) + value
+        if not stage is None:
+            self._counter_stages[counter] = stage
+    
+    def elapsed(self):
+        return (time.time() if self.end_time is None else self.end_time) - self.start_time
+    
+    def finish(self):
+        self.end_time = time.time()
+    
+    def report(self):
+        """
+            Plain dict of the run, ready for json.
+        """
+        rates = OrderedDict()
+        for counter, value in self.counters.items():
+            stage = self._counter_stages.get(counter)
+            if stage in self.spans and self.spans[stage][0] > 0:
+                rates["{}/s".format(counter)] = value / self.spans[stage][0]
+        
+        return OrderedDict([('version', REPORT_VERSION),
+                            ('module', self.name),
+                            ('start_time', self.start_time),
+                            ('total_seconds', self.elapsed()),
+                            ('spans', OrderedDict((stage, OrderedDict([('seconds', seconds), ('calls', calls),
+                                                                       ('rss_delta_bytes', self.rss_deltas.get(stage))]))
+                                                  for stage, (seconds, calls) in self.spans.items())),
+                            ('counters', OrderedDict((k, to_builtin(v)) for k, v in self.counters.items())),
+                            ('rates', rates),
+                            ('rss_bytes', get_current_rss()),
+                            ('process_peak_rss_bytes', get_peak_rss()),
+                            ('process_peak_rss_children_bytes', get_peak_rss(True)),
+                            ('info', OrderedDict((k, to_builtin(v)) for k, v in self.info.items())),
+                            ])
+    
+    def to_json(self):
+        return json.dumps(self.report())
+    
+    def log_report(self, level=logging.INFO):
+        report = self.report()
+        lines = ["{} finished in {:.2f} s.".format(self.name, report['total_seconds'])]
+        for stage, span in report['spans'].items():
+            line = "    {:<24}{:>10.3f} s{:>8} calls".format(stage, span['seconds'], span['calls'])
+            if not span['rss_delta_bytes'] is None:
+                line += "{:>16,} bytes RSS".format(span['rss_delta_bytes'])
+            lines.append(line)
+        for counter, value in report['counters'].items():
+            lines.append("    {:<24}{:>14,}".format(counter, value))
+        for rate, value in report['rates'].items():
+            lines.append("    {:<24}{:>14.1f}".format(rate, value))
+        if not report['process_peak_rss_bytes'] is None:
+            lines.append("    {:<24}{:>14,}".format('process peak RSS bytes', report['process_peak_rss_bytes']))
+        logger.log(level, "\n".join(lines))
+
+def to_builtin(value):
+    """
+        numpy scalars to python numbers, so they can be written as json.
+    """
+    try:
+        return value.item()
+    except AttributeError:
+        return value
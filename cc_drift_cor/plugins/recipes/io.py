@@ -16,10 +16,10 @@ from PYME.recipes import processing
 from PYME.recipes.graphing import Plot
 
 import numpy as np
-from scipy import ndimage, interpolate
 from PYME.IO.image import ImageStack
 
 from functools import partial
+from ...engine import interpolate_drift, DriftTable
 
 import logging
 logger=logging.getLogger(__name__)
@@ -156,18 +156,6 @@ class InterpolateDrift(ModuleBase):
         namespace[self.output_drift_plot] = Plot(partial(generate_drift_plot, tIndex, drift, spl))
         namespace[self.output_drift_plot].plot()
         
-def interpolate_drift(tIndex, drift, degree_of_spline, smoothing_factor):
-    if smoothing_factor < 0:
-        smoothing_factor = None
-                
-    spl = list()
-    for i in range(drift.shape[1]):
-        spl_1d = interpolate.UnivariateSpline(tIndex, drift[:,i], k=degree_of_spline, s=smoothing_factor)
-        spl.append(spl_1d)
-    
-    return spl
-
-
 class LoadDriftandInterp(ModuleBase):
     """
     Loads drift data from file(s) and use them to create a spline interpolator (``scipy.interpolate.UnivariateSpline``).
@@ -192,6 +180,14 @@ class LoadDriftandInterp(ModuleBase):
         Degree of the smoothing spline.
     smoothing_factor : float
         Smoothing factor.
+    fuse_drift : String
+        Combines the drift of all files into a single interpolator per dimension when loading, so the cost
+        of applying the drift doesn't grow with the number of files.
+        Table evaluates the combined drift at every frame (linear between frames).
+        Spline fits a new interpolating spline to the combined drift at all loaded time points.
+        None (default) sums the splines of every file on each call.
+    save_path : File
+        Saves the combined drift (same format as ``DriftOutput``) if provided. Ignored if ``fuse_drift`` is None.
     """
     
     input_dummy = Input('input') # breaks GUI without this???
@@ -199,6 +195,8 @@ class LoadDriftandInterp(ModuleBase):
     load_paths = List(File, [""], 1)
     degree_of_spline = Int(3) # 1 for linear, 3 for cubic
     smoothing_factor = Float(-1) # 0 for no smoothing. set to negative for UnivariateSpline defulat
+    fuse_drift = Enum(['None', 'Table', 'Spline'])
+    save_path = File('')
 #    input_drift_raw = Input('drift_raw')
     output_drift_interpolator= Output('drift_interpolator')
     output_drift_plot = Output('drift_plot')
@@ -237,6 +235,23 @@ class LoadDriftandInterp(ModuleBase):
 #            spl_combined.append(lambda x: np.sum([f(x) for f in spl], axis=0))
             spl_combined.append(partial(spl_method, spl))
         
+        if self.fuse_drift != 'None':
+            if self.fuse_drift == 'Table':
+                t_fused = np.arange(np.floor(t_min), np.ceil(t_max) + 1)
+            else:
+                t_fused = np.unique(np.concatenate(tIndexes))
+            drift_fused = np.stack([f(t_fused) for f in spl_combined], axis=1)
+            
+            if self.fuse_drift == 'Table':
+                # combined splines still used outside of the table
+                spl_combined = [DriftTable(t_fused[0], drift_fused[:, i], f) for i, f in enumerate(spl_combined)]
+            else:
+                spl_combined = interpolate_drift(t_fused, drift_fused, min(self.degree_of_spline, len(t_fused)-1), 0)
+            
+            if self.save_path != "":
+                np.savez_compressed(self.save_path, tIndex=t_fused, drift=drift_fused)
+                print('saved')
+        
         namespace[self.output_drift_interpolator] = spl_combined
         
         # non essential, only for plotting out drift data
@@ -11,46 +11,16 @@ from PYME.recipes.graphing import Plot
 
 import numpy as np
 from PYME.IO import tabular
-from PYME.LMVis import renderers
-from scipy import ndimage, signal, interpolate
+from scipy import interpolate
 
 from functools import partial
 from .io import generate_drift_plot
 
-import multiprocessing
 import time
+import os
 
-def calc_fft_from_locs_helper(args):
-    """
-        Wrapper
-    """
-    return (args[0], calc_fft_from_locs(*args[1:]))
-
-# trying to avoid redunant code
-from .processing import calc_fft_from_image
-def calc_fft_from_locs(xyz, bxyz, cache_fft=None, filter_size=None):
-    # module level for multiprocessing
-    """
-        Creates histogram and applies Tukey filter.
-        Results passed to calc_fft_from_image in the base class
-    """
-    im = np.histogramdd(xyz, bxyz)[0]
-    
-    if not filter_size is None:
-        mask_shape = np.ones(len(im.shape), dtype=np.int)
-        for i, d in enumerate(im.shape):
-            if d <= 1:
-                continue
-            mask_shape[:] = 1
-            mask_shape[i] = d    
-            mask = np.empty(mask_shape)
-            mask.squeeze()[:] = signal.tukey(d, filter_size)
-            im *= mask
-        
-    del xyz, bxyz
-    
-    return calc_fft_from_image(im, cache_fft)
-    
+from ...engine import (calc_fft_from_locs_helper, calc_fft_from_locs, calc_bin_edges, plan_windows,
+                       plan_windows_by_density, calc_drift_lut, lookup_drift, OnlineRCCDriftEstimator)
 from .processing import RCCDriftCorrectionBase
 #@register_module('RCCDriftCorrection')
 class RCCDriftCorrection(RCCDriftCorrectionBase):
@@ -62,7 +32,7 @@ class RCCDriftCorrection(RCCDriftCorrectionBase):
     
     Runtime will vary hugely depending on size of dataset and settings.
     
-    ``cache_fft`` is necessary for large datasets.
+    ``cache_fft`` holds the ft images of large datasets that do not fit in memory.
         
     Inputs
     ------
@@ -78,7 +48,9 @@ class RCCDriftCorrection(RCCDriftCorrectionBase):
     output_drift_plot : Plot
         *Deprecated.*   Plot of drift results.
     output_cross_cor : ImageStack
-        Cross correlation images if ``debug_cor_file`` is not blank.
+        Cross correlation images if ``debug_cor_file`` is not blank. xy projections with ``project_z``.
+    output_cross_cor_xz : ImageStack
+        xz cross correlation images with ``project_z`` if ``debug_cor_file`` is not blank.
     outputName : Tabular
         *Deprecated.*   Drift-corrected dataset.
     
@@ -88,24 +60,53 @@ class RCCDriftCorrection(RCCDriftCorrectionBase):
         Setting for image construction. Step size between images
     window : Int
         Setting for image construction. Number of frames used per image. Should be equal or larger than step size.
+    window_mode : String
+        Setting for image construction. Fixed uses ``step`` and ``window``. Adaptive sizes back to back windows
+        to contain ``target_count`` localizations each, so sparse (e.g. bleached) parts of the dataset get longer windows.
+    target_count : Int
+        Setting for image construction. Number of localizations per image for adaptive windows.
     binsize : Float
         Setting for image construction. Pixel size.
     flatten_z : Bool
         Setting for image construction. Ignore z information if enabled.
+    project_z : Bool
+        Setting for image construction. For 3D data, measure x, y drift from xy histograms and z drift from xz histograms
+        instead of full 3D histograms. Much faster and uses less memory. Ignored if ``flatten_z`` is enabled.
     tukey_size : Float
         Setting for image construction. Shape parameter for Tukey filter (``scipy.signal.tukey``).
     cache_fft : File
-        Use file as disk cache if provided.
+        File for the ft images when they are stored on file. Blank keeps them in memory.
+    storage : String
+        Where the ft images are stored. Auto keeps them in memory if they fit in ``memory_limit``, otherwise on ``cache_fft``.
+    precision : String
+        Precision of the ft images. Auto uses single precision only if that is needed to keep them in memory.
+    memory_limit : Float
+        Approximate memory (MB) for the ft images and pair correlation, also limits the pairs correlated at once.
+        0 for half of the available memory.
     method : String
-        Redundant, mean, or direct cross-correlation.
+        Redundant, mean, or direct cross-correlation. IRLS uses the pairs of RCC, but pairs with residuals over
+        ``shift_max`` are down-weighted in a few reweighted solves instead of removed one by one.
     shift_max : Float
-        Rejection threshold for RCC.
+        Rejection threshold for RCC, down-weighting threshold for IRLS.
     corr_window : Float
         Size of correlation window. Frames are only compared if within this frame range. N/A for DCC.
+    pair_sampling : String
+        Window compares all frames within ``corr_window``. Geometric and Random add long range pairs
+        (``corr_window`` * 2, 4, 8, ... apart or about log2(n) random ones per frame), for long acquisitions
+        where all pairs (``corr_window`` 0) are too many. N/A for DCC.
+    weighting : String
+        Uniform solves for drift with all cross correlations equal. Quality weights each by how well its peak fits
+        a gaussian. Experimental: no gain over Uniform has been shown, including on simulated localizations
+        with a sparse stretch, so Uniform is the default.
     multiprocessing : Float
         Enables multiprocessing.
     debug_cor_file : File
-        Enables debugging. Use file as disk cache if provided.
+        Enables debugging. Cross correlations are stored in this file if provided.
+        With ``project_z``, those of the xz projections are stored next to it with an _xz suffix.
+    debug_cor_size : Int
+        Width of the cross correlations stored for debugging, cropped around the peak. 0 to store them whole.
+    debug_cor_every : Int
+        Only every nth pair is stored for debugging.
     """
     
     input_for_correction = Input('Localizations')
@@ -113,43 +114,40 @@ class RCCDriftCorrection(RCCDriftCorrectionBase):
     # redundant cross-corelation, mean cross-correlation, direction cross-correlation
     step = Int(2500)
     window = Int(2500)
+    window_mode = Enum(['Fixed', 'Adaptive'])
+    target_count = Int(20000)
     binsize = Float(30)
     flatten_z = Bool()
+    project_z = Bool()
     tukey_size = Float(0.25)
 
+    output_cross_cor_xz = Output('cross_cor_xz')
     outputName = Output('corrected_localizations')
     
     def calc_corr_drift_from_locs(self, x, y, z, t):
 
         # bin edges for histogram
-        bx = np.arange(x.min(), x.max() + self.binsize + 1, self.binsize)
-        by = np.arange(y.min(), y.max() + self.binsize + 1, self.binsize)
-        bz = np.arange(z.min(), z.max() + self.binsize + 1, self.binsize)
-        
-        # pad bin length to odd number so image size is even
-        if bx.shape[0] % 2 == 0:
-            bx = np.concatenate([bx, [bx[-1] + bx[1] - bx[0]]])
-        if by.shape[0] % 2 == 0:
-            by = np.concatenate([by, [by[-1] + by[1] - by[0]]])
-        if bz.shape[0] > 2 and bz.shape[0] % 2 == 0:
-            bz = np.concatenate([bz, [bz[-1] + bz[1] - bz[0]]])
+        bx = calc_bin_edges(x.min(), x.max(), self.binsize)
+        by = calc_bin_edges(y.min(), y.max(), self.binsize)
+        bz = calc_bin_edges(z.min(), z.max(), self.binsize, pad_single_bin=False)
         assert (bx.shape[0] % 2 == 1) and (by.shape[0] % 2 == 1), "Ops. Image not correctly padded to even size."
 
-        # start time of all windows, allow partial window near end of pipeline
-        time_values = np.arange(t.min(), t.max() + 1, self.step)
-        # 2d array, start and end time of windows
-        time_values = np.stack([time_values, np.clip(time_values + self.window, None, t.max())], axis=1)        
-        n_steps = time_values.shape[0]
-        # center time of center for returning. last window may have different spacing
-        time_values_mid = time_values.mean(axis=1)
-
         if (np.any(np.diff(t) < 0)): # in case pipeline is not sorted for whatever reason
             t_sort_arg = np.argsort(t)
             t = t[t_sort_arg]
             x = x[t_sort_arg]
             y = y[t_sort_arg]
             z = z[t_sort_arg]
-            
+        
+        # 2d array, start and end time of windows
+        if self.window_mode == 'Adaptive':
+            time_values = plan_windows_by_density(t, self.target_count)
+            print("{} adaptive windows, {:.0f} to {:.0f} frames long.".format(time_values.shape[0], np.ptp(time_values, axis=1).min(), np.ptp(time_values, axis=1).max()))
+        else:
+            time_values = plan_windows(t, self.step, self.window)
+        # center time of center for returning. last window may have different spacing
+        time_values_mid = time_values.mean(axis=1)
+        
         time_indexes = np.zeros_like(time_values, dtype=int)
         time_indexes[:, 0] = np.searchsorted(t, time_values[:, 0], side='left')
         time_indexes[:, 1] = np.searchsorted(t, time_values[:, 1]-1, side='right')
@@ -159,29 +157,69 @@ class RCCDriftCorrection(RCCDriftCorrectionBase):
 #        print(time_values_mid)
 #        print(time_indexes)
 
+        if self.project_z and bz.shape[0] > 2:
+            # lateral drift from xy histograms (z flattened into a single bin)
+            # and axial drift from xz histograms (y flattened into a single bin)
+            # cost is about 1/z_bins of the full 3d histograms
+            bz_flat = np.asarray([bz[0], bz[-1]])
+            by_flat = np.asarray([by[0], by[-1]])
+            
+            # xz cross correlations go to their own file so both projections can be inspected
+            if self.debug_cor_file == "":
+                debug_cor_file_xz = ""
+            else:
+                root, ext = os.path.splitext(self.debug_cor_file)
+                debug_cor_file_xz = root + "_xz" + ext
+            
+            shifts, coefs, weights = self.calc_corr_drift_from_histograms(x, y, z, bx, by, bz_flat, time_indexes, remove_invalid=False)
+            cc_image_xy = self._cc_image
+            print("{:.2f} s. Finished xy projection.".format(time.time() - self._start_time))
+            shifts_xz, _, weights_xz = self.calc_corr_drift_from_histograms(x, y, z, bx, by_flat, bz, time_indexes, remove_invalid=False,
+                                                                            debug_cor_file=debug_cor_file_xz)
+            self.trait_setq(**{"_cc_image": cc_image_xy, "_cc_image_xz": self._cc_image})
+            print("{:.2f} s. Finished xz projection.".format(time.time() - self._start_time))
+            
+            shifts[:, 2] = shifts_xz[:, 2]
+            if not weights is None:
+                # pair is only as good as its worse projection
+                weights = np.minimum(weights, weights_xz)
+            shifts, coefs, weights = self.remove_invalid_shifts(shifts, coefs, weights)
+        else:
+            shifts, coefs, weights = self.calc_corr_drift_from_histograms(x, y, z, bx, by, bz, time_indexes)
+            self.trait_setq(**{"_cc_image_xz": None})
+        
+        return time_values_mid, self.binsize * shifts, coefs, weights
+    
+    def calc_corr_drift_from_histograms(self, x, y, z, bx, by, bz, time_indexes, remove_invalid=True, debug_cor_file=None):
+        """
+            Bins localizations into one histogram per time window, calculates their ft
+            and feeds them to calc_corr_drift_from_ft_images (in base class).
+            debug_cor_file is passed on, None for ``debug_cor_file``.
+            Returns shifts in bins.
+        """
+        n_steps = time_indexes.shape[0]
+        
         # Fourier transformed (and binned) set of images to correlate against
         # one another
         # Crude way of swaping longest axis to the last for optimizing rfft performance.
         # Code changed for this is limited to this method.
         xyz = np.asarray([x, y, z])
-        bxyz = np.asarray([bx, by, bz])
+        bxyz = [bx, by, bz]
         dims_order = np.arange(len(xyz))
         dims_length = np.asarray([len(b) for b in bxyz])
         dims_largest_index = np.argmax(dims_length)
         dims_order[-1], dims_order[dims_largest_index] = dims_order[dims_largest_index], dims_order[-1]
         xyz = xyz[dims_order]
-        bxyz = bxyz[dims_order]
+        bxyz = [bxyz[i] for i in dims_order]
         dims_length = dims_length[dims_order]
         
-        # use memmap for caching if ft_cache is defined
-        if self.cache_fft == "":
-            ft_images = np.zeros((n_steps, dims_length[0]-1, dims_length[1]-1, (dims_length[2]-1)//2 + 1, ), dtype=np.complex)
-        else:
-            ft_images = np.memmap(self.cache_fft, dtype=np.complex, mode='w+', shape=(n_steps, dims_length[0]-1, dims_length[1]-1, (dims_length[2]-1)//2 + 1, ))
+        # in memory or memmap on cache_fft, whichever fits
+        ft_images = self.allocate_ft_images((n_steps, dims_length[0]-1, dims_length[1]-1, (dims_length[2]-1)//2 + 1, ))
+        cache_fft = self.cache_fft if isinstance(ft_images, np.memmap) else ""
         
         print(ft_images.shape)
-        print("{:,} bytes".format(ft_images.nbytes))
         
+        t_fft = time.time()
         print("{:.2f} s. About to start heavy lifting.".format(time.time() - self._start_time))
         
         # fill ft_images
@@ -190,10 +228,10 @@ class RCCDriftCorrection(RCCDriftCorrectionBase):
         if self.multiprocessing:
             dt = ft_images.dtype
             sh = ft_images.shape
-            args = [(i, xyz[:,slice(*ti)].T, bxyz, (self.cache_fft, dt, sh, i), self.tukey_size) for i, ti in enumerate(time_indexes)]
+            args = [(i, xyz[:,slice(*ti)].T, bxyz, (cache_fft, dt, sh, i), self.tukey_size) for i, ti in enumerate(time_indexes)]
 
             for i, (j, res) in enumerate(self._pool.imap_unordered(calc_fft_from_locs_helper, args)):                
-                if self.cache_fft == "":
+                if cache_fft == "":
                     ft_images[j] = res
                  
                 if ((i+1) % (n_steps//5) == 0):
@@ -211,18 +249,18 @@ class RCCDriftCorrection(RCCDriftCorrectionBase):
                     print("{:.2f} s. Completed calculating {} of {} total ft images.".format(time.time() - self._start_time, i+1, n_steps))
         
         print("{:.2f} s. Finished generating ft array.".format(time.time() - self._start_time))
-        print("{:,} bytes".format(ft_images.nbytes))
+        self.get_instrumentation().add_time('FFT generation', time.time() - t_fft)
+        self.count('FFTs', n_steps, 'FFT generation')
+        self.count_cache(ft_images)
         
-        shifts, coefs = self.calc_corr_drift_from_ft_images(ft_images)
+        shifts, coefs, weights = self.calc_corr_drift_from_ft_images(ft_images, remove_invalid, debug_cor_file)
         
         # clean up of ft_images, potentially really large array
         if isinstance(ft_images, np.memmap):
             ft_images.flush()
         del ft_images
         
-#        print(shifts)
-#        print(coefs)
-        return time_values_mid, self.binsize * shifts[:, dims_order], coefs
+        return shifts[:, dims_order], coefs, weights
 
     def _execute(self, namespace):
 #        from PYME.util import mProfile
@@ -232,8 +270,7 @@ class RCCDriftCorrection(RCCDriftCorrectionBase):
         print("Starting drift correction module.")
         
         if self.multiprocessing:
-            proccess_count = np.clip(multiprocessing.cpu_count()-1, 1, None)            
-            self.trait_setq(**{"_pool": multiprocessing.Pool(processes=proccess_count)})
+            self.trait_setq(**{"_pool": self.open_pool()})
         
         locs = namespace[self.input_for_correction]
 
@@ -245,46 +282,14 @@ class RCCDriftCorrection(RCCDriftCorrectionBase):
 #        mProfile.report()
 
         if self.multiprocessing:
-            self._pool.close()
-            self._pool.join()
+            self.close_pool(self._pool)
             
         # convert frame-to-frame drift to drift from origin
         shifts = np.cumsum(shifts, 0)
 
-        out = tabular.mappingFilter(namespace[self.input_for_mapping])
-        t_out = out['t']
         # cubic interpolate with no smoothing
-        dx = interpolate.CubicSpline(t_shift, shifts[:, 0])(t_out)
-        dy = interpolate.CubicSpline(t_shift, shifts[:, 1])(t_out)
-        dz = interpolate.CubicSpline(t_shift, shifts[:, 2])(t_out)
-
-        if 'dx' in out.keys():
-            # getting around oddity with mappingFilter
-            # addColumn adds a new column but also keeps the old column
-            # __getitem__ returns the new column
-            # but mappings usues the old column
-            # Wrap with another level of mappingFilter so the new column becomes the 'old column'
-            out.addColumn('dx', dx)
-            out.addColumn('dy', dy)
-            out.addColumn('dz', dz)
-            out = tabular.mappingFilter(out)
-#            out.mdh = namespace[self.input_localizations].mdh
-            out.setMapping('x', 'x + dx')
-            out.setMapping('y', 'y + dy')
-            out.setMapping('z', 'z + dz')
-        else:
-            out.addColumn('dx', dx)
-            out.addColumn('dy', dy)
-            out.addColumn('dz', dz)
-            out.setMapping('x', 'x + dx')
-            out.setMapping('y', 'y + dy')
-            out.setMapping('z', 'z + dz')
-
-        # propagate metadata, if present
-        try:
-            out.mdh = locs.mdh
-        except AttributeError:
-            pass
+        interpolators = [interpolate.CubicSpline(t_shift, shifts[:, i]) for i in range(shifts.shape[1])]
+        out = map_drift_corrected(namespace[self.input_for_mapping], interpolators)
 
         namespace[self.outputName] = out
         namespace[self.output_drift] = t_shift, shifts
@@ -293,6 +298,86 @@ class RCCDriftCorrection(RCCDriftCorrectionBase):
         namespace[self.output_drift_plot] = Plot(partial(generate_drift_plot, t_shift, shifts))
         
         namespace[self.output_cross_cor] = self._cc_image
+        namespace[self.output_cross_cor_xz] = self._cc_image_xz
+
+class DriftCorrectedSource(tabular.TabularBase):
+    """
+    Tabular source that applies drift when columns are accessed.
+    
+    Drift is evaluated once per frame into a lookup table and gathered per localization
+    by frame index, in chunks of ``chunk_size``. No full length drift columns are stored.
+    Falls back to calling the interpolators directly if t is not integer.
+    
+    Adds dx, dy, dz columns and replaces x, y, z with x + dx etc.
+    Existing dx, dy, dz columns (from previous corrections) are replaced,
+    their correction is already part of x, y, z.
+    """
+    
+    chunk_size = 1000000
+    
+    _drift_keys = ['dx', 'dy', 'dz']
+    _position_keys = ['x', 'y', 'z']
+    
+    def __init__(self, source, interpolators):
+        self._source = source
+        self._interpolators = interpolators
+        
+        t = source['t']
+        self._t_first, self._lut = calc_drift_lut(interpolators, t.min(), t.max())
+        self._length = t.shape[0]
+        del t
+        
+        # propagate metadata, if present
+        try:
+            self.mdh = source.mdh
+        except AttributeError:
+            pass
+    
+    def keys(self):
+        keys = list(self._source.keys())
+        return keys + [k for k in self._drift_keys[:len(self._interpolators)] if not k in keys]
+    
+    def __getitem__(self, keys):
+        key, sl = self._getKeySlice(keys)
+        
+        if key in self._drift_keys[:len(self._interpolators)]:
+            dim = self._drift_keys.index(key)
+            t = self._source['t', sl]
+            out = np.empty(t.shape)
+        elif key in self._position_keys[:len(self._interpolators)]:
+            dim = self._position_keys.index(key)
+            t = self._source['t', sl]
+            out = np.array(self._source[key, sl], dtype=float)
+        else:
+            return self._source[keys]
+        
+        for i in range(0, t.shape[0], self.chunk_size):
+            chunk = slice(i, i + self.chunk_size)
+            if key in self._drift_keys:
+                out[chunk] = self._lookup(t[chunk], dim)
+            else:
+                out[chunk] += self._lookup(t[chunk], dim)
+        
+        return out
+    
+    def _lookup(self, t, dim):
+        return lookup_drift(t, self._t_first, self._lut[:, dim], self._interpolators[dim])
+    
+    def __len__(self):
+        return self._length
+
+def map_drift_corrected(source, interpolators):
+    """
+        mappingFilter over DriftCorrectedSource, so columns can still be added (addColumn)
+        or mapped (setMapping) on the corrected dataset. x, y, z are already corrected.
+    """
+    out = tabular.mappingFilter(DriftCorrectedSource(source, interpolators))
+    try:
+        out.mdh = source.mdh
+    except AttributeError:
+        pass
+    return out
+
 
 #@register_module('ApplyDrift')
 class ApplyDrift(ModuleBase):
@@ -309,7 +394,7 @@ class ApplyDrift(ModuleBase):
     Outputs
     -------
     output_name : Tabular
-        Drift-corrected dataset.
+        Drift-corrected dataset. A ``mappingFilter``, more columns can be added or mapped on it.
     """
     
     input_localizations = Input('Localizations')
@@ -320,40 +405,6 @@ class ApplyDrift(ModuleBase):
     
     def execute(self, namespace):
 #        t_shift, shifts = namespace[self.input_drift]
-        out = tabular.mappingFilter(namespace[self.input_localizations])
-        out.mdh = namespace[self.input_localizations].mdh
-        
-        t_out = out['t']
-
-        dx = namespace[self.input_drift_interpolator][0](t_out)
-        dy = namespace[self.input_drift_interpolator][1](t_out)
-        dz = namespace[self.input_drift_interpolator][2](t_out)
-        
-        if 'dx' in out.keys():
-            # getting around oddity with mappingFilter
-            # addColumn adds a new column but also keeps the old column
-            # __getitem__ returns the new column
-            # but mappings usues the old column
-            # Wrap with another level of mappingFilter so the new column becomes the 'old column'
-            out.addColumn('dx', dx)
-            out.addColumn('dy', dy)
-            out.addColumn('dz', dz)
-            out = tabular.mappingFilter(out)
-            out.mdh = namespace[self.input_localizations].mdh
-            out.setMapping('x', 'x + dx')
-            out.setMapping('y', 'y + dy')
-            out.setMapping('z', 'z + dz')
-        else:
-            out.addColumn('dx', dx)
-            out.addColumn('dy', dy)
-            out.addColumn('dz', dz)
-            out.setMapping('x', 'x + dx')
-            out.setMapping('y', 'y + dy')
-            out.setMapping('z', 'z + dz')
-        
-        try:
-            out.mdh = self.input_localizations.mdh
-        except AttributeError:
-            pass
+        out = map_drift_corrected(namespace[self.input_localizations], namespace[self.input_drift_interpolator])
 
         namespace[self.output_name] = out
\ No newline at end of file
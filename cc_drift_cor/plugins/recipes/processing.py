@@ -16,20 +16,30 @@ from PYME.recipes import processing
 from PYME.recipes.graphing import Plot
 
 import numpy as np
-from scipy import ndimage, optimize, signal, interpolate
 from PYME.IO.image import ImageStack
+from PYME.IO import MetaDataHandler
 from PYME.IO.dataWrap import ListWrap
+from PYME.IO.DataSources.BaseDataSource import BaseDataSource
 
 import time
 
 from functools import partial
 from .io import generate_drift_plot
+from .instrumentation import Instrumentation
+from ...engine import (calc_median_kernel_shape, calc_tukey_mask, plan_tiles, preprocess_tile_helper, preprocess_tile,
+                       median_filter, calc_bin_slices, calc_block_reduce_dtype, block_reduce_helper, block_reduce,
+                       calc_shift, calc_fft_from_image, calc_fft_from_images_helper, calc_fft_from_images, prefetch_blocks,
+                       preprocess_bin_fft_helper, shift_frames_helper, shift_frames,
+                       plan_pairs, calc_pair_shifts, remove_invalid_shifts, solve_drift, reject_outliers,
+                       count_pairs, get_available_memory, plan_rcc_memory, plan_debug_cross_cor,
+                       QUALITY_METRICS, calc_pair_weights, solve_drift_robust, PAIR_SAMPLINGS)
 
 import os
 from os import path
 
 import gc
 import multiprocessing
+from collections import deque, OrderedDict
 
 import logging
 logger=logging.getLogger(__name__)
@@ -37,18 +47,106 @@ logger=logging.getLogger(__name__)
 class CacheCleanupModule(ModuleBase):
     """
     Workaround to handle cache file issues.
+    
+    Also times each run by stage (see ``instrumentation``). The report is logged at the end of the run, added
+    to the metadata of ImageStack outputs and, if ``report_path`` is provided, saved there as JSON.
     """
     
     _caches = list()
+    _shared_pool = None
+    report_path = File('')
     
     def execute(self, namespace, autofix=True):
 #        self.complete_metadata()
         self.cleanup_caches()
         self.fix_filepaths(autofix)
         
+        self.trait_setq(**{"_instrumentation": Instrumentation(self.__class__.__name__)})
         self._execute(namespace)
+        self._instrumentation.finish()
+        self.save_report(namespace)
         
         self.cleanup_caches()
+    
+    @staticmethod
+    def share_pool(pool, pool_size=None):
+        """
+            Makes all modules use pool instead of starting and closing their own (e.g. for batch runs).
+            None to go back to a pool per run.
+        """
+        if pool is None:
+            CacheCleanupModule._shared_pool = None
+        else:
+            CacheCleanupModule._shared_pool = (pool, pool_size if not pool_size is None else pool._processes)
+    
+    def get_pool_size(self):
+        if not CacheCleanupModule._shared_pool is None:
+            return CacheCleanupModule._shared_pool[1]
+        return int(np.clip(multiprocessing.cpu_count()-1, 1, None))
+    
+    def open_pool(self):
+        """
+            Worker pool for this run. The shared pool if set, otherwise a new one. Release with close_pool.
+        """
+        if not CacheCleanupModule._shared_pool is None:
+            return CacheCleanupModule._shared_pool[0]
+        return multiprocessing.Pool(processes=self.get_pool_size())
+    
+    def close_pool(self, pool):
+        if not CacheCleanupModule._shared_pool is None and pool is CacheCleanupModule._shared_pool[0]:
+            return
+        pool.close()
+        pool.join()
+    
+    def get_memory_limit(self):
+        """
+            Bytes the run may use, from the ``memory_limit`` parameter (MB) of the module.
+            0 for half of the currently available memory. None if that is unknown.
+        """
+        if self.memory_limit > 0:
+            return int(self.memory_limit * 2**20)
+        available = get_available_memory()
+        if available is None:
+            return None
+        return available // 2
+    
+    def get_instrumentation(self):
+        """
+            Instrumentation of the current run. Started here if the module is used outside of ``execute``.
+        """
+        if getattr(self, "_instrumentation", None) is None:
+            self.trait_setq(**{"_instrumentation": Instrumentation(self.__class__.__name__)})
+        return self._instrumentation
+    
+    def span(self, stage):
+        """
+            Context manager timing a stage of the current run.
+        """
+        return self.get_instrumentation().span(stage)
+    
+    def count(self, counter, value=1, stage=None):
+        self.get_instrumentation().count(counter, value, stage)
+    
+    def count_cache(self, array):
+        """
+            Adds array to 'bytes cached' if it is a file cache.
+        """
+        if isinstance(array, np.memmap):
+            self.count('bytes cached', array.nbytes)
+    
+    def save_report(self, namespace):
+        self._instrumentation.log_report()
+        report = self._instrumentation.to_json()
+        
+        for trait_name in self.editable_traits():
+            if self.trait(trait_name).is_trait_type(Output):
+                output = namespace.get(self.trait_get(trait_name)[trait_name])
+                if isinstance(output, ImageStack):
+                    output.mdh['Processing.Instrumentation.{}'.format(self.__class__.__name__)] = report
+        
+        if self.report_path != "":
+            with open(self.report_path, 'w') as f:
+                f.write(report)
                         
     def set_cache(self, cache_name, cache):
         try:
@@ -84,7 +182,7 @@ class CacheCleanupModule(ModuleBase):
             if trait.is_trait_type(File):
                 trait_value = self.trait_get(trait_name)[trait_name]
 #                print('{} is File: {}'.format(trait_name, trait_value))
-                if trait_value is not "":
+                if trait_value != "":
                     try:
                         with open(trait_value, 'w+'):
                             pass
@@ -123,6 +221,8 @@ class PreprocessingFilter(CacheCleanupModule):
     2. Replaces out of range values to defined values.
     
     3. Applies 2D Tukey filter to dampen potential edge artifacts.
+    
+    Steps 2 and 3 are done together, block by block, straight into ``output_dtype``.
         
     Inputs
     ------
@@ -135,7 +235,12 @@ class PreprocessingFilter(CacheCleanupModule):
     Parameters
     ----------
     median_filter_size : int
-        Median filter size (``scipy.ndimage.median_filter``).
+        Median filter size. 0 to disable.
+    median_filter_dims : String
+        3D kernel (x, y and neighbouring frames) or 2D kernel (each frame on its own).
+    median_method : String
+        Selection network is an exact min/max network over shifted copies of the data, much faster for small kernels.
+        ndimage uses ``scipy.ndimage.median_filter``. Auto picks the selection network for kernels of up to 125 pixels.
     threshold_lower : Float
         Pixels at this value or lower are replaced.
     clip_to_lower : Float
@@ -146,6 +251,12 @@ class PreprocessingFilter(CacheCleanupModule):
         Pixels above the upper threshold are replaced by this value.
     tukey_size : float
         Shape parameter for Tukey filter (``scipy.signal.tukey``).
+    multiprocessing : Bool
+        Enables multiprocessing. Tiles are filtered in parallel.
+    memory_budget : Float
+        Approximate memory (MB) used by tiles in flight. Sets the tile size.
+    output_dtype : String
+        Data type of the filtered images.
     cache_clip : File
         Use file as disk cache if provided.
     """
@@ -155,7 +266,12 @@ class PreprocessingFilter(CacheCleanupModule):
     threshold_upper = Float(65535)
     clip_to_upper = Float(0)
     median_filter_size = Int(3)
+    median_filter_dims = Enum(['3D', '2D'])
+    median_method = Enum(['Auto', 'Selection network', 'ndimage'])
     tukey_size = Float(0.25)
+    multiprocessing = Bool()
+    memory_budget = Float(1000)
+    output_dtype = Enum(['float32', 'float64'])
     cache_clip = File("clip_cache.bin")
     output_name = Output('clipped_images')
     
@@ -163,50 +279,100 @@ class PreprocessingFilter(CacheCleanupModule):
         self._start_time = time.time()
         ims = namespace[self.input_name]
         
-        dtype = ims.data[:,:,0].dtype
+        dtype = np.dtype(self.output_dtype)
+        images_shape = tuple(np.asarray(ims.data.shape[:3], dtype=np.int64))
         
-        # Somewhat arbitrary way to decide on chunk size 
-        chunk_size = 100000000 / ims.data.shape[0] / ims.data.shape[1] / dtype.itemsize
-        chunk_size = max(1, chunk_size)
-#        print chunk_size
-        
-        tukey_mask_x = signal.tukey(ims.data.shape[0], self.tukey_size)
-        tukey_mask_y = signal.tukey(ims.data.shape[1], self.tukey_size)
-        self._tukey_mask_2d = np.multiply(*np.meshgrid(tukey_mask_x, tukey_mask_y, indexing='ij'))[:,:,None]
+        self._tukey_mask_2d = calc_tukey_mask(ims.data.shape[:2], self.tukey_size, dtype)
 
         
         if self.cache_clip == "":
-            raw_data = np.empty(tuple(np.asarray(ims.data.shape[:3], dtype=np.long)), dtype=dtype)
+            raw_data = np.empty(images_shape, dtype=dtype)
         else:
-            raw_data = np.memmap(self.cache_clip, dtype=dtype, mode='w+', shape=tuple(np.asarray(ims.data.shape[:3], dtype=np.long)))
+            raw_data = np.memmap(self.cache_clip, dtype=dtype, mode='w+', shape=images_shape)
         
-        progress = 0.2 * ims.data.shape[2]
-        for f in np.arange(0, ims.data.shape[2], chunk_size):
-            raw_data[:,:,f:f+chunk_size] = self.applyFilter(ims.data[:,:,f:f+chunk_size])            
+        if self.multiprocessing:
+            pool_size = self.get_pool_size()
+        else:
+            pool_size = 1
+        
+        # each tile in flight holds the input, the median filtered copy and temporaries in float64
+        halo = np.asarray(self.get_median_kernel_shape()) // 2
+        max_tile_voxels = int(self.memory_budget * 2**20 / (2 * pool_size * 4 * 8))
+        if pool_size > 1:
+            # at least a couple of tiles per process
+            max_tile_voxels = min(max_tile_voxels, np.prod(images_shape) // (2 * pool_size))
+        tiles = plan_tiles(images_shape, halo, max_tile_voxels)
+        print("{:.2f} s. Filtering in {} tiles.".format(time.time() - self._start_time, len(tiles)))
+        
+        def get_args(tile):
+            outer, core = tile
+            data = ims.data[outer].reshape(tuple(sl.stop - sl.start for sl in outer))
+            tukey_mask = self._tukey_mask_2d[core[0], core[1]] if self.tukey_size > 0 else None
+            inner = tuple(slice(c.start - o.start, c.stop - o.start) for c, o in zip(core, outer))
+            return (core, data, inner, self.get_filter_args(tukey_mask))
+        
+        timings = list()
+        instrumentation = self.get_instrumentation()
+        # tiles completed and next progress report, same for the pool and serial paths
+        progress = [0, 0.2 * len(tiles)]
+        def store(core, res, timing):
+            raw_data[core] = res
+            timings.append(timing)
+            instrumentation.add_time('median filter', timing[0])
+            instrumentation.add_time('clip and taper', timing[1])
+            logger.debug("Tile {}: {:.3f} s median filter, {:.3f} s clip and Tukey filter.".format(core, *timing))
             
-            if (f+chunk_size >= progress):
+            progress[0] += 1
+            if (progress[0] >= progress[1]):
                 if isinstance(raw_data, np.memmap):
                     raw_data.flush()
-                progress += 0.2 * ims.data.shape[2]
-                print("{:.2f} s. Completed clipping {} of {} total images.".format(time.time() - self._start_time, min(f+chunk_size, ims.data.shape[2]), ims.data.shape[2]))
+                progress[1] += 0.2 * len(tiles)
+                print("{:.2f} s. Completed clipping {} of {} total tiles.".format(time.time() - self._start_time, progress[0], len(tiles)))
+        
+        with self.span('preprocessing'):
+            if pool_size > 1:
+                pool = self.open_pool()
+                pending = deque()
+                for tile in tiles:
+                    pending.append(pool.apply_async(preprocess_tile_helper, (get_args(tile),)))
+                    # limit number of tiles in flight to stay within the memory budget
+                    while len(pending) >= 2 * pool_size or (len(pending) > 0 and pending[0].ready()):
+                        store(*pending.popleft().get())
+                while len(pending) > 0:
+                    store(*pending.popleft().get())
+                self.close_pool(pool)
+            else:
+                for tile in tiles:
+                    store(*preprocess_tile_helper(get_args(tile)))
+            
+            if isinstance(raw_data, np.memmap):
+                raw_data.flush()
+        self.count_cache(raw_data)
+        self.count('frames', images_shape[2], 'preprocessing')
+        self.count('tiles', len(tiles))
+        print("{:.2f} s. Completed clipping {} total images.".format(time.time() - self._start_time, images_shape[2]))
+        timings = np.asarray(timings)
+        print("Per tile (mean / max): {:.3f} / {:.3f} s median filter, {:.3f} / {:.3f} s clip and Tukey filter.".format(
+                timings[:, 0].mean(), timings[:, 0].max(), timings[:, 1].mean(), timings[:, 1].max()))
         
         clipped_images = ImageStack(raw_data, mdh=ims.mdh)
         self.completeMetadata(clipped_images)
         
         namespace[self.output_name] = clipped_images
     
+    def get_median_kernel_shape(self):
+        return calc_median_kernel_shape(self.median_filter_size, self.median_filter_dims)
+    
+    def get_filter_args(self, tukey_mask=None):
+        return (self.get_median_kernel_shape(), self.median_method, self.threshold_lower, self.clip_to_lower,
+                self.threshold_upper, self.clip_to_upper, tukey_mask, self.output_dtype)
+    
     def applyFilter(self, data):
         """
             Performs the actual filtering here.
         """
-        if self.median_filter_size > 0:
-            data = ndimage.median_filter(data, self.median_filter_size, mode='nearest')
-        data[data >= self.threshold_upper] = self.clip_to_upper        
-        data[data <= self.threshold_lower] = self.clip_to_lower        
-        data -= self.clip_to_lower        
-        if self.tukey_size > 0:
-            data = data * self._tukey_mask_2d
-        return data
+        tukey_mask = self._tukey_mask_2d if self.tukey_size > 0 else None
+        return preprocess_tile(data, None, *self.get_filter_args(tukey_mask))[0]
 
     def completeMetadata(self, im):
         im.mdh['Processing.Clipping.LowerBounds'] = self.threshold_lower
@@ -219,8 +385,8 @@ class PreprocessingFilter(CacheCleanupModule):
 #@register_module('Binning')
 class Binning(CacheCleanupModule):
     """
-    Downsample 3D data (mean).
-    X, Y pixels that does't fill a full bin are dropped.
+    Downsample 3D data (mean, sum or max).
+    X, Y pixels that does't fill a full bin are dropped unless ``keep_partial_bins``.
     Pixels in the 3rd dimension can have a partially filled bin.
         
     Inputs
@@ -243,6 +409,14 @@ class Binning(CacheCleanupModule):
         Stopping index in y.
     binsize : Float
         Bin size.
+    mode : String
+        How pixels in a bin are combined. Mean gives float32 for integer data, sum a wider integer type.
+    keep_partial_bins : Bool
+        Keeps partially filled bins at the x, y edges instead of dropping those pixels.
+    multiprocessing : Bool
+        Enables multiprocessing. Slabs of frames are binned in parallel.
+    memory_budget : Float
+        Approximate memory (MB) used by slabs in flight. Sets the number of frames read at once.
     cache_bin : File
         Use file as disk cache if provided.
     """
@@ -255,6 +429,10 @@ class Binning(CacheCleanupModule):
 #    z_start = Int(0)
 #    z_end = Int(-1)
     binsize = List([1,1,1], minlen=3, maxlen=3)
+    mode = Enum(['mean', 'sum', 'max'])
+    keep_partial_bins = Bool(False)
+    multiprocessing = Bool()
+    memory_budget = Float(1000)
     cache_bin = File("binning_cache_2.bin")
     outputName = Output('binned_image')
     
@@ -262,243 +440,101 @@ class Binning(CacheCleanupModule):
         self._start_time = time.time()
         ims = namespace[self.inputName]
         
-        binsize = np.asarray(self.binsize, dtype=np.int)
+        binsize = np.asarray(self.binsize, dtype=np.int64)
 #        print (binsize)
 
-        # unconventional, end stop in inclusive
-        x_slice = np.arange(ims.data.shape[0]+1)[slice(self.x_start, self.x_end, 1)]
-        y_slice = np.arange(ims.data.shape[1]+1)[slice(self.y_start, self.y_end, 1)]
-        x_slice = x_slice[:x_slice.shape[0] // binsize[0] * binsize[0]]
-        y_slice = y_slice[:y_slice.shape[0] // binsize[1] * binsize[1]]
-#        print x_slice, len(x_slice)
-#        print y_slice, len(y_slice)
-        bincounts = np.asarray([len(x_slice)//binsize[0], len(y_slice)//binsize[1], -(-ims.data.shape[2]//binsize[2])], dtype=np.long)
-        
-        x_slice_ind = slice(x_slice[0], x_slice[-1]+1)
-        y_slice_ind = slice(y_slice[0], y_slice[-1]+1)
-        
-#        print (bincounts)
-        new_shape = np.stack([bincounts, binsize], -1).flatten()
-#        print(new_shape)
+        x_slice_ind, y_slice_ind, bincounts = calc_bin_slices(ims.data.shape[:3], self.x_start, self.x_end, self.y_start, self.y_end, binsize, self.keep_partial_bins)
+        x_length = x_slice_ind.stop - x_slice_ind.start
+        y_length = y_slice_ind.stop - y_slice_ind.start
         
         # need to wrap this to work for multiply color channel images
-#        binned_image = ims.data[:,:,:].reshape(new_shape)
-        dtype = ims.data[:,:,0].dtype
+        in_dtype = ims.data[:,:,0].dtype
+        dtype = calc_block_reduce_dtype(in_dtype, binsize, self.mode)
         
 #        print bincounts
-        binned_image = np.memmap(self.cache_bin, dtype=dtype, mode='w+', shape=tuple(np.asarray(bincounts, dtype=np.long)))
+        binned_image = np.memmap(self.cache_bin, dtype=dtype, mode='w+', shape=tuple(np.asarray(bincounts, dtype=np.int64)))
 #        print binned_image.shape
         
-        new_shape_one_chunk = new_shape.copy()
-        new_shape_one_chunk[4] = 1
-        new_shape_one_chunk[5] = -1
-#        print new_shape_one_chunk
-        progress = 0.2 * ims.data.shape[2]
-#        print 
-        for i, f in enumerate(np.arange(0, ims.data.shape[2], binsize[2])):
-            raw_data_chunk = ims.data[x_slice_ind,y_slice_ind,f:f+binsize[2]].squeeze()
-            
-            binned_image[:,:,i] = raw_data_chunk.reshape(new_shape_one_chunk).mean((1,3,5)).squeeze()
+        if self.multiprocessing:
+            pool_size = self.get_pool_size()
+        else:
+            pool_size = 1
+        
+        # whole bins of frames per slab. Slab in flight holds the input and about two accumulator copies
+        n_frames = ims.data.shape[2]
+        frame_bytes = x_length * y_length * (in_dtype.itemsize + 2 * np.dtype(dtype).itemsize)
+        bins_per_slab = int(self.memory_budget * 2**20 // (2 * pool_size * frame_bytes * binsize[2]))
+        bins_per_slab = int(np.clip(bins_per_slab, 1, bincounts[2]))
+        if pool_size > 1:
+            # at least a couple of slabs per process
+            bins_per_slab = max(1, min(bins_per_slab, -(-bincounts[2] // (2 * pool_size))))
+        frames_per_slab = bins_per_slab * binsize[2]
+        slabs = [(f, min(f + frames_per_slab, n_frames)) for f in range(0, n_frames, frames_per_slab)]
+        
+        def get_args(slab):
+            f_start, f_end = slab
+            data = ims.data[x_slice_ind, y_slice_ind, f_start:f_end].reshape((x_length, y_length, f_end - f_start))
+            return (f_start // binsize[2], data, binsize, self.mode)
+        
+        # slabs and frames completed and next progress report, same for the pool and serial paths
+        progress = [0, 0, 0.2 * len(slabs)]
+        def store(i, res):
+            binned_image[:, :, i:i+res.shape[2]] = res
             
-            if (f+binsize[2] >= progress):
+            progress[0] += 1
+            progress[1] = min(progress[1] + res.shape[2] * binsize[2], n_frames)
+            if (progress[0] >= progress[2]):
                 binned_image.flush()
-                progress += 0.2 * ims.data.shape[2]
-                print("{:.2f} s. Completed binning {} of {} total images.".format(time.time() - self._start_time, min(f+binsize[2], ims.data.shape[2]), ims.data.shape[2]))
+                progress[2] += 0.2 * len(slabs)
+                print("{:.2f} s. Completed binning {} of {} total images.".format(time.time() - self._start_time, progress[1], n_frames))
+        
+        with self.span('binning'):
+            if pool_size > 1:
+                pool = self.open_pool()
+                pending = deque()
+                for slab in slabs:
+                    pending.append(pool.apply_async(block_reduce_helper, (get_args(slab),)))
+                    # limit number of slabs in flight to stay within the memory budget
+                    while len(pending) >= 2 * pool_size or (len(pending) > 0 and pending[0].ready()):
+                        store(*pending.popleft().get())
+                while len(pending) > 0:
+                    store(*pending.popleft().get())
+                self.close_pool(pool)
+            else:
+                for slab in slabs:
+                    store(*block_reduce_helper(get_args(slab)))
+            
+            binned_image.flush()
+        self.count('frames', n_frames, 'binning')
+        self.count('slabs', len(slabs))
+        self.count_cache(binned_image)
+        print("{:.2f} s. Completed binning {} total images.".format(time.time() - self._start_time, n_frames))
 
 #        print(type(binned_image))
         im = ImageStack(binned_image, titleStub=self.outputName)
 #        print(type(im.data))
         im.mdh.copyEntriesFrom(ims.mdh)
         im.mdh['Parent'] = ims.filename
-        try:
-            ### Metadata must be logged correctly for the measured drift to be applicable to the source image
-            im.mdh['voxelsize.x'] *= binsize[0] 
-            im.mdh['voxelsize.y'] *= binsize[1]
-#            im.mdh['voxelsize.z'] *= binsize[2]
-            if 'recipe.binning' in im.mdh.keys():
-                im.mdh['recipe.binning'] = binsize * im.mdh['recipe.binning']
-            else:
-                im.mdh['recipe.binning'] = binsize
-        except:
-            pass
+        bin_metadata(im.mdh, binsize)
         
         namespace[self.outputName] = im
 
 
-def calc_shift_helper(args):
-    """
-        Wrappers needed for imap_unordered functions, etc.
-    """
-    return (args[0], calc_shift(*args[1:]))
-
-def calc_shift(index_1, index_2, origin=0, cache_fft=None, debug_cross_cor=None):
-    """
-        Are the actual ft images passed? If not, fetch them from file cache.
-    """
-    if not cache_fft is None and cache_fft[0] != "":
-        path, dtype, shape = cache_fft
-        ft_images = np.memmap(path, mode="r", dtype=dtype, shape=shape)
-        ft_1 = ft_images[index_1]
-        ft_2 = ft_images[index_2]
-        del ft_images
-    else:
-        ft_1 = index_1
-        ft_2 = index_2
-        
-    return calc_shift_direct(ft_1, ft_2, origin, debug_cross_cor)
-
-def calc_shift_direct(ft_1, ft_2, origin=0, debug_cross_cor=None):
-    """
-        Does the actual fft cross correlation.
-        Clean up - including cropping, thresholding, mask dilation.
-        Performs n dimension gaussian fit and returns center.
-    """
-    ft_1 = ndimage.fourier_gaussian(ft_1, 0.5)
-    ft_2 = ndimage.fourier_gaussian(ft_2, 0.5)
-    # module level for multiprocessing
-    tmp = ft_1 * np.conj(ft_2)    
-    del ft_1, ft_2
-    cross_corr = np.abs(np.fft.ifftshift(np.fft.irfftn(tmp)))
-    flat_dims = np.where(np.asarray(cross_corr.shape) == 1)[0]
-    if len(flat_dims) > 0:
-        cross_corr = cross_corr.squeeze()
-
-    if cross_corr.sum() == 0:
-        return origin * np.nan
-    
-#    threshold = np.ptp(cross_corr) * 0.5 + np.min(cross_corr)
-    
-    # cheat and striaght up crop out 3/4 of the image if it's large
-    # i.e. drift not allow to span 1/4 the image width
-    cropping = [slice(dim*6//16, -dim*6//16) if dim >= 16 else slice(None, None) for dim in cross_corr.shape]
-    cross_corr_mask = np.zeros(cross_corr.shape)
-    cross_corr_mask[cropping] = True
-    
-#    threshold = np.percentile(cross_corr[cropping], 95)
-    
-    threshold = np.ptp(cross_corr[cross_corr_mask.astype(bool)]) * 0.75 + np.min(cross_corr[cross_corr_mask.astype(bool)])
-    
-    cross_corr_mask *= cross_corr > threshold
-    
-    # difficult to adjust for complete despeckling. slow?
-#    cross_corr_mask = ndimage.binary_erosion(cross_corr_mask, structure=np.ones((1,)*cross_corr_mask.ndim), iterations=1, border_value=1, )
-#    cross_corr_mask = ndimage.binary_dilation(cross_corr_mask, structure=np.ones((3,)*cross_corr_mask.ndim), iterations=1, border_value=0, )
-#    print("mask {}".format(cross_corr_mask.sum()))
-    
-    labeled_image, labeled_counts = ndimage.label(cross_corr_mask)
-    if labeled_counts > 1: 
-        max_index = np.argmax(ndimage.mean(cross_corr_mask, labeled_image, range(1, labeled_counts+1))) + 1
-        cross_corr_mask = labeled_image == max_index
-    
-    cross_corr_mask = ndimage.binary_dilation(cross_corr_mask, structure=np.ones((5,)*cross_corr_mask.ndim), iterations=1, border_value=0, )
-    
-    cross_corr_thresholded = cross_corr * cross_corr_mask
-#    
-    if not debug_cross_cor is None:
-        i, (path, dtype, shape) = debug_cross_cor
-        cc_images = np.memmap(path, mode="r+", dtype=dtype, shape=shape)
-        cross_corr_thresholded_repadded = cross_corr_thresholded.view()
-        for d in flat_dims:
-            cross_corr_thresholded_repadded = np.expand_dims(cross_corr_thresholded_repadded, d)
-        short_axis = np.argmin(cross_corr_thresholded_repadded.shape)
-        cc_images[i] = cross_corr_thresholded_repadded.mean(axis=short_axis)
-        del cc_images
-    
-    dims = range(len(cross_corr.shape))
-    
-    # crop out masked area
-    bounds = np.zeros((len(dims), 2), dtype=np.int)
-    for d in dims:
-        dims_tmp = list(dims)
-        dims_tmp.remove(d)
-        mask_1d = np.any(cross_corr_mask, axis=tuple(dims_tmp))
-        bounds[d] = np.where(mask_1d)[0][[0, -1]] + [0, 1]
-        cross_corr_thresholded = cross_corr_thresholded.take(np.arange(*bounds[d]), axis=d)    
-
-#    offset = np.zeros(len(dims))
-#    for d, length in enumerate(cross_corr_thresholded.shape):
-#        dims_tmp = list(dims)
-#        dims_tmp.remove(d)
-#        offset[d] = np.sum(np.arange(length) * cross_corr_thresholded.sum(axis=tuple(dims_tmp)))
-#    offset /= cross_corr_thresholded.sum()
-#    offset += bounds[:, 0]
-    
-    cross_corr_thresholded[cross_corr_thresholded==0] = np.nan
-#    cross_corr_thresholded -= np.nanmin(cross_corr_thresholded)
-    cross_corr_thresholded /= np.nanmax(cross_corr_thresholded)
-
-#    ### Gaussian fit
-##    p0 = [np.nanmax(cross_corr_thresholded), np.nanmin(cross_corr_thresholded)]
-#    p0 = [1, 0]
-#    grids = list()
-#    for i, d in enumerate(cross_corr_thresholded.shape):
-#        grids.append(np.arange(d))
-#        p0.extend([(d-1)*0.5, 0.5*d])
-##    print grids
-##    print p0
-#    res = optimize.least_squares(guassian_nd_error, p0, args=(grids, cross_corr_thresholded))
-##    print res.x 
-    
-    ### Rbf peak finding
-    p0 = []
-    grids = list()
-    for i, d in enumerate(cross_corr_thresholded.shape):
-        grids.append(np.arange(d))
-        p0.append(0.5*d)
-    rbf_interpolator = build_rbf(grids, cross_corr_thresholded)
-    res = optimize.minimize(rbf_nd_error, p0, args=rbf_interpolator)
-    
-    offset = list()
-    for i in np.arange(len(cross_corr_thresholded.shape)):
-#        offset.append(res.x[2*i+2])
-        offset.append(res.x[i])
-    offset += bounds[:, 0]
-#    print offset
-    
-    if len(flat_dims) > 0:
-        offset = np.insert(offset, flat_dims, 0)
-        
-    return offset - origin
-
-def guassian_nd_error(p, dims, data):
-    """
-        Calculates mask size normalized error. Protected against nan's.
+def bin_metadata(mdh, binsize):
     """
-    mask = ~np.isnan(data)
-    return (data - gaussian_nd(p, dims))[mask]/mask.sum()
-
-def gaussian_nd(p, dims):
-    """
-        Creates n dimension gaussian with background.
-        p: tuple of variable length (A, bg, dim_0, sig_0, dim_1, sig_1, dim_2, sig_2, ...)
-        dims: 1d axis. need to match length with p
+        Updates voxelsize and recipe.binning of mdh in place.
     """
-    A, bg = p[:2]
-    dims_nd = np.meshgrid(*dims, indexing='ij')
-    exponent = 0
-    for i, dim in enumerate(dims_nd):
-#        print 2+2*i, 2+2*i+1
-        exponent += (dim-p[2+2*i])**2/(2*p[2+2*i+1]**2)
-    return A * np.exp(-exponent) + bg
-
-def build_rbf(grids, data):
-    grid_nd_list = np.meshgrid(*grids, indexing='ij')
-    data = data.flatten()
-    mask = ~np.isnan(data)
-    data = data[mask]
-    grid_nd_list_cleaned = [grid_nd.flatten()[mask] for grid_nd in grid_nd_list]
-    grid_nd_list_cleaned.append(data)
-    return interpolate.Rbf(*grid_nd_list_cleaned, function='multiquadric', epsilon=1.)
-
-def rbf_nd_error(p, rbf_interpolator):
-    return -rbf_interpolator(*p)
-
-def rbf_nd(rbf_interpolator, dims):
-    out_shape = [len(d) for d in dims]
-    dims_nd_list = np.meshgrid(*dims, indexing='ij')
-    dims_nd_list_cleaned = [dim_nd.flatten() for dim_nd in dims_nd_list]
-    return rbf_interpolator(*dims_nd_list_cleaned).reshape(out_shape)
-    
+    try:
+        ### Metadata must be logged correctly for the measured drift to be applicable to the source image
+        mdh['voxelsize.x'] *= binsize[0] 
+        mdh['voxelsize.y'] *= binsize[1]
+#        mdh['voxelsize.z'] *= binsize[2]
+        if 'recipe.binning' in mdh.keys():
+            mdh['recipe.binning'] = binsize * mdh['recipe.binning']
+        else:
+            mdh['recipe.binning'] = binsize
+    except:
+        pass
 
 #@register_module('RCCDriftCorrectionFromCachedFFT')
 class RCCDriftCorrectionBase(CacheCleanupModule):
@@ -512,12 +548,19 @@ class RCCDriftCorrectionBase(CacheCleanupModule):
     """
     
     cache_fft = File("rcc_cache.bin")
-    method = Enum(['RCC', 'MCC', 'DCC'])
-    # redundant cross-corelation, mean cross-correlation, direct cross-correlation
+    storage = Enum(['Auto', 'Memory', 'File'])
+    precision = Enum(['Auto', 'Double', 'Single'])
+    memory_limit = Float(0)
+    method = Enum(['RCC', 'MCC', 'DCC', 'IRLS'])
+    # redundant cross-corelation, mean cross-correlation, direct cross-correlation, RCC pairs solved robustly
     shift_max = Float(5)  # nm
     corr_window = Int(5)
+    pair_sampling = Enum(PAIR_SAMPLINGS)
+    weighting = Enum(['Uniform', 'Quality'])
     multiprocessing = Bool()
     debug_cor_file = File()
+    debug_cor_size = Int(32)
+    debug_cor_every = Int(1)
 
     output_drift = Output('drift')
     output_drift_plot = Output('drift_plot')
@@ -525,124 +568,143 @@ class RCCDriftCorrectionBase(CacheCleanupModule):
     # if debug_cor_file not blank, filled with imagestack of cross correlation
     output_cross_cor = Output('cross_cor')
 
-    def calc_corr_drift_from_ft_images(self, ft_images):
+    def plan_memory(self, ft_images_shape):
+        """
+            Chooses storage and precision of the ft images and the number of pairs correlated at once
+            (see ``plan_rcc_memory``) and logs the plan before any heavy lifting.
+        """
+        n_pairs = count_pairs(ft_images_shape[0], self.method, self.corr_window, self.pair_sampling)
+        pool_size = self.get_pool_size() if self.multiprocessing else 1
+        plan = plan_rcc_memory(ft_images_shape, n_pairs, self.get_memory_limit(), self.storage, self.precision, self.cache_fft != "", pool_size)
+        
+        print("Memory plan: ft images in {} as {}, {} pairs in flight on {} of {} workers. Estimated {:.0f} MB of {} MB.".format(
+            plan['storage'].lower(), plan['dtype'], plan['pairs_in_flight'], plan['workers'], pool_size,
+            plan['estimated_bytes'] / 2.**20, "unknown" if plan['memory_limit'] is None else "{:.0f}".format(plan['memory_limit'] / 2.**20)))
+        logger.info("Memory plan for {} pairs of {} ft images: {}".format(n_pairs, ft_images_shape, dict(plan)))
+        if not plan['fits']:
+            logger.warning("Estimated memory use of {:.0f} MB is over the limit of {:.0f} MB.".format(plan['estimated_bytes'] / 2.**20, plan['memory_limit'] / 2.**20))
+        
+        self.get_instrumentation().info['memory_plan'] = plan
+        self.trait_setq(**{"_memory_plan": plan})
+        return plan
+    
+    def allocate_ft_images(self, ft_images_shape):
+        """
+            Plans memory use and allocates the ft images, in memory or on ``cache_fft`` as planned.
+        """
+        plan = self.plan_memory(ft_images_shape)
+        if plan['storage'] == 'Memory':
+            return np.zeros(ft_images_shape, dtype=plan['dtype'])
+        else:
+            return np.memmap(self.cache_fft, dtype=plan['dtype'], mode='w+', shape=ft_images_shape)
+    
+    def calc_corr_drift_from_ft_images(self, ft_images, remove_invalid=True, debug_cor_file=None):
+        """
+            Cross correlates the pairs of ft images and returns their shifts.
+            debug_cor_file replaces ``debug_cor_file`` if not None, e.g. to keep the cross correlations of several runs.
+        """
         n_steps = ft_images.shape[0]
+        if debug_cor_file is None:
+            debug_cor_file = self.debug_cor_file
+        
+        # plan of allocate_ft_images, planned here if ft_images came from elsewhere
+        plan = getattr(self, "_memory_plan", None)
+        if plan is None:
+            plan = self.plan_memory(ft_images.shape)
+        self.trait_setq(**{"_memory_plan": None})
+        cache_fft = self.cache_fft if isinstance(ft_images, np.memmap) else ""
         
         # Matrix equation coefficient matrix
-        # Shape can be predetermined based on method
-        if self.method == "DCC":
-            coefs_size = n_steps - 1
-        elif self.corr_window > 0:
-            coefs_size = n_steps * self.corr_window - self.corr_window * (self.corr_window + 1) / 2
-        else:
-            coefs_size = n_steps * (n_steps-1) / 2
-        coefs_size = int(coefs_size)
-        coefs = np.zeros((coefs_size, n_steps-1))
-        shifts = np.zeros((coefs_size, 3))
-
-        counter = 0
-
-        ft_1_cache = list()
-        ft_2_cache = list()
-        autocor_shift_cache = list()
+        # Shape determined by method, stored as the time points of each pair (PairCoefficients)
+        pairs, coefs = plan_pairs(n_steps, self.method, self.corr_window, self.pair_sampling)
+        coefs_size = coefs.shape[0]
         
 #        print self.debug_cor_file
-        if not self.debug_cor_file == "":
-            cc_file_shape = [shifts.shape[0], ft_images.shape[1], ft_images.shape[2], (ft_images.shape[3]-1)*2]
+        if not debug_cor_file == "":
+            cc_shape = [ft_images.shape[1], ft_images.shape[2], (ft_images.shape[3]-1)*2]
             
             # flatten shortest dimension to reduce cross correlation to 2d images for easier debugging
-            min_arg = min(enumerate(cc_file_shape[1:]), key=lambda x: x[1])[0] + 1
-            cc_file_shape.pop(min_arg)
-            cc_file_args = (self.debug_cor_file, np.float, tuple(cc_file_shape))
-            cc_file = np.memmap(cc_file_args[0], dtype=cc_file_args[1], mode="w+", shape=cc_file_args[2])
-#            del cc_file
-            cc_args = zip(range(shifts.shape[0]), (cc_file_args, )*shifts.shape[0])
-        else:
-            cc_args = (None,) * shifts.shape[0]
-
-        # For each ft image, calculate correlation
-        for i in np.arange(0, n_steps-1):
-            if self.method == "DCC" and i > 0:
-                break
-            
-            ft_1 = ft_images[i, :, :]
+            cc_shape.pop(int(np.argmin(cc_shape)))
+            # only the peak neighbourhood of every nth pair is kept
+            cc_dtype, captured = plan_debug_cross_cor(coefs_size, cc_shape, self.debug_cor_size, self.debug_cor_every)
+            cc_store = np.memmap(debug_cor_file, dtype=cc_dtype, mode="w+", shape=(len(captured),))
+            cc_store['pair'] = captured
+            cc_store.flush()
             
-            autocor_shift = calc_shift(ft_1, ft_1)
-
-            for j in np.arange(i+1, n_steps):                
-                if (self.method != "DCC") and (self.corr_window > 0) and (j-i > self.corr_window):
-                    break
-                
-                ft_2 = ft_images[j, :, :]
-
-                coefs[counter, i:j] = 1
-                
-                # if multiprocessing, use cache when defined
-                if self.multiprocessing:
-                    # if reading ft_images from cache, replace ft_1 and ft_2 with their indices
-                    if not self.cache_fft == "":
-                        ft_1 = i
-                        ft_2 = j
-
-                    ft_1_cache.append(ft_1)
-                    ft_2_cache.append(ft_2)
-                    autocor_shift_cache.append(autocor_shift)
-                else:
-                    shifts[counter, :] = calc_shift(ft_1, ft_2, autocor_shift, None, cc_args[counter])
+            # workers reopen the file, written to directly otherwise
+            store = (debug_cor_file, cc_dtype, cc_store.shape) if self.multiprocessing else cc_store
+            cc_args = [None] * coefs_size
+            for slot, k in enumerate(captured):
+                cc_args[k] = (slot, store)
+        else:
+            cc_args = None
+        
+        def progress(n_done, n_total):
+            print("{:.2f} s. Completed calculating {} of {} total shifts.".format(time.time() - self._start_time, n_done, n_total))
+        
+        with self.span('pair correlation'):
+            # if multiprocessing, workers read ft_images from cache when stored on file
+            shifts, quality = calc_pair_shifts(ft_images, pairs, cache_fft, self._pool if self.multiprocessing else None, cc_args, progress, plan['pairs_in_flight'])
                     
-                    if ((counter+1) % (coefs_size//5) == 0):
-                        print("{:.2f} s. Completed calculating {} of {} total shifts.".format(time.time() - self._start_time, counter+1, coefs_size))
-                
-                counter += 1
-                
-        if self.multiprocessing:
-            args = zip(range(len(autocor_shift_cache)),
-                       ft_1_cache,
-                       ft_2_cache,
-                       autocor_shift_cache,
-                       len(ft_1_cache) * ((self.cache_fft, ft_images.dtype, ft_images.shape),),
-                       cc_args
-                       )
-            for i, (j, res) in enumerate(self._pool.imap_unordered(calc_shift_helper, args)):
-                shifts[j,] = res
-                
-                if ((i+1) % (coefs_size//5) == 0):
-                    print("{:.2f} s. Completed calculating {} of {} total shifts.".format(time.time() - self._start_time, i+1, coefs_size))
-                
         print("{:.2f} s. Finished calculating all shifts.".format(time.time() - self._start_time))
-        print("{:,} bytes".format(coefs.nbytes))
-        print("{:,} bytes".format(shifts.nbytes))
-        
-        if not self.debug_cor_file == "":
-            # move time axis for ImageStack
-            cc_file = np.moveaxis(cc_file, 0, 2)
-            self.trait_setq(**{"_cc_image": ImageStack(data=cc_file.copy())})
-            del cc_file
+        self.count('pairs', coefs_size, 'pair correlation')
+        self.get_instrumentation().info['coefs_bytes'] = coefs.nbytes
+        self.get_instrumentation().info['shifts_bytes'] = shifts.nbytes
+        for i, metric in enumerate(QUALITY_METRICS):
+            self.get_instrumentation().info['median ' + metric] = float(np.nanmedian(quality[:, i])) if coefs_size > 0 else None
+        
+        weights = calc_pair_weights(quality) if self.weighting == 'Quality' else None
+        
+        if not debug_cor_file == "":
+            # read from file only when viewed
+            cc_store.flush()
+            self.count('bytes cached', cc_store.nbytes, 'pair correlation')
+            self.trait_setq(**{"_cc_image": ImageStack(CrossCorrelationDataSource(cc_store, pairs), titleStub=self.output_cross_cor)})
         else:
             self.trait_setq(**{"_cc_image": None})
 
-        assert (np.all(np.any(coefs, axis=1))), "Coefficient matrix filled less than expected."
-
-        mask = np.where(~np.isnan(shifts).any(axis=1))[0]
-        if len(mask) < shifts.shape[0]:
-            print("Removed {} cross correlations due to bad/missing data?".format(shifts.shape[0]-len(mask)))            
-            coefs = coefs[mask, :]
-            shifts = shifts[mask, :]
-        
-        assert (coefs.shape[0] > 0) and (np.linalg.matrix_rank(coefs) == n_steps - 1), "Something went wrong with coefficient matrix. Not full rank."
+        if remove_invalid:
+            shifts, coefs, weights = self.remove_invalid_shifts(shifts, coefs, weights)
                 
-        return shifts, coefs  # shifts.shape[0] is n_steps - 1
+        return shifts, coefs, weights  # shifts.shape[0] is n_steps - 1, weights None unless weighting by quality
+    
+    def remove_invalid_shifts(self, shifts, coefs, weights=None):
+        """
+            Drops cross correlations with nan shifts and checks the coefficient matrix is still solvable.
+            Separate from calc_corr_drift_from_ft_images so shifts from several runs can be combined first.
+        """
+        n_shifts = shifts.shape[0]
+        shifts, coefs, weights = remove_invalid_shifts(shifts, coefs, weights)
+        if shifts.shape[0] < n_shifts:
+            print("Removed {} cross correlations due to bad/missing data?".format(n_shifts-shifts.shape[0]))            
+            self.count('invalid pairs', n_shifts-shifts.shape[0])
+        
+        return shifts, coefs, weights
 
-    def rcc(self, shift_max, t_shift, shifts, coefs, ):
+    def rcc(self, shift_max, t_shift, shifts, coefs, weights=None):
         """
             Should probably rename function.
             Takes cross correlation results and calculates shifts.
+            Least squares weighted per pair if weights are provided.
         """
         
         print("{:.2f} s. About to start solving shifts array.".format(time.time() - self._start_time))
+        
+        if self.method == "IRLS":
+            # Down-weight pairs with residual errors over shift_max instead of removing them
+            with self.span('solve'):
+                drifts, robust_weights, iterations = solve_drift_robust(coefs, shifts, shift_max, weights)
+            print("{:.2f} s. Robust solve finished after {} iterations.".format(time.time() - self._start_time, iterations))
+            self.count('solver iterations', iterations)
+            self.count('down-weighted pairs', int(np.sum(robust_weights < 1)))
+            
+            # pad with 0 drift for first time point
+            drifts = np.pad(drifts, [[1,0],[0,0]], 'constant', constant_values=0)
+            return t_shift, drifts
 
         # Estimate drift
-        drifts = np.matmul(np.linalg.pinv(coefs), shifts)
+        with self.span('solve'):
+            drifts = solve_drift(coefs, shifts, weights)
 #        print(t_shift)
 #        print(drifts)
         
@@ -650,34 +712,18 @@ class RCCDriftCorrectionBase(CacheCleanupModule):
         
         if self.method == "RCC":
         
-            # Calculate residual errors
-            residuals = np.matmul(coefs, drifts) - shifts
-            residuals_dist = np.linalg.norm(residuals, axis=1)
-    
-            # Sort and mask residual errors
-            residuals_arg = np.argsort(-residuals_dist)
-            residuals_arg = residuals_arg[residuals_dist[residuals_arg] > shift_max]
-    
-            # Remove coefs rows
-            # Descending from largest residuals to small
-            # Only if matrix remains full rank
-            coefs_temp = np.empty_like(coefs)
-            counter = 0
-            for i, index in enumerate(residuals_arg):
-                coefs_temp[:] = coefs
-                coefs_temp[index, :] = 0
-                if np.linalg.matrix_rank(coefs_temp) == coefs.shape[1]:
-                    coefs[:] = coefs_temp
-    #                print("index {} with residual of {} removed".format(index, residuals_dist[index]))
-                    counter += 1
-                else:
+            with self.span('rejection'):
+                # Remove pairs with residual errors over shift_max
+                kept, counter, complete = reject_outliers(coefs, shifts, drifts, shift_max)
+                if not complete:
                     print("Could not remove all residuals over shift_max threshold.")
-                    break
-            print("removed {} in total".format(counter))
-            
-            # Estimate drift again
-            drifts = np.matmul(np.linalg.pinv(coefs), shifts)
-            
+                print("removed {} in total".format(counter))
+                self.count('rejected pairs', counter)
+                
+                # Estimate drift again, removed pairs weighted 0
+                weights = kept if weights is None else weights * kept
+                drifts = solve_drift(coefs, shifts, weights)
+                
             print("{:.2f} s. RCC completed. Repeated solving shifts array.".format(time.time() - self._start_time))
 
         # pad with 0 drift for first time point
@@ -695,8 +741,7 @@ class RCCDriftCorrectionBase(CacheCleanupModule):
         print("Starting drift correction module.")
         
         if self.multiprocessing:
-            proccess_count = np.clip(multiprocessing.cpu_count()-1, 1, None)
-            self._pool = multiprocessing.Pool(processes=proccess_count)
+            self._pool = self.open_pool()
         
 #        mProfile.profileOn(['localisations.py'])
 
@@ -706,8 +751,7 @@ class RCCDriftCorrectionBase(CacheCleanupModule):
 #        mProfile.report()
 
         if self.multiprocessing:
-            self._pool.close()
-            self._pool.join()
+            self.close_pool(self._pool)
             
         # convert frame-to-frame drift to drift from origin
         shifts = np.cumsum(shifts, 0)
@@ -715,68 +759,6 @@ class RCCDriftCorrectionBase(CacheCleanupModule):
         namespace[self.output_drift] = t_shift, shifts
 
 
-def calc_fft_from_image_helper(args):
-    """
-        Wrapper for working with multiprocessing functions.
-    """
-    return (args[0], calc_fft_from_image(*args[1:]))
-
-def calc_fft_from_image(im, cache_fft=None):
-    # module level for multiprocessing
-    """
-        Reals real fft from passed or cached image
-    """
-    
-    if not cache_fft is None and cache_fft[0] != "":
-        path, dtype, shape, index = cache_fft
-        ft_images = np.memmap(path, mode="r+", dtype=dtype, shape=shape)
-        ft_images[index] = np.fft.rfftn(im)
-        ft_images.flush()
-        del ft_images
-        return
-    
-    return np.fft.rfftn(im)
-
-def shift_image_helper(args):
-    """
-        Wrapper for working with multiprocessing functions.
-    """
-    return (args[2], shift_image(*args))
-
-def shift_image(ft_image, shifts, index=None, cache_fft=None, cache_image=None, cache_kxyz=None):
-    """
-        Handles file caching issues.
-    """
-    if not cache_fft is None and cache_fft[0] != "":
-        path, dtype, shape = cache_fft
-        ft_images = np.memmap(path, mode="r", dtype=dtype, shape=shape)
-        ft_image = ft_images[index]
-        del ft_images
-        
-    if not cache_image is None and cache_image[0] != "":
-        path, dtype, shape = cache_image
-        images = np.memmap(path, mode="r+", dtype=dtype, shape=shape)
-        images[index] = shift_image_direct(ft_image, shifts, cache_kxyz)
-        images.flush()
-        del images
-        return
-    
-    return shift_image_direct(ft_image, shifts, cache_kxyz)
-
-def shift_image_direct(source_ft, shifts, kxyz=None):
-    """
-        Performs fft based sub-pixel shifts. Can accept cached kxyz
-    """
-    if kxyz is None:
-        kx = np.fft.fftfreq(source_ft.shape[0])
-        ky = np.fft.fftfreq(source_ft.shape[1])
-        kz = np.fft.fftfreq(source_ft.shape[2]) * 0.5
-        kx, ky, kz = np.meshgrid(kx, ky, kz, indexing='ij')
-    else:
-        kx, ky, kz = kxyz
-        
-    return np.abs(np.fft.irfftn(source_ft*np.exp(-2j*np.pi*(kx*shifts[0] + ky*shifts[1] + kz*shifts[2]))))
-
 #@register_module('RCCDriftCorrection')
 class RCCDriftCorrection(RCCDriftCorrectionBase):
     """
@@ -787,7 +769,7 @@ class RCCDriftCorrection(RCCDriftCorrectionBase):
     
     Runtime will vary hugely depending on image size and settings for cross-correlation.
     
-    ``cache_fft`` is necessary for large images.
+    ``cache_fft`` holds the ft images of large images that do not fit in memory.
         
     Inputs
     ------
@@ -805,17 +787,37 @@ class RCCDriftCorrection(RCCDriftCorrectionBase):
     Parameters
     ----------
     cache_fft : File
-        Use file as disk cache if provided.
+        File for the ft images when they are stored on file. Blank keeps them in memory.
+    storage : String
+        Where the ft images are stored. Auto keeps them in memory if they fit in ``memory_limit``, otherwise on ``cache_fft``.
+    precision : String
+        Precision of the ft images. Auto uses single precision only if that is needed to keep them in memory.
+    memory_limit : Float
+        Approximate memory (MB) for the ft images and pair correlation, also limits the pairs correlated at once.
+        0 for half of the available memory.
     method : String
-        Redundant, mean, or direct cross-correlation.
+        Redundant, mean, or direct cross-correlation. IRLS uses the pairs of RCC, but pairs with residuals over
+        ``shift_max`` are down-weighted in a few reweighted solves instead of removed one by one.
     shift_max : Float
-        Rejection threshold for RCC.
+        Rejection threshold for RCC, down-weighting threshold for IRLS.
     corr_window : Float
         Size of correlation window. Frames are only compared if within this frame range. N/A for DCC.
+    pair_sampling : String
+        Window compares all frames within ``corr_window``. Geometric and Random add long range pairs
+        (``corr_window`` * 2, 4, 8, ... apart or about log2(n) random ones per frame), for long acquisitions
+        where all pairs (``corr_window`` 0) are too many. N/A for DCC.
+    weighting : String
+        Uniform solves for drift with all cross correlations equal. Quality weights each by how well its peak fits
+        a gaussian. Experimental: no gain over Uniform has been shown, including on simulated localizations
+        with a sparse stretch, so Uniform is the default.
     multiprocessing : Float
         Enables multiprocessing.
     debug_cor_file : File
-        Enables debugging. Use file as disk cache if provided.
+        Enables debugging. Cross correlations are stored in this file if provided.
+    debug_cor_size : Int
+        Width of the cross correlations stored for debugging, cropped around the peak. 0 to store them whole.
+    debug_cor_every : Int
+        Only every nth pair is stored for debugging.
     """
     
     input_image = Input('input')
@@ -845,27 +847,27 @@ class RCCDriftCorrection(RCCDriftCorrectionBase):
                 cross_cor_dim = 2                
             elif nDims == 4:
                 # Assign T as cross_cor_dim if it exists, otherwise use Z
+                # additionalDims are the dims after x and y
                 pos_t = self.ims.data.additionalDims.find('T')
                 if pos_t != -1:
-                    cross_cor_dim = pos_t
+                    cross_cor_dim = 2 + pos_t
                 else:
                     pos_z = self.ims.data.additionalDims.find('Z')
                     if pos_z != -1:
-                        cross_cor_dim = pos_z
+                        cross_cor_dim = 2 + pos_z
                     else:
                         assert True, "This shouldn't happen. No T or Z defined in imagestack. Don't know what to do."                    
             else:
                 assert True, "This shouldn't happen. IF statements falling through."
                 
-            xyz_dims = range(0, 4)
+            xyz_dims = list(range(0, 4))
             xyz_dims.remove(cross_cor_dim)
             self.dims_order = [cross_cor_dim,] + xyz_dims
             
         def swapaxes(self, a, b):
-            a = max(self.dims_order) if a == -1 else a
-            b = max(self.dims_order) if b == -1 else b
-            a = self.dims_order.index(a)
-            b = self.dims_order.index(b)            
+            # a and b index the spatial dims, shape[1:]
+            a = a % 3 + 1
+            b = b % 3 + 1
             self.swaped_axes = (a-1, b-1)
             self.dims_order[a], self.dims_order[b] = self.dims_order[b], self.dims_order[a]
             
@@ -880,7 +882,7 @@ class RCCDriftCorrection(RCCDriftCorrectionBase):
 #            print [slices[sorting_order[i]] for i in np.arange(len(slices))]
 #            print type(self.ims.data)
 #            print self.ims.data.__class__
-            data = self.ims.data[[slices[sorting_order[i]] for i in np.arange(len(slices))]]
+            data = self.ims.data[tuple([slices[sorting_order[i]] for i in np.arange(len(slices))])]
             return np.swapaxes(data, *self.swaped_axes)            
         
         @property
@@ -889,6 +891,23 @@ class RCCDriftCorrection(RCCDriftCorrectionBase):
 #            print raw_shape
 #            print raw_shape[self.dims_order]
             return tuple(raw_shape[self.dims_order])                
+        
+        def read_block(self, i_start, i_end, out=None):
+            """
+                Reads images i_start to i_end in one call in the native order of the data,
+                then reorders the axes once for the whole block (into out if provided).
+            """
+            raw_shape = list(self.ims.data.shape)
+            raw_shape[self.dims_order[0]] = i_end - i_start
+            slices = [slice(None)] * len(raw_shape)
+            slices[self.dims_order[0]] = slice(i_start, i_end)
+            data = np.reshape(self.ims.data[tuple(slices)], raw_shape)
+            data = np.transpose(data, self.dims_order)
+            if out is None:
+                return np.ascontiguousarray(data)
+            out = out[:i_end - i_start]
+            out[:] = data
+            return out
     
     def calc_corr_drift_from_imagestack(self, ims):
         """
@@ -909,58 +928,78 @@ class RCCDriftCorrection(RCCDriftCorrectionBase):
         images_shape = images.shape
 #        print(images_shape)
         
-        ft_images_shape = tuple([long(i) for i in [images_shape[0], images_shape[1], images_shape[2], images_shape[3]//2 + 1]])
+        ft_images_shape = tuple([int(i) for i in [images_shape[0], images_shape[1], images_shape[2], images_shape[3]//2 + 1]])
         
-        # use memmap for caching if ft_cache is defined
-        if self.cache_fft == "":
-            ft_images = np.zeros(ft_images_shape, dtype=np.complex)
-        else:
-            try:
-                del ft_images
-            except:
-                pass
-            ft_images = np.memmap(self.cache_fft, dtype=np.complex, mode='w+', shape=ft_images_shape)
+        # in memory or memmap on cache_fft, whichever fits
+        ft_images = self.allocate_ft_images(ft_images_shape)
+        cache_fft = self.cache_fft if isinstance(ft_images, np.memmap) else ""
             
 #        print(ft_images.shape)
-        print("{:,} bytes".format(ft_images.nbytes))
         
+        t_fft = time.time()
         print("{:.2f} s. About to start heavy lifting.".format(time.time() - self._start_time))
+        
+        # about 64 MB of images per read, next block is read while the current one is transformed
+        block_size = int(np.clip(2**26 // (8 * np.prod(images_shape[1:])), 1, images_shape[0]))
+        blocks = [(i, min(i + block_size, images_shape[0])) for i in range(0, images_shape[0], block_size)]
+        buffers = [np.empty((block_size,) + tuple(images_shape[1:]), dtype=ims.data[:,:,0].dtype) for i in range(2)]
+        progress = 0.2 * images_shape[0]
             
         if self.multiprocessing:            
             
             dt = ft_images.dtype
             sh = ft_images.shape
-            args = [(i, images[i,:,:,:], (self.cache_fft, dt, sh, i)) for i in np.arange(images.shape[0])]
-
-            for i, (j, res) in enumerate(self._pool.imap_unordered(calc_fft_from_image_helper, args)):
-                if self.cache_fft == "":
-                    ft_images[j] = res
-                    
-                if ((i+1) % (images_shape[0]//5) == 0):
-                    print("{:.2f} s. Completed calculating {} of {} total ft images.".format(time.time() - self._start_time, i+1, images_shape[0]))
+            pool_size = self.get_pool_size()
+            
+            def store(j, res):
+                if not res is None:
+                    ft_images[j:j+res.shape[0]] = res
+            
+            pending = deque()
+            for i_start, block in prefetch_blocks(images.read_block, blocks, buffers):
+                # buffers are reused, copy before handing over to the pool
+                pending.append(self._pool.apply_async(calc_fft_from_images_helper, ((i_start, np.array(block), (cache_fft, dt, sh)),)))
+                while len(pending) >= 2 * pool_size or (len(pending) > 0 and pending[0].ready()):
+                    store(*pending.popleft().get())
+                
+                if (i_start + block.shape[0] >= progress):
+                    progress += 0.2 * images_shape[0]
+                    print("{:.2f} s. Completed reading {} of {} total images.".format(time.time() - self._start_time, i_start + block.shape[0], images_shape[0]))
+            
+            while len(pending) > 0:
+                store(*pending.popleft().get())
         else:
             
-            for i in np.arange(images.shape[0]):
+            for i_start, block in prefetch_blocks(images.read_block, blocks, buffers):
     
                 # .. we store ft of image                
-                ft_images[i] = calc_fft_from_image(images[i,:,:,:])
+                ft_images[i_start:i_start+block.shape[0]] = calc_fft_from_images(block)
                 
-                if ((i+1) % (images_shape[0]//5) == 0):
-                    print("{:.2f} s. Completed calculating {} of {} total ft images.".format(time.time() - self._start_time, i+1, images_shape[0]))
+                if (i_start + block.shape[0] >= progress):
+                    progress += 0.2 * images_shape[0]
+                    print("{:.2f} s. Completed calculating {} of {} total ft images.".format(time.time() - self._start_time, i_start + block.shape[0], images_shape[0]))
         
         print("{:.2f} s. Finished generating ft array.".format(time.time() - self._start_time))
-        print("{:,} bytes".format(ft_images.nbytes))
+        self.get_instrumentation().add_time('FFT generation', time.time() - t_fft)
+        self.count('FFTs', images_shape[0], 'FFT generation')
+        self.count_cache(ft_images)
         
-        shifts, coefs = self.calc_corr_drift_from_ft_images(ft_images)
+        shifts, coefs, weights = self.calc_corr_drift_from_ft_images(ft_images)
         
 ##        self._ft_images = ft_images
 ##        self._images = images
 #        self.set_cache("_ft_images", ft_images)
 #        self.set_cache("_images", images)
         
-        return np.arange(images.shape[0]), shifts[:, dims_order], coefs
+        return np.arange(images.shape[0]), shifts[:, dims_order], coefs, weights
     
     
+    def get_mdh(self, ims):
+        """
+            Metadata of the images the drift is measured on.
+        """
+        return ims.mdh
+    
     def _execute(self, namespace):
         
 #        from PYME.util import mProfile
@@ -969,8 +1008,7 @@ class RCCDriftCorrection(RCCDriftCorrectionBase):
         print("Starting drift correction module.")
         
         if self.multiprocessing:
-            proccess_count = np.clip(multiprocessing.cpu_count()-1, 1, None)
-            self._pool = multiprocessing.Pool(processes=proccess_count)
+            self._pool = self.open_pool()
         
         ims = namespace[self.input_image]
 
@@ -993,17 +1031,17 @@ class RCCDriftCorrection(RCCDriftCorrectionBase):
 #        del self.image_cache
         
         if self.multiprocessing:
-            self._pool.close()
-            self._pool.join()
+            self.close_pool(self._pool)
        
 #        print shifts
         
+        mdh = self.get_mdh(ims)
         try:
-            shifts[:, 0] *= ims.mdh.voxelsize.x
-            shifts[:, 1] *= ims.mdh.voxelsize.y
-            shifts[:, 2] *= ims.mdh.voxelsize.z
+            shifts[:, 0] *= mdh.voxelsize.x
+            shifts[:, 1] *= mdh.voxelsize.y
+            shifts[:, 2] *= mdh.voxelsize.z
             
-            if ims.mdh.voxelsize.units == 'um':
+            if mdh.voxelsize.units == 'um':
 #                print('um units')
                 shifts *= 1E3
         except:
@@ -1011,11 +1049,11 @@ class RCCDriftCorrection(RCCDriftCorrectionBase):
         
 #        print shifts
         
-        if 'recipe.binning' in ims.mdh.keys():
+        if 'recipe.binning' in mdh.keys():
 #            print 'binning detected'
-            t_shift = t_shift.astype(np.float)
-            t_shift *= ims.mdh['recipe.binning'][2]
-            t_shift += 0.5 * ims.mdh['recipe.binning'][2]
+            t_shift = t_shift.astype(np.float64)
+            t_shift *= mdh['recipe.binning'][2]
+            t_shift += 0.5 * mdh['recipe.binning'][2]
             
         namespace[self.output_drift] = t_shift, shifts
 #        print shifts
@@ -1026,10 +1064,217 @@ class RCCDriftCorrection(RCCDriftCorrectionBase):
         namespace[self.output_cross_cor] = self._cc_image
         
         
+#@register_module('StreamingRCCDriftCorrection')
+class StreamingRCCDriftCorrection(RCCDriftCorrection):
+    """
+    For 3D (XYT) image data. Combines ``PreprocessingFilter``, ``Binning`` and ``RCCDriftCorrection``.
+    
+    Frames are read once, filtered and binned in memory and the ft of each binned time point is stored
+    straight away. Same result as chaining the three modules, without writing and rereading
+    the filtered and binned images.
+        
+    Inputs
+    ------
+    input_image : ImageStack
+    
+    Outputs
+    -------
+    output_drift : Tuple of arrays
+        Drift results.
+    output_drift_plot : Plot
+        *Deprecated.*   Plot of drift results.
+    output_cross_cor : ImageStack
+        Cross correlation images if ``debug_cor_file`` is not blank.
+    
+    Parameters
+    ----------
+    median_filter_size : int
+        Median filter size. 0 to disable.
+    median_filter_dims : String
+        3D kernel (x, y and neighbouring frames) or 2D kernel (each frame on its own).
+    median_method : String
+        See ``PreprocessingFilter``.
+    threshold_lower : Float
+        Pixels at this value or lower are replaced.
+    clip_to_lower : Float
+        Pixels below the lower threshold are replaced by this value.
+    threshold_upper : Float
+        Pixels at this value or higher are replaced.
+    clip_to_upper : Float
+        Pixels above the upper threshold are replaced by this value.
+    tukey_size : float
+        Shape parameter for Tukey filter (``scipy.signal.tukey``).
+    x_start : int
+        Starting index in x for binning.
+    x_end : Float
+        Stopping index in x for binning.
+    y_start : Float
+        Starting index in y for binning.
+    y_end : Float
+        Stopping index in y for binning.
+    binsize : Float
+        Bin size.
+    bin_mode : String
+        How pixels in a bin are combined.
+    keep_partial_bins : Bool
+        Keeps partially filled bins at the x, y edges instead of dropping those pixels.
+    memory_budget : Float
+        Approximate memory (MB) used by blocks of frames in flight. Sets the number of frames read at once.
+    cache_fft : File
+        File for the ft images when they are stored on file. Blank keeps them in memory.
+    storage : String
+        Where the ft images are stored. Auto keeps them in memory if they fit in ``memory_limit``, otherwise on ``cache_fft``.
+    precision : String
+        Precision of the ft images. Auto uses single precision only if that is needed to keep them in memory.
+    memory_limit : Float
+        Approximate memory (MB) for the ft images and pair correlation, also limits the pairs correlated at once.
+        0 for half of the available memory.
+    method : String
+        Redundant, mean, or direct cross-correlation. IRLS uses the pairs of RCC, but pairs with residuals over
+        ``shift_max`` are down-weighted in a few reweighted solves instead of removed one by one.
+    shift_max : Float
+        Rejection threshold for RCC, down-weighting threshold for IRLS.
+    corr_window : Float
+        Size of correlation window. Frames are only compared if within this frame range. N/A for DCC.
+    pair_sampling : String
+        Window compares all frames within ``corr_window``. Geometric and Random add long range pairs
+        (``corr_window`` * 2, 4, 8, ... apart or about log2(n) random ones per frame), for long acquisitions
+        where all pairs (``corr_window`` 0) are too many. N/A for DCC.
+    weighting : String
+        Uniform solves for drift with all cross correlations equal. Quality weights each by how well its peak fits
+        a gaussian. Experimental: no gain over Uniform has been shown, including on simulated localizations
+        with a sparse stretch, so Uniform is the default.
+    multiprocessing : Float
+        Enables multiprocessing.
+    debug_cor_file : File
+        Enables debugging. Cross correlations are stored in this file if provided.
+    debug_cor_size : Int
+        Width of the cross correlations stored for debugging, cropped around the peak. 0 to store them whole.
+    debug_cor_every : Int
+        Only every nth pair is stored for debugging.
+    """
+    
+    threshold_lower = Float(0)
+    clip_to_lower = Float(0)
+    threshold_upper = Float(65535)
+    clip_to_upper = Float(0)
+    median_filter_size = Int(3)
+    median_filter_dims = Enum(['3D', '2D'])
+    median_method = Enum(['Auto', 'Selection network', 'ndimage'])
+    tukey_size = Float(0.25)
+    x_start = Int(0)
+    x_end = Int(-1)
+    y_start = Int(0)
+    y_end = Int(-1)
+    binsize = List([1,1,1], minlen=3, maxlen=3)
+    bin_mode = Enum(['mean', 'sum', 'max'])
+    keep_partial_bins = Bool(False)
+    memory_budget = Float(1000)
+    
+    def get_mdh(self, ims):
+        mdh = MetaDataHandler.NestedClassMDHandler(ims.mdh)
+        bin_metadata(mdh, np.asarray(self.binsize, dtype=np.int64))
+        return mdh
+    
+    def calc_corr_drift_from_imagestack(self, ims):
+        """
+            Streams frames through preprocessing, binning and fft.
+            Feeds fft images to calc_corr_drift_from_ft_images (in base class).
+            Returns shifts in (binned) pixels.
+        """
+        images_shape = tuple(np.asarray(ims.data.shape[:3], dtype=np.int64))
+        n_frames = images_shape[2]
+        binsize = np.asarray(self.binsize, dtype=np.int64)
+        x_slice_ind, y_slice_ind, bincounts = calc_bin_slices(images_shape, self.x_start, self.x_end, self.y_start, self.y_end, binsize, self.keep_partial_bins)
+        
+        median_kernel_shape = calc_median_kernel_shape(self.median_filter_size, self.median_filter_dims)
+        halo = median_kernel_shape[2] // 2
+        tukey_mask = calc_tukey_mask(images_shape[:2], self.tukey_size) if self.tukey_size > 0 else None
+        filter_args = (median_kernel_shape, self.median_method, self.threshold_lower, self.clip_to_lower,
+                       self.threshold_upper, self.clip_to_upper, tukey_mask, np.float32)
+        
+        # same layout as RCCDriftCorrection for XYT data, largest spatial dim last to maximize gain from the real ft
+        spatial_shape = np.asarray([bincounts[0], bincounts[1], 1])
+        dims_order = np.arange(3)
+        dims_largest_index = np.argmax(spatial_shape)
+        dims_order[-1], dims_order[dims_largest_index] = dims_order[dims_largest_index], dims_order[-1]
+        image_shape = spatial_shape[dims_order]
+        
+        ft_images_shape = tuple([int(i) for i in [bincounts[2], image_shape[0], image_shape[1], image_shape[2]//2 + 1]])
+        
+        # in memory or memmap on cache_fft, whichever fits
+        ft_images = self.allocate_ft_images(ft_images_shape)
+        
+        if self.multiprocessing:
+            pool_size = self.get_pool_size()
+        else:
+            pool_size = 1
+        
+        # whole bins of frames per block. Block in flight holds the raw frames, filtered copies and temporaries
+        frame_bytes = images_shape[0] * images_shape[1] * (ims.data[:,:,0].dtype.itemsize + 4 * 4)
+        bins_per_block = int(self.memory_budget * 2**20 // (2 * pool_size * frame_bytes * binsize[2]))
+        bins_per_block = int(np.clip(bins_per_block, 1, bincounts[2]))
+        if pool_size > 1:
+            bins_per_block = max(1, min(bins_per_block, -(-bincounts[2] // (2 * pool_size))))
+        blocks = [(b, min(b + bins_per_block, bincounts[2])) for b in range(0, bincounts[2], bins_per_block)]
+        
+        cache_fft = (self.cache_fft if isinstance(ft_images, np.memmap) else "", ft_images.dtype, ft_images.shape)
+        
+        def get_args(block):
+            f_start = block[0] * binsize[2]
+            f_end = min(block[1] * binsize[2], n_frames)
+            # extra frames for the median filter
+            outer = slice(max(f_start - halo, 0), min(f_end + halo, n_frames))
+            data = ims.data[:, :, outer].reshape(images_shape[:2] + (outer.stop - outer.start,))
+            inner = (slice(None), slice(None), slice(f_start - outer.start, f_end - outer.start))
+            return (block[0], data, inner, filter_args, (x_slice_ind, y_slice_ind), binsize, self.bin_mode, dims_order, cache_fft)
+        
+        # blocks completed and next progress report, same for the pool and serial paths
+        # workers writing to cache_fft return None, so progress is in blocks
+        progress = [0, 0.2 * len(blocks)]
+        def store(index, res):
+            if not res is None:
+                ft_images[index:index+res.shape[0]] = res
+            
+            progress[0] += 1
+            if (progress[0] >= progress[1]):
+                progress[1] += 0.2 * len(blocks)
+                print("{:.2f} s. Completed calculating ft images of {} of {} total blocks.".format(time.time() - self._start_time, progress[0], len(blocks)))
+        
+        t_fft = time.time()
+        print("{:.2f} s. About to start heavy lifting.".format(time.time() - self._start_time))
+        
+        if pool_size > 1:
+            pending = deque()
+            for block in blocks:
+                pending.append(self._pool.apply_async(preprocess_bin_fft_helper, (get_args(block),)))
+                # limit number of blocks in flight to stay within the memory budget
+                while len(pending) >= 2 * pool_size or (len(pending) > 0 and pending[0].ready()):
+                    store(*pending.popleft().get())
+            while len(pending) > 0:
+                store(*pending.popleft().get())
+        else:
+            for block in blocks:
+                store(*preprocess_bin_fft_helper(get_args(block)))
+        
+        if isinstance(ft_images, np.memmap):
+            ft_images.flush()
+        print("{:.2f} s. Finished generating ft array.".format(time.time() - self._start_time))
+        # preprocessing and binning run in the same workers, not timed separately
+        self.get_instrumentation().add_time('preprocess, bin and FFT', time.time() - t_fft)
+        self.count('FFTs', bincounts[2], 'preprocess, bin and FFT')
+        self.count('blocks', len(blocks))
+        self.count_cache(ft_images)
+        
+        shifts, coefs, weights = self.calc_corr_drift_from_ft_images(ft_images)
+        
+        return np.arange(bincounts[2]), shifts[:, dims_order], coefs, weights
+
+
 #@register_module('ShiftImage')
 class ShiftImage(CacheCleanupModule):
     """
-    Performs FT based image shift. Only shift in 2D.    
+    Performs FT based or real space interpolated image shift. Only shift in 2D. Use ``ShiftVolume`` for XYZT data.
         
     Inputs
     ------
@@ -1046,14 +1291,37 @@ class ShiftImage(CacheCleanupModule):
     ----------
     padding_multipler : Int
         Padding (as multiple of image size) added to the image before shifting to avoid artifacts.
+    shift_method : String
+        Fourier shifts the padded images in frequency space. Linear, Cubic and Lanczos (windowed sinc)
+        interpolate in real space, much faster for small drifts and without ringing.
+    batch_size : Int
+        Number of frames shifted per batch. 0 for automatic (about 256 MB of buffers per batch).
+    multiprocessing : Bool
+        Enables multiprocessing. Batches are shifted in parallel and written directly to ``cache_image``.
+    lazy : Bool
+        Shifts frames only when they are read (``DriftCorrectedDataSource``) instead of all frames up front.
+        ``multiprocessing``, ``batch_size`` and ``cache_image`` are not used.
+    lazy_cache_size : Int
+        Number of recently shifted frames kept in memory when ``lazy``.
+    storage : String
+        Where the shifted images are stored. Auto keeps them in memory if they fit in ``memory_limit``, otherwise on ``cache_image``.
+    memory_limit : Float
+        Approximate memory (MB) for the shifted images and batches in flight. 0 for half of the available memory.
     cache_image : File
-        Use file as disk cache if provided.
+        File for the shifted images when they are stored on file. Blank keeps them in memory.
     """
     
     input_image = Input('input')
 #    input_shift = Input('drift')
     input_drift_interpolator = Input('drift_interpolator')
     padding_multipler = Int(1)
+    shift_method = Enum(['Fourier', 'Linear', 'Cubic', 'Lanczos'])
+    batch_size = Int(0)
+    multiprocessing = Bool()
+    lazy = Bool(False)
+    lazy_cache_size = Int(32)
+    storage = Enum(['Auto', 'Memory', 'File'])
+    memory_limit = Float(0)
     
 #    ft_cache = File("ft_images.bin")
     cache_image = File("shifted_image.bin")
@@ -1070,55 +1338,65 @@ class ShiftImage(CacheCleanupModule):
         
         ims = namespace[self.input_image]
         
-        t_out = np.arange(ims.data.shape[2], dtype=np.float)
-        
-        if 'recipe.binning' in ims.mdh.keys():
-            t_out *= ims.mdh['recipe.binning'][2]
-            t_out += 0.5*ims.mdh['recipe.binning'][2]
-#        print t_out
+        t_out = self.get_t_out(ims.data.shape[2], ims.mdh)
 
         dx = namespace[self.input_drift_interpolator][0](t_out)
         dy = namespace[self.input_drift_interpolator][1](t_out)
         
-        shifted_images = self.shift_images(ims, np.stack([dx, dy], 1), ims.mdh)
-        
-        namespace[self.outputName] = ImageStack(shifted_images, titleStub = self.outputName, mdh=ims.mdh)
-            
-    def shift_images(self, ims, shifts, mdh):
+        if self.lazy:
+            shifts_in_pixels = self.get_shifts_in_pixels(np.stack([dx, dy], 1), ims.mdh)
+            source = DriftCorrectedDataSource(ims.data, shifts_in_pixels, self.shift_method,
+                                              self.padding_multipler, self.lazy_cache_size)
+            namespace[self.outputName] = ImageStack(source, titleStub = self.outputName, mdh=ims.mdh)
+            return
         
-        padding = np.stack((ims.data.shape[:2],)*2, -1) #2d only
-        padding *= self.padding_multipler
-        
-        padded_image_shape = np.asarray(ims.data.shape[:2], dtype=np.long) + padding.sum((1))
+        if self.multiprocessing:
+            self._pool_size = self.get_pool_size()
+            self._pool = self.open_pool()
         
-        dtype = ims.data[:,:,0].dtype
-        padded_image = np.zeros(padded_image_shape, dtype=dtype)
-               
-        kx = (np.fft.fftfreq(padded_image_shape[0])) 
-        ky = (np.fft.fftfreq(padded_image_shape[1]))
-#        kz = (np.fft.fftfreq(self._ft_images.shape[3])) * 0.5
-#        kx, ky, kz = np.meshgrid(kx, ky, kz, indexing='ij')
-        kx, ky = np.meshgrid(kx, ky, indexing='ij')
+        shifted_images = self.shift_images(ims, np.stack([dx, dy], 1), ims.mdh)
         
-        images_shape = np.asarray(ims.data.shape[:3], dtype=np.long)
-        images_shape = tuple(images_shape)
+        if self.multiprocessing:
+            self.close_pool(self._pool)
         
-        if self.cache_image == "":
-            shifted_images = np.empty(images_shape)
-        else:
-            shifted_images = np.memmap(self.cache_image, dtype=np.float, mode='w+', shape=images_shape)
+        namespace[self.outputName] = ImageStack(shifted_images, titleStub = self.outputName, mdh=ims.mdh)
             
-#        print(shifts.shape)
-#        print(kx.shape, ky.shape)
+    def get_images_shape(self, ims):
+        """
+            Spatial dims then frames.
+        """
+        return tuple(np.asarray(ims.data.shape[:3], dtype=np.int64))
+    
+    def get_frames(self, ims, i_start, i_end):
+        """
+            Frames i_start to i_end as array of spatial dims then frames.
+        """
+        images_shape = self.get_images_shape(ims)
+        return ims.data[:, :, i_start:i_end].reshape(images_shape[:-1] + (i_end - i_start,))
+    
+    def get_t_out(self, n_frames, mdh):
+        """
+            Time of each frame, center of the binned frames if the data was binned in T.
+        """
+        t_out = np.arange(n_frames, dtype=np.float64)
         
-#        print shifts
+        if 'recipe.binning' in mdh.keys():
+            # T is the last binned dim
+            t_out *= mdh['recipe.binning'][-1]
+            t_out += 0.5*mdh['recipe.binning'][-1]
+        
+        return t_out
+    
+    def get_shifts_in_pixels(self, shifts, mdh):
+        """
+            Converts drift (nm) to pixels. One column per spatial dim (x, y, z).
+        """
         shifts_in_pixels = np.copy(shifts)
         
         try:
-            shifts_in_pixels[:, 0] = shifts[:, 0] / mdh.voxelsize.x
-            shifts_in_pixels[:, 1] = shifts[:, 1] / mdh.voxelsize.y
-#            shifts_in_pixels[:, 2] = shifts[:, 2] / mdh.voxelsize.z
-            
+            for i, dim in enumerate(['x', 'y', 'z'][:shifts.shape[1]]):
+                shifts_in_pixels[:, i] = shifts[:, i] / getattr(mdh.voxelsize, dim)
+        
 #            shifts_in_pixels[np.isnan(shifts_in_pixels)] = 0
             
 #            print mdh
@@ -1129,37 +1407,280 @@ class ShiftImage(CacheCleanupModule):
             Warning("Failed at converting drift in pixels to real distances")
             repr(e)
         
-#        print shifts_in_pixels
-            
-        for i in np.arange(ims.data.shape[2]):
-#            print i
-            
-            padded_image[padding[0,0]:padding[0,0]+ims.data.shape[0],padding[1,0]:padding[1,0]+ims.data.shape[1]] = ims.data[:,:,i].squeeze()
+        return shifts_in_pixels
+    
+    def allocate_shifted_images(self, images_shape):
+        """
+            Shifted images in memory or memmap on ``cache_image``, whichever fits (see ``storage``).
+        """
+        output_bytes = int(np.prod(images_shape)) * np.dtype(np.float64).itemsize
+        # batches are about 256 MB each, 2 per worker in flight
+        batches_bytes = 2 * (self.get_pool_size() if self.multiprocessing else 1) * 2**28
+        memory_limit = self.get_memory_limit()
+        
+        if self.cache_image == "" or self.storage == 'Memory':
+            storage = 'Memory'
+        elif self.storage == 'File' or not (memory_limit is None or output_bytes + batches_bytes <= memory_limit):
+            storage = 'File'
+        else:
+            storage = 'Memory'
+        
+        print("Memory plan: shifted images in {}. Estimated {:.0f} MB of {} MB.".format(
+            storage.lower(), (output_bytes + batches_bytes) / 2.**20, "unknown" if memory_limit is None else "{:.0f}".format(memory_limit / 2.**20)))
+        self.get_instrumentation().info['memory_plan'] = OrderedDict([('storage', storage),
+                                                                      ('output_bytes', output_bytes),
+                                                                      ('batches_bytes', batches_bytes),
+                                                                      ('memory_limit', memory_limit),
+                                                                      ])
+        
+        if storage == 'Memory':
+            return np.empty(images_shape)
+        else:
+            return np.memmap(self.cache_image, dtype=np.float64, mode='w+', shape=images_shape)
+    
+    def shift_images(self, ims, shifts, mdh):
+        
+        images_shape = self.get_images_shape(ims)
+        spatial_shape = np.asarray(images_shape[:-1])
+        
+        padding = spatial_shape * self.padding_multipler
+        padded_image_shape = spatial_shape + 2 * padding
+        
+        shifted_images = self.allocate_shifted_images(images_shape)
             
-            ft_image = np.fft.fftn(padded_image)
+#        print shifts
+        shifts_in_pixels = self.get_shifts_in_pixels(shifts, mdh)
+        
+#        print shifts_in_pixels
+        
+        if self.batch_size > 0:
+            batch_size = self.batch_size
+        elif self.shift_method == 'Fourier':
+            # about 256 MB of ft per batch
+            batch_size = int(np.clip(2**28 // (16 * np.prod(padded_image_shape[:-1]) * (padded_image_shape[-1]//2 + 1)), 1, 64))
+        else:
+            # about 256 MB of input, output and temporary frames
+            batch_size = int(np.clip(2**28 // (32 * np.prod(spatial_shape)), 1, 256))
+        
+        n_frames = images_shape[-1]
+        batches = [(i, min(i + batch_size, n_frames)) for i in range(0, n_frames, batch_size)]
+        cache_image = (self.cache_image if isinstance(shifted_images, np.memmap) else "", shifted_images.dtype, shifted_images.shape)
+        progress = 0.2 * n_frames
+        t_apply = time.time()
+        
+        if self.multiprocessing:
+            # batches completed and next progress report, workers writing to cache_image return None
+            completed = [0, 0.2 * len(batches)]
+            def store(j, res):
+                if not res is None:
+                    shifted_images[..., j:j+res.shape[-1]] = res
+                
+                completed[0] += 1
+                if (completed[0] >= completed[1]):
+                    completed[1] += 0.2 * len(batches)
+                    print("{:.2f} s. Completed shifting {} of {} total batches.".format(time.time() - self._start_time, completed[0], len(batches)))
             
-            data_shifted = shift_image_direct_rough(ft_image, shifts_in_pixels[i], kxy=(kx, ky))
+            pending = deque()
+            for i_start, i_end in batches:
+                args = (i_start, self.get_frames(ims, i_start, i_end), shifts_in_pixels[i_start:i_end], self.shift_method, padding, cache_image)
+                pending.append(self._pool.apply_async(shift_frames_helper, (args,)))
+                
+                # limit number of batches in flight so frames are not all read into memory at once
+                while len(pending) >= 2 * self._pool_size or (len(pending) > 0 and pending[0].ready()):
+                    store(*pending.popleft().get())
             
-            shifted_images[:,:,i] = data_shifted[padding[0,0]:padding[0,0]+ims.data.shape[0],padding[1,0]:padding[1,0]+ims.data.shape[1]]
+            while len(pending) > 0:
+                store(*pending.popleft().get())
             
-            if ((i+1) % (shifted_images.shape[-1]//5) == 0):
-                if isinstance(shifted_images, np.memmap):
-                    shifted_images.flush()
-                print("{:.2f} s. Completed shifting {} of {} total images.".format(time.time() - self._start_time, i+1, shifted_images.shape[-1]))            
+            print("{:.2f} s. Completed shifting {} total images.".format(time.time() - self._start_time, n_frames))
+        else:
+            for i_start, i_end in batches:
+                frames = self.get_frames(ims, i_start, i_end)
+                shifted_images[..., i_start:i_end] = shift_frames(frames, shifts_in_pixels[i_start:i_end], self.shift_method, padding)
+                
+                if (i_end >= progress):
+                    if isinstance(shifted_images, np.memmap):
+                        shifted_images.flush()
+                    progress += 0.2 * n_frames
+                    print("{:.2f} s. Completed shifting {} of {} total images.".format(time.time() - self._start_time, i_end, n_frames))
+        
+        if isinstance(shifted_images, np.memmap):
+            shifted_images.flush()
+        self.get_instrumentation().add_time('apply', time.time() - t_apply)
+        self.count('frames', n_frames, 'apply')
+        self.count('batches', len(batches))
+        self.count_cache(shifted_images)
         
         return shifted_images
+
+
+#@register_module('ShiftVolume')
+class ShiftVolume(ShiftImage):
+    """
+    Performs FT based or real space interpolated shift of volumes in 3D (XYZ) for each time point of XYZT data.
+    
+    Volumes are read, shifted and written out in batches so the whole dataset is never loaded into memory.
+    Uses z drift if the interpolator has 3 dimensions.
+        
+    Inputs
+    ------
+    input_image : ImageStack
+        XYZT images with drift.
+    input_drift_interpolator : 
+        Returns drift when called with frame number / time.
+    
+    Outputs
+    -------
+    outputName : ImageStack
+        XYZT images.
+    
+    Parameters
+    ----------
+    padding_multipler : Int
+        Padding (as multiple of volume size) added to the volume before shifting to avoid artifacts.
+    shift_method : String
+        Fourier shifts the padded volumes in frequency space. Linear, Cubic and Lanczos (windowed sinc)
+        interpolate in real space, much faster for small drifts and without ringing.
+    batch_size : Int
+        Number of volumes shifted per batch. 0 for automatic (about 256 MB of buffers per batch).
+    multiprocessing : Bool
+        Enables multiprocessing. Batches are shifted in parallel and written directly to ``cache_image``.
+    lazy : Bool
+        Not supported for volumes. Raises an error if set.
+    cache_image : File
+        Use file as disk cache if provided.
+    """
+    
+    cache_image = File("shifted_volume.bin")
+    
+    def _execute(self, namespace):
+        self._start_time = time.time()
+        
+        ims = namespace[self.input_image]
+        interpolator = namespace[self.input_drift_interpolator]
+        
+        if self.lazy:
+            raise Exception("lazy is not supported for volumes. Use ShiftImage or disable lazy.")
+        
+        t_out = self.get_t_out(self.get_images_shape(ims)[-1], ims.mdh)
+        
+        drift = [interpolator[i](t_out) for i in range(min(len(interpolator), 3))]
+        if len(drift) < 3:
+            drift.append(np.zeros_like(t_out))
+        
+        if self.multiprocessing:
+            self._pool_size = self.get_pool_size()
+            self._pool = self.open_pool()
+        
+        shifted_images = self.shift_images(ims, np.stack(drift, 1), ims.mdh)
+        
+        if self.multiprocessing:
+            self.close_pool(self._pool)
+        
+        namespace[self.outputName] = ImageStack(shifted_images, titleStub = self.outputName, mdh=ims.mdh)
+    
+    def get_dims_order(self, ims):
+        """
+            Data axes in XYZT order.
+        """
+        if ims.data.nTrueDims != 4:
+            raise Exception("Expects XYZT data. Use ShiftImage for 2D data.")
+        
+        pos_z = ims.data.additionalDims.find('Z')
+        pos_t = ims.data.additionalDims.find('T')
+        if pos_z == -1 or pos_t == -1:
+            raise Exception("Expects XYZT data. Found additional dims {}.".format(ims.data.additionalDims))
+        
+        return [0, 1, 2 + pos_z, 2 + pos_t]
+    
+    def get_images_shape(self, ims):
+        """
+            XYZT
+        """
+        raw_shape = np.asarray(ims.data.shape, dtype=np.int64)
+        return tuple(raw_shape[self.get_dims_order(ims)])
+    
+    def get_frames(self, ims, i_start, i_end):
+        """
+            Volumes i_start to i_end as XYZT array.
+        """
+        dims_order = self.get_dims_order(ims)
+        slices = [slice(None)] * 4
+        slices[dims_order[3]] = slice(i_start, i_end)
+        volumes = np.asarray(ims.data[tuple(slices)])
+        if dims_order[2] > dims_order[3]:
+            volumes = np.swapaxes(volumes, 2, 3)
+        return volumes
+    
+class CrossCorrelationDataSource(BaseDataSource):
+    """
+        Read only view of the debug store of cross correlations (see ``plan_debug_cross_cor``), one slice per stored pair.
+        Slices are read from the file only when requested.
+        pairs: (i, j) of all pairs, those of the stored slices are kept in ``pairs``, their crop corners in ``corners``.
+    """
+    moduleName = 'CrossCorrelationDataSource'
+    
+    def __init__(self, store, pairs):
+        self.store = store
+        self.pairs = [tuple(pairs[k]) for k in store['pair']]
+        self.corners = np.array(store['corner'])
+    
+    def getSlice(self, ind):
+        return np.asarray(self.store['image'][ind], dtype=np.float64)
+    
+    def getSliceShape(self):
+        return self.store.dtype['image'].shape
+    
+    def getNumSlices(self):
+        return self.store.shape[0]
+    
+    def getEvents(self):
+        return []
+    
+    def isComplete(self):
+        return True
+
+
+class DriftCorrectedDataSource(BaseDataSource):
+    """
+        Wraps a 2D (XYT) data source and shifts frames only when they are requested.
+        Recently shifted frames are kept in a small LRU cache so browsing back and forth is cheap.
+        shifts_in_pixels: (frames x 2)
+    """
+    moduleName = 'DriftCorrectedDataSource'
+    
+    def __init__(self, datasource, shifts_in_pixels, shift_method='Fourier', padding_multipler=1, cache_size=32):
+        self.datasource = datasource
+        self.shifts_in_pixels = shifts_in_pixels
+        self.shift_method = shift_method
+        self.padding = np.asarray(self.getSliceShape()[:2]) * padding_multipler
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+    
+    def getSlice(self, ind):
+        try:
+            # move to the end as most recently used
+            frame = self._cache.pop(ind)
+        except KeyError:
+            frame = np.asarray(self.datasource.getSlice(ind), dtype=np.float64)
+            frame = shift_frames(frame[:, :, None], self.shifts_in_pixels[ind:ind+1], self.shift_method, self.padding)[:, :, 0]
+            
+            if self.cache_size > 0 and len(self._cache) >= self.cache_size:
+                self._cache.popitem(last=False)
+        
+        if self.cache_size > 0:
+            self._cache[ind] = frame
+        return frame
+    
+    def getSliceShape(self):
+        return self.datasource.getSliceShape()
+    
+    def getNumSlices(self):
+        return self.datasource.getNumSlices()
+    
+    def getEvents(self):
+        return self.datasource.getEvents()
     
-def shift_image_direct_rough(source_ft, shifts, kxy=None):
-    if kxy is None:
-        kx = np.fft.fftfreq(source_ft.shape[0])
-        ky = np.fft.fftfreq(source_ft.shape[1])
-#        kz = np.fft.fftfreq(source_ft.shape[2]) * 0.5
-        kx, ky = np.meshgrid(kx, ky, indexing='ij')
-    else:
-        kx, ky = kxy
-    
-#    print(source_ft.dtype)
-#    print(kx.dtype)
-#    print(ky.dtype)
-#    print(shifts.dtype)
-    return np.abs(np.fft.ifftn(source_ft*np.exp(-2j*np.pi*(kx*shifts[0] + ky*shifts[1]))))
\ No newline at end of file
+    def isComplete(self):
+        return self.datasource.isComplete()
+    
\ No newline at end of file
@@ -25,4 +25,7 @@ setup(name='cc_drift_cor',
       cmdclass = {
               'develop': run_post_develop,
               },
+      entry_points = {
+              'console_scripts': ['cc_drift_cor_batch = cc_drift_cor.batch:main'],
+              },
      )
@@ -0,0 +1,119 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+import pytest
+
+from cc_drift_cor import batch
+from cc_drift_cor.benchmarks import simulate_image_stack, drift_at, rms_without_offset
+
+
+class RecordingBudget(batch.MemoryBudget):
+    """
+        MemoryBudget that records the most datasets admitted at the same time.
+    """
+    instances = []
+    
+    def __init__(self, budget):
+        super(RecordingBudget, self).__init__(budget)
+        self.running = 0
+        self.max_running = 0
+        self._lock = threading.Lock()
+        RecordingBudget.instances.append(self)
+    
+    @contextmanager
+    def reserve(self, nbytes):
+        with super(RecordingBudget, self).reserve(nbytes):
+            with self._lock:
+                self.running += 1
+                self.max_running = max(self.max_running, self.running)
+            try:
+                yield
+            finally:
+                with self._lock:
+                    self.running -= 1
+
+
+def save_simulated_images(tmpdir, dims, size, n_frames, seeds=(0,)):
+    from PYME.IO.image import ImageStack
+    filenames, drifts = [], []
+    for seed in seeds:
+        raw, clean, drift, mdh, render = simulate_image_stack(size=size, n_frames=n_frames, dims=dims, seed=seed)
+        filenames.append(str(tmpdir.join('simulated_{}.h5'.format(seed))))
+        ImageStack(raw, mdh=mdh).Save(filename=filenames[-1])
+        drifts.append(drift)
+    return filenames, drifts
+
+
+def run_images(filenames, output, settings, *args):
+    argv = ['images'] + filenames + ['--output', output, '--workers', '1', '--drift-only'] + list(args)
+    for setting in settings:
+        argv += ['--set', setting]
+    assert batch.main(argv) == 0
+    
+    with open(os.path.join(output, 'summary.json')) as f:
+        summary = json.load(f)
+    assert [d['status'] for d in summary['datasets']] == ['ok'] * len(filenames)
+    return [np.load(os.path.join(d['output'], 'drift.npz')) for d in summary['datasets']]
+
+
+@pytest.mark.parametrize('dims, size, n_frames, settings', [(2, 64, 100, ['binsize=[1, 1, 10]']), (3, 96, 20, [])])
+def test_batch_images_drift_only(tmpdir, dims, size, n_frames, settings):
+    pytest.importorskip('PYME')
+    filenames, drifts = save_simulated_images(tmpdir, dims, size, n_frames)
+    result = run_images(filenames, str(tmpdir.join('results')), settings)[0]
+    
+    # measured drift (nm) is the correction, i.e. -drift
+    error = rms_without_offset(result['drift'][:, :dims] + drift_at(drifts[0], result['tIndex']))
+    assert error < 30
+
+
+def test_batch_jobs_match_serial_run(tmpdir, monkeypatch):
+    pytest.importorskip('PYME')
+    monkeypatch.setattr(batch, 'MemoryBudget', RecordingBudget)
+    filenames, _ = save_simulated_images(tmpdir, 2, 64, 100, seeds=(0, 1, 2))
+    settings = ['binsize=[1, 1, 10]']
+    
+    serial = run_images(filenames, str(tmpdir.join('serial')), settings, '--jobs', '1')
+    assert RecordingBudget.instances[-1].max_running == 1
+    
+    # budget fits all datasets
+    together = run_images(filenames, str(tmpdir.join('together')), settings, '--jobs', '3', '--memory-budget', '100000')
+    assert RecordingBudget.instances[-1].max_running > 1
+    for a, b in zip(serial, together):
+        np.testing.assert_array_equal(a['tIndex'], b['tIndex'])
+        np.testing.assert_allclose(a['drift'], b['drift'], rtol=1e-12, atol=1e-9)
+    
+    # budget below the estimate of one dataset, jobs are admitted one at a time
+    limited = run_images(filenames, str(tmpdir.join('limited')), settings, '--jobs', '3', '--memory-budget', '1')
+    assert RecordingBudget.instances[-1].max_running == 1
+    for a, b in zip(serial, limited):
+        np.testing.assert_allclose(a['drift'], b['drift'], rtol=1e-12, atol=1e-9)
+
+
+def test_memory_budget_admission():
+    budget = RecordingBudget(100)
+    
+    def job(nbytes):
+        with budget.reserve(nbytes):
+            time.sleep(0.05)
+    
+    threads = [threading.Thread(target=job, args=(40,)) for i in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert budget.max_running == 2
+    assert budget.used == 0
+    
+    # over the budget on its own, still runs alone
+    budget.max_running = 0
+    threads = [threading.Thread(target=job, args=(nbytes,)) for nbytes in [150, 40, 150]]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert budget.max_running == 1
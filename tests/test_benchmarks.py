@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+from cc_drift_cor import benchmarks
+
+
+@pytest.mark.parametrize('dims', [2, 3])
+def test_localizations_recover_drift(dims):
+    pytest.importorskip('PYME')
+    results = benchmarks.benchmark_localizations(n_events=40000, n_frames=4000, dims=dims)
+    # RMS error (nm) of the measured drift and of the corrected localizations against the simulated drift
+    assert results['rcc'][1] < 10
+    assert results['ApplyDrift'][1] < 15
+
+
+@pytest.mark.parametrize('dims, size', [(2, 64), (3, 96)])
+def test_images_recover_drift(dims, size):
+    pytest.importorskip('PYME')
+    # z has size // 8 slices, fewer than 12 is not enough for the z drift
+    results = benchmarks.benchmark_images(size=size, n_frames=100, dims=dims)
+    # RMS error (nm) of the measured drift, simulated drift is up to 300 nm
+    assert results['rcc'][1] < 30
+    shift_name = 'ShiftImage' if dims == 2 else 'ShiftVolume'
+    assert results[shift_name][1] < 0.05
+
+
+def test_solvers_recover_drift():
+    results = benchmarks.benchmark_solvers(n_steps=50)
+    assert results['RCC'][1] < 0.5
+    assert results['IRLS'][1] < 0.5
+
+
+def test_pair_sampling_beats_window_of_same_cost():
+    results = benchmarks.benchmark_pair_sampling(n_steps=200)
+    # Geometric 1 correlates fewer pairs than Window 20 but is more accurate than Window 5
+    assert results['Geometric 1'][0] < results['Window 20'][0]
+    assert results['Geometric 1'][1] < results['Window 5'][1]
+
+
+def test_shift_and_median_benchmarks():
+    results = benchmarks.benchmark_shift_methods(shape=(64, 64), n_frames=4, repeats=1)
+    assert all(error < 0.05 for seconds, error in results.values())
+    results = benchmarks.benchmark_median_methods(shape=(64, 64), n_frames=4)
+    assert all(error == 0 for rate, error in results.values())
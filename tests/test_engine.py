@@ -0,0 +1,295 @@
+import numpy as np
+import pytest
+
+from cc_drift_cor.engine import DriftTable
+
+
+def linear(t):
+    return 2. * np.asarray(t)
+
+
+@pytest.mark.parametrize('fallback', [None, linear])
+def test_drift_table_inside(fallback):
+    table = DriftTable(10, linear(np.arange(10, 20)), fallback)
+    assert table(12.5) == pytest.approx(25.)
+    assert np.shape(table(12.5)) == ()
+    np.testing.assert_allclose(table(np.asarray([10, 12.5, 19])), [20, 25, 38])
+
+
+def test_drift_table_outside_clips():
+    table = DriftTable(10, linear(np.arange(10, 20)))
+    assert table(5) == pytest.approx(20.)
+    assert table(25) == pytest.approx(38.)
+    np.testing.assert_allclose(table(np.asarray([5, 15, 25])), [20, 30, 38])
+
+
+def test_drift_table_outside_fallback():
+    table = DriftTable(10, linear(np.arange(10, 20)), linear)
+    assert table(5) == pytest.approx(10.)
+    assert table(25.) == pytest.approx(50.)
+    assert np.shape(table(25.)) == ()
+    np.testing.assert_allclose(table(np.asarray([5, 15, 25])), [10, 30, 50])
+    np.testing.assert_allclose(table(np.asarray([[5, 15], [25, 19]])), [[10, 30], [50, 38]])
+
+
+from cc_drift_cor import engine
+
+
+def test_median_filter_selection_matches_ndimage():
+    from scipy import ndimage
+    rng = np.random.RandomState(0)
+    data = rng.randint(0, 1000, (21, 17, 5)).astype(np.uint16)
+    for kernel_shape in [(3, 3, 1), (3, 3, 3), (2, 3, 1), (5, 1, 1)]:
+        expected = ndimage.median_filter(data, kernel_shape, mode='nearest')
+        np.testing.assert_array_equal(engine.median_filter_selection(data, kernel_shape, block_size=64), expected)
+
+
+def test_block_reduce_partial_bins():
+    rng = np.random.RandomState(0)
+    data = rng.randint(0, 1000, (11, 7, 5)).astype(np.uint16)
+    binsize = (3, 2, 5)
+    shape = tuple(-(-n // b) for n, b in zip(data.shape, binsize))
+    blocks = np.empty(shape, dtype=object)
+    for index in np.ndindex(*shape):
+        blocks[index] = data[tuple(slice(i * b, (i + 1) * b) for i, b in zip(index, binsize))].astype(np.float64)
+    
+    for mode, reduce in [('mean', np.mean), ('sum', np.sum), ('max', np.max)]:
+        reduced = engine.block_reduce(data, binsize, mode)
+        assert reduced.shape == shape
+        assert reduced.dtype == engine.calc_block_reduce_dtype(data.dtype, binsize, mode)
+        expected = np.vectorize(reduce)(blocks)
+        np.testing.assert_allclose(reduced, expected, rtol=1e-6)
+
+
+def test_clip_and_taper():
+    rng = np.random.RandomState(0)
+    data = rng.randint(0, 1000, (13, 9, 4)).astype(np.uint16)
+    mask = engine.calc_tukey_mask(data.shape[:2], 0.5)
+    for threshold_lower, clip_to_lower, threshold_upper, clip_to_upper in [(100, 50, 900, 950), (100, 120, 900, 80)]:
+        expected = data.astype(np.float64)
+        expected[expected >= threshold_upper] = clip_to_upper
+        expected[expected <= threshold_lower] = clip_to_lower
+        expected -= clip_to_lower
+        expected *= mask
+        
+        out = engine.clip_and_taper(data, threshold_lower, clip_to_lower, threshold_upper, clip_to_upper, mask, block_size=40)
+        assert out.dtype == np.float32
+        np.testing.assert_allclose(out, expected, rtol=1e-6)
+
+
+def test_plan_tiles_stitching_matches_single_tile():
+    rng = np.random.RandomState(0)
+    data = rng.randint(0, 1000, (23, 19, 6)).astype(np.uint16)
+    kernel_shape = (3, 3, 3)
+    halo = tuple(k // 2 for k in kernel_shape)
+    filter_args = (kernel_shape, 'Auto', 100, 50, 900, 950)
+    
+    expected = engine.preprocess_tile(data, None, *filter_args)[0]
+    tiles = engine.plan_tiles(data.shape, halo, 500)
+    assert len(tiles) > 1
+    stitched = np.full(data.shape, np.nan, dtype=np.float32)
+    for outer, core in tiles:
+        inner = tuple(slice(c.start - o.start, c.stop - o.start) for o, c in zip(outer, core))
+        stitched[core] = engine.preprocess_tile(data[outer], inner, *filter_args)[0]
+    np.testing.assert_array_equal(stitched, expected)
+
+
+def shift_frames_baseline(frames, shifts):
+    """
+        Per frame complex fft shift with the frame size as padding, as ShiftImage did before batching.
+    """
+    shape = np.asarray(frames.shape[:2])
+    padded_shape = 3 * shape
+    kx, ky = np.meshgrid(np.fft.fftfreq(padded_shape[0]), np.fft.fftfreq(padded_shape[1]), indexing='ij')
+    shifted = np.empty(frames.shape)
+    for i in range(frames.shape[-1]):
+        padded = np.zeros(padded_shape)
+        padded[shape[0]:2*shape[0], shape[1]:2*shape[1]] = frames[:, :, i]
+        ft = np.fft.fftn(padded) * np.exp(-2j*np.pi*(kx*shifts[i, 0] + ky*shifts[i, 1]))
+        shifted[:, :, i] = np.abs(np.fft.ifftn(ft))[shape[0]:2*shape[0], shape[1]:2*shape[1]]
+    return shifted
+
+
+def render_blobs(shape, n_frames, sigma=2.):
+    # far enough from the borders that shifted blobs are not cut off
+    x, y = np.meshgrid(np.arange(shape[0]), np.arange(shape[1]), indexing='ij')
+    frame = np.zeros(shape)
+    for cx, cy in [(20, 18), (26, 28), (32, 21)]:
+        frame += np.exp(-((x - cx)**2 + (y - cy)**2) / (2 * sigma**2))
+    return np.repeat(frame[:, :, None], n_frames, axis=2)
+
+
+@pytest.mark.parametrize('method, tolerance', [('Fourier', 1e-9), ('Linear', 1e-1), ('Cubic', 2e-2), ('Lanczos', 1e-2)])
+def test_shift_frames_matches_baseline(method, tolerance):
+    frames = render_blobs((52, 46), 4)
+    shifts = np.asarray([[0, 0], [0.3, -1.2], [2.5, 1.7], [-3.4, 0.6]])
+    expected = shift_frames_baseline(frames, shifts)
+    
+    shifted = engine.shift_frames(frames, shifts, method)
+    assert shifted.shape == frames.shape
+    np.testing.assert_allclose(shifted, expected, atol=tolerance)
+
+
+@pytest.mark.parametrize('method, corr_window', [('DCC', 0), ('RCC', 0), ('RCC', 3), ('RCC', 20)])
+@pytest.mark.parametrize('sampling', engine.PAIR_SAMPLINGS)
+@pytest.mark.parametrize('n_steps', [1, 2, 7, 40])
+def test_count_pairs_matches_select_pairs(n_steps, method, corr_window, sampling):
+    pairs = engine.select_pairs(n_steps, method, corr_window, sampling)
+    assert engine.count_pairs(n_steps, method, corr_window, sampling) == len(pairs)
+    assert len(set(pairs)) == len(pairs)
+    assert all(0 <= i < j < n_steps for i, j in pairs)
+    if n_steps > 1:
+        assert engine.PairCoefficients.from_pairs(pairs, n_steps).is_full_rank()
+
+
+def simulate_pair_shifts(n_steps, corr_window, sampling, n_outliers=0, seed=0):
+    rng = np.random.RandomState(seed)
+    pairs, coefs = engine.plan_pairs(n_steps, 'RCC', corr_window, sampling)
+    drifts = rng.normal(0, 1, (n_steps - 1, 3))
+    shifts = coefs.dot(drifts) + rng.normal(0, 0.05, (len(pairs), 3))
+    outliers = rng.choice(len(pairs), n_outliers, replace=False)
+    shifts[outliers] += rng.normal(0, 20, (n_outliers, 3))
+    return coefs, drifts, shifts, outliers
+
+
+@pytest.mark.parametrize('n_steps, corr_window', [(12, 0), (60, 4)])
+def test_pair_coefficients_solve_matches_pinv(n_steps, corr_window):
+    coefs, drifts, shifts, _ = simulate_pair_shifts(n_steps, corr_window, 'Window')
+    dense = coefs.todense()
+    np.testing.assert_allclose(coefs.dot(drifts), np.matmul(dense, drifts))
+    
+    weights = np.random.RandomState(1).uniform(0.5, 2, len(coefs))
+    expected = np.matmul(np.linalg.pinv(dense * np.sqrt(weights)[:, None]), shifts * np.sqrt(weights)[:, None])
+    np.testing.assert_allclose(engine.solve_drift(coefs, shifts, weights), expected, atol=1e-8)
+
+
+def reject_outliers_greedy(coefs, shifts, drifts, shift_max):
+    """
+        Previous dense implementation of reject_outliers, rank checked after each removal.
+    """
+    dense = coefs.todense()
+    residuals_dist = np.linalg.norm(np.matmul(dense, drifts) - shifts, axis=1)
+    residuals_arg = np.argsort(-residuals_dist)
+    residuals_arg = residuals_arg[residuals_dist[residuals_arg] > shift_max]
+    
+    counter = 0
+    for index in residuals_arg:
+        temp = dense.copy()
+        temp[index, :] = 0
+        if np.linalg.matrix_rank(temp) == dense.shape[1]:
+            dense = temp
+            counter += 1
+        else:
+            return np.any(dense != 0, axis=1), counter, False
+    return np.any(dense != 0, axis=1), counter, True
+
+
+@pytest.mark.parametrize('n_steps, corr_window, n_outliers', [(20, 0, 15), (30, 2, 10), (30, 1, 5)])
+def test_reject_outliers_matches_greedy(n_steps, corr_window, n_outliers):
+    coefs, _, shifts, _ = simulate_pair_shifts(n_steps, corr_window, 'Window', n_outliers)
+    drifts = engine.solve_drift(coefs, shifts)
+    
+    keep, counter, complete = engine.reject_outliers(coefs, shifts, drifts, 1.)
+    expected_keep, expected_counter, expected_complete = reject_outliers_greedy(coefs, shifts, drifts, 1.)
+    np.testing.assert_array_equal(keep, expected_keep)
+    assert (counter, complete) == (expected_counter, expected_complete)
+
+
+def test_solve_drift_robust_with_outliers():
+    coefs, drifts, shifts, outliers = simulate_pair_shifts(40, 6, 'Window', n_outliers=20)
+    error_lsq = np.abs(engine.solve_drift(coefs, shifts) - drifts).max()
+    
+    robust, robust_weights, n_iterations = engine.solve_drift_robust(coefs, shifts, 0.5)
+    assert np.abs(robust - drifts).max() < 0.3
+    assert np.abs(robust - drifts).max() < error_lsq / 20
+    # only the outliers are down-weighted
+    np.testing.assert_array_equal(np.where(robust_weights < 1)[0], np.sort(outliers))
+    assert 1 < n_iterations < 50
+
+
+def test_calc_pair_weights():
+    quality = np.zeros((5, len(engine.QUALITY_METRICS)))
+    quality[:, engine.QUALITY_METRICS.index('fit_residual')] = [0.1, 0.2, 0.001, np.nan, np.inf]
+    weights = engine.calc_pair_weights(quality)
+    
+    # residuals below 0.01 are clipped, nan and inf get the lowest weight
+    expected = np.asarray([1 / 0.1**2, 1 / 0.2**2, 1 / 0.01**2, 0, 0])
+    expected *= 5 / expected.sum()
+    np.testing.assert_allclose(weights[:3], expected[:3])
+    np.testing.assert_allclose(weights[3:], 1e-3)
+    assert weights[2] > weights[0] > weights[1]
+
+
+def test_plan_rcc_memory():
+    ft_shape = (100, 64, 64, 33)
+    ft_bytes = 100 * 64 * 64 * 33 * 16
+    n_pairs = engine.count_pairs(100, 'RCC', 10)
+    
+    plan = engine.plan_rcc_memory(ft_shape, n_pairs, pool_size=4)
+    assert (plan['storage'], plan['precision'], plan['workers'], plan['fits']) == ('Memory', 'Double', 4, True)
+    assert plan['ft_bytes'] == ft_bytes
+    
+    plan = engine.plan_rcc_memory(ft_shape, n_pairs, 0.75 * ft_bytes)
+    assert (plan['storage'], plan['precision'], plan['fits']) == ('Memory', 'Single', True)
+    assert plan['estimated_bytes'] <= 0.75 * ft_bytes
+    
+    plan = engine.plan_rcc_memory(ft_shape, n_pairs, 0.25 * ft_bytes, pool_size=4)
+    assert (plan['storage'], plan['precision'], plan['fits']) == ('File', 'Double', True)
+    assert plan['estimated_bytes'] <= 0.25 * ft_bytes
+    assert 1 <= plan['workers'] <= 4
+    
+    plan = engine.plan_rcc_memory(ft_shape, n_pairs, 0.25 * ft_bytes, can_cache=False)
+    assert (plan['storage'], plan['precision'], plan['fits']) == ('Memory', 'Single', False)
+    
+    plan = engine.plan_rcc_memory(ft_shape, n_pairs, storage='File', precision='Single')
+    assert (plan['storage'], plan['precision'], plan['dtype']) == ('File', 'Single', 'complex64')
+
+
+def test_debug_cross_cor_store():
+    dtype, captured = engine.plan_debug_cross_cor(10, (32, 24), crop_size=8, every=3)
+    np.testing.assert_array_equal(captured, [0, 3, 6, 9])
+    assert dtype['image'].shape == (8, 8)
+    
+    # 3D cross correlation, projected along its short z axis, with its peak near the x border
+    cross_corr = np.zeros((32, 24, 4))
+    cross_corr[30, 5, :] = 1
+    store = np.zeros(len(captured), dtype=dtype)
+    engine.store_cross_cor(cross_corr, [], 1, store)
+    np.testing.assert_array_equal(store['corner'][1], [24, 1])
+    assert store['image'][1][6, 4] == 1
+    assert store['image'][1].sum() == 1
+    assert store['image'][0].sum() == 0
+    
+    dtype, _ = engine.plan_debug_cross_cor(1, (32, 24))
+    assert dtype['image'].shape == (32, 24)
+
+
+def test_prefetch_blocks_order():
+    data = np.arange(100)
+    blocks = [(i, min(i + 15, 100)) for i in range(0, 100, 15)]
+    buffers = [np.empty(15, dtype=data.dtype) for _ in range(2)]
+    
+    def read_block(i_start, i_end, out):
+        out = out[:i_end - i_start]
+        out[:] = data[i_start:i_end]
+        return out
+    
+    starts = []
+    for i_start, block in engine.prefetch_blocks(read_block, blocks, buffers):
+        starts.append(i_start)
+        np.testing.assert_array_equal(block, data[i_start:i_start + len(block)])
+    assert starts == [b[0] for b in blocks]
+
+
+def test_prefetch_blocks_raises():
+    def read_block(i_start, i_end, out):
+        if i_start == 2:
+            raise ValueError("bad block")
+        return out
+    
+    blocks = [(0, 1), (1, 2), (2, 3), (3, 4)]
+    seen = []
+    with pytest.raises(ValueError, match="bad block"):
+        for i_start, block in engine.prefetch_blocks(read_block, blocks, [np.empty(1)]):
+            seen.append(i_start)
+    assert seen == [0, 1]
@@ -0,0 +1,27 @@
+import json
+
+import numpy as np
+import pytest
+
+from cc_drift_cor.plugins.recipes.instrumentation import Instrumentation, get_current_rss
+
+
+def test_span_rss_delta():
+    if get_current_rss() is None:
+        pytest.skip("RSS not available on this platform")
+    instrumentation = Instrumentation('test')
+    
+    with instrumentation.span('allocate'):
+        kept = np.ones(2**24)
+    with instrumentation.span('allocate and free'):
+        freed = np.ones(2**24)
+        del freed
+    instrumentation.add_time('elsewhere', 1.)
+    
+    report = json.loads(instrumentation.to_json())
+    # 128 MB kept, the allocator may keep a bit of what was freed
+    assert report['spans']['allocate']['rss_delta_bytes'] > 0.9 * kept.nbytes
+    assert abs(report['spans']['allocate and free']['rss_delta_bytes']) < 0.1 * kept.nbytes
+    assert report['spans']['elsewhere']['rss_delta_bytes'] is None
+    assert report['rss_bytes'] > kept.nbytes
+    assert report['process_peak_rss_bytes'] >= report['rss_bytes']
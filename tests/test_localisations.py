@@ -0,0 +1,78 @@
+import os
+import time
+
+import numpy as np
+import pytest
+
+from cc_drift_cor import benchmarks
+
+pytest.importorskip('PYME')
+from cc_drift_cor.plugins.recipes import localisations
+
+
+def measure_drift(locs, **kwargs):
+    """
+        Drift measured by Locs_RCC (without ApplyDrift) at the time points of the windows, and the module.
+    """
+    rcc = localisations.RCCDriftCorrection(step=400, window=400, binsize=30., cache_fft='', multiprocessing=False, **kwargs)
+    rcc.trait_setq(**{"_start_time": time.time()})
+    drift_res = rcc.calc_corr_drift_from_locs(locs['x'], locs['y'], locs['z'], locs['t'])
+    t_shift, shifts = rcc.rcc(rcc.shift_max, *drift_res)
+    return t_shift, np.cumsum(shifts, 0), rcc
+
+
+def test_project_z_matches_full_3d():
+    locs, drift = benchmarks.simulate_localizations(n_events=40000, n_frames=4000, dims=3)
+    
+    errors = dict()
+    measured = dict()
+    for project_z in [False, True]:
+        t_shift, shifts, _ = measure_drift(locs, project_z=project_z)
+        # measured drift is the correction, i.e. -drift
+        residuals = shifts + benchmarks.drift_at(drift, t_shift)
+        errors[project_z] = [benchmarks.rms_without_offset(residuals[:, [d]]) for d in range(3)]
+        measured[project_z] = shifts
+    
+    # RMS error (nm) per axis, simulated drift spans up to 120 nm
+    assert max(errors[False]) < 5
+    assert max(errors[True]) < 5
+    assert benchmarks.rms_without_offset(measured[True] - measured[False]) < 3
+
+
+def test_project_z_keeps_both_debug_projections(tmpdir):
+    locs, _ = benchmarks.simulate_localizations(n_events=20000, n_frames=2000, dims=3)
+    debug_cor_file = str(tmpdir.join('cross_cor.bin'))
+    
+    _, _, rcc = measure_drift(locs, project_z=True, debug_cor_file=debug_cor_file, debug_cor_size=0)
+    assert os.path.exists(debug_cor_file)
+    assert os.path.exists(str(tmpdir.join('cross_cor_xz.bin')))
+    
+    # 5000 nm x 5000 nm x 600 nm in 30 nm bins, xz projections are much shorter in z
+    xy_shape = rcc._cc_image.data.getSliceShape()
+    xz_shape = rcc._cc_image_xz.data.getSliceShape()
+    assert max(xy_shape) == max(xz_shape)
+    assert min(xz_shape) < min(xy_shape) / 4
+    assert rcc._cc_image.data.getNumSlices() == rcc._cc_image_xz.data.getNumSlices()
+    
+    _, _, rcc = measure_drift(locs, project_z=False, debug_cor_file=debug_cor_file)
+    assert rcc._cc_image_xz is None
+
+
+def test_apply_drift_output_is_mapping_filter():
+    from PYME.IO import tabular
+    locs, drift = benchmarks.simulate_localizations(n_events=1000, n_frames=100, dims=3)
+    interpolators = [lambda t, d=d: -benchmarks.drift_at(drift, t)[:, d] for d in range(3)]
+    namespace = {'Localizations': tabular.DictSource(locs), 'drift_interpolator': interpolators}
+    apply_drift = localisations.ApplyDrift()
+    apply_drift.execute(namespace)
+    out = namespace[apply_drift.output_name]
+    
+    assert isinstance(out, tabular.mappingFilter)
+    for k in ['x', 'y', 'z']:
+        np.testing.assert_allclose(out[k], locs[k + '_true'])
+    
+    # columns and mappings added downstream as on the previous mappingFilter output
+    out.addColumn('A', np.ones(1000))
+    np.testing.assert_array_equal(out['A'], 1)
+    out.setMapping('x', 'x - dx')
+    np.testing.assert_allclose(out['x'], locs['x'])
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+from cc_drift_cor.benchmarks import simulate_localizations
+from cc_drift_cor.engine import OnlineRCCDriftEstimator
+
+
+def run_estimator(locs, dims, corr_window=2, chunk=250):
+    z_range = (locs['z'].min(), locs['z'].max()) if dims == 3 else None
+    estimator = OnlineRCCDriftEstimator((locs['x'].min(), locs['x'].max()), (locs['y'].min(), locs['y'].max()), z_range,
+                                        binsize=30, step=500, window=500, corr_window=corr_window)
+    t = locs['t']
+    for start in np.arange(0, t.max() + 1, chunk):
+        m = (t >= start) & (t < start + chunk)
+        estimator.add_localizations(locs['x'][m], locs['y'][m], locs['z'][m] if dims == 3 else None, t[m])
+    estimator.finish()
+    return estimator.drift
+
+
+def drift_error(t_mid, positions, drift):
+    # positions are relative to the first window and of opposite sign to the drift added
+    truth = drift[t_mid.astype(int)] - drift[int(t_mid[0])]
+    valid = ~np.isnan(positions).any(axis=1)
+    return np.sqrt(((positions[valid] + truth[valid])**2).mean(axis=0)), valid
+
+
+@pytest.mark.parametrize('dims', [2, 3])
+def test_online_recovers_drift(dims):
+    locs, drift = simulate_localizations(n_events=60000, n_frames=5000, dims=dims, seed=1)
+    t_mid, positions = run_estimator(locs, dims)
+    
+    error, valid = drift_error(t_mid, positions, drift)
+    assert valid.all()
+    assert np.all(error[:dims] < 10)
+    if dims == 2:
+        assert np.all(positions[:, 2] == 0)
+
+
+def test_online_skips_gap():
+    locs, drift = simulate_localizations(n_events=60000, n_frames=5000, dims=3, seed=2)
+    # no localizations in windows 4 and 5
+    keep = (locs['t'] < 2000) | (locs['t'] >= 3000)
+    locs = dict((k, v[keep]) for k, v in locs.items())
+    t_mid, positions = run_estimator(locs, 3, corr_window=2)
+    
+    error, valid = drift_error(t_mid, positions, drift)
+    assert list(np.where(~valid)[0]) == [4, 5]
+    assert np.all(error < 10)
@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('PYME')
+
+from PYME.IO.image import ImageStack
+
+from cc_drift_cor.benchmarks import simulate_image_stack
+from cc_drift_cor.engine import shift_frames
+from cc_drift_cor.plugins.recipes import processing
+
+
+def volume_namespace(module, binning):
+    raw, clean, drift, mdh, render = simulate_image_stack(size=32, n_frames=4, dims=3)
+    if not binning is None:
+        mdh['recipe.binning'] = binning
+    
+    t_called = list()
+    def zero_drift(t):
+        t_called.append(np.asarray(t))
+        return np.zeros_like(t)
+    
+    namespace = {module.input_image: ImageStack(clean, mdh=mdh),
+                 module.input_drift_interpolator: [zero_drift] * 3}
+    return namespace, t_called
+
+
+@pytest.mark.parametrize('binning, t_expected', [(None, [0, 1, 2, 3]), ([1, 1, 10], [5, 15, 25, 35])])
+def test_shift_volume_binned_time(binning, t_expected):
+    shift = processing.ShiftVolume(cache_image='', multiprocessing=False, shift_method='Linear')
+    namespace, t_called = volume_namespace(shift, binning)
+    shift._execute(namespace)
+    
+    assert len(t_called) == 3
+    for t in t_called:
+        np.testing.assert_allclose(t, t_expected)
+
+
+def test_shift_volume_lazy_raises():
+    shift = processing.ShiftVolume(cache_image='', multiprocessing=False, lazy=True)
+    namespace, t_called = volume_namespace(shift, None)
+    with pytest.raises(Exception):
+        shift._execute(namespace)
+    assert not shift.outputName in namespace
+
+
+class CountingSource(object):
+    """
+        Minimal XYT data source that counts reads per frame.
+    """
+    def __init__(self, data):
+        self.data = data
+        self.reads = list()
+    
+    def getSlice(self, ind):
+        self.reads.append(ind)
+        return self.data[:, :, ind]
+    
+    def getSliceShape(self):
+        return self.data.shape[:2]
+    
+    def getNumSlices(self):
+        return self.data.shape[2]
+
+
+@pytest.mark.parametrize('cache_size, cached, reads', [(0, [], [0, 1, 0, 2, 1, 0]),
+                                                       (1, [0], [0, 1, 0, 2, 1, 0]),
+                                                       (2, [1, 0], [0, 1, 2, 1, 0]),
+                                                       (8, [2, 1, 0], [0, 1, 2])])
+def test_lazy_source_lru(cache_size, cached, reads):
+    rng = np.random.RandomState(0)
+    data = rng.rand(16, 16, 3)
+    shifts = rng.uniform(-2, 2, (3, 2))
+    source = CountingSource(data)
+    lazy = processing.DriftCorrectedDataSource(source, shifts, 'Cubic', cache_size=cache_size)
+    
+    expected = shift_frames(data, shifts, 'Cubic', np.asarray(data.shape[:2]))
+    for ind in [0, 1, 0, 2, 1, 0]:
+        np.testing.assert_allclose(lazy.getSlice(ind), expected[:, :, ind])
+    
+    # least recently used first
+    assert list(lazy._cache.keys()) == cached
+    assert source.reads == reads